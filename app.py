@@ -1,20 +1,28 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS  # Add this import
 import json
 import os
-import random
-import secrets
 import logging
 import subprocess
-import qrcode
-from io import BytesIO
-import base64
+import csv
+import re
+import tempfile
+import threading
+from datetime import datetime
+from io import StringIO
 from werkzeug.utils import secure_filename
-from PIL import Image
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from openpyxl import Workbook
 from dotenv import load_dotenv
+from storage import open_backend, TicketSpaceExhausted
+from assets import AssetManifest
+from draw import DrawError, draw_winners
+from thumbnails import ThumbnailQueue, UploadRejected, image_limits, inspect_upload
+from blobs import BlobStore, is_blob, referenced_blobs
+import variants
+import qrcodes
+import mailer
+import outbox
+from compression import COMPRESSIBLE_TYPES, CompressedCache, available_encodings, compress, compress_stream, negotiate
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,13 +31,90 @@ app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 app.logger.setLevel(logging.INFO)  # Set logging level to INFO for production
 
-# Add cache control headers to all responses
+# Add cache control headers to responses that don't set their own
 @app.after_request
 def add_header(response):
-    """Add headers to prevent caching"""
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
+    """Prevent caching unless the route chose a caching policy (e.g. ETag revalidation)"""
+    if 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '-1'
+    return response
+
+def with_etag(response, etag):
+    """Tag a response with a strong ETag; clients may keep it but must revalidate before use"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def cached_response(etag):
+    """Answer from what is already known about this version of the resource, or return None.
+
+    That is a bodyless 304 if the client's If-None-Match has etag, or the
+    body compressed for an identical earlier request; either way nothing is
+    loaded or serialised.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
+    encoding = negotiate(request.headers.get('Accept-Encoding'), available_encodings())
+    if encoding != 'identity':
+        body = compressed_responses.get((request.full_path, etag, encoding))
+        if body is not None:
+            response = with_etag(app.response_class(body, mimetype='application/json'), etag)
+            response.set_etag(etag, weak=True)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+# API response compression; levels are the gzip level (1-9) and brotli quality (0-11)
+API_COMPRESS_MIN_SIZE = int(os.environ.get('API_COMPRESS_MIN_SIZE', 1024))
+API_COMPRESS_LEVELS = {
+    'gzip': int(os.environ.get('API_GZIP_LEVEL', 6)),
+    'br': int(os.environ.get('API_BROTLI_QUALITY', 5)),
+}
+compressed_responses = CompressedCache(int(os.environ.get('API_COMPRESS_CACHE_BYTES', 8 * 1024 * 1024)))
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-encode API responses the client accepts.
+
+    Bodies of ETag-tagged responses are cached per URL, version and encoding,
+    so each version is compressed once. Streamed responses are compressed
+    chunk by chunk.
+    """
+    if (not request.path.startswith('/api/')
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'), available_encodings())
+    if encoding == 'identity':
+        return response
+    level = API_COMPRESS_LEVELS[encoding]
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < API_COMPRESS_MIN_SIZE:
+            return response
+        etag, _ = response.get_etag()
+        key = (request.full_path, etag, encoding)
+        body = compressed_responses.get(key) if etag else None
+        if body is None:
+            body = compress(data, encoding, level)
+            if etag:
+                compressed_responses.put(key, body)
+        response.set_data(body)
+        if etag:
+            # A different byte representation of the same version
+            response.set_etag(etag, weak=True)
+    response.headers['Content-Encoding'] = encoding
     return response
 
 # Configure upload folder
@@ -46,192 +131,205 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-RAFFLES_FILE = 'raffle_data.json'
-BUYERS_FILE = 'buyers.json'
+# Raffle/buyer storage (STORAGE_BACKEND=json|sqlite)
+store = open_backend()
+
+# Uploaded images and thumbnails, stored once per content under a hash name
+blobs = BlobStore(os.path.join(UPLOAD_FOLDER, 'blobs'))
+BLOB_GC_GRACE = float(os.environ.get('BLOB_GC_GRACE', 3600))
+
+# Resized/WebP copies of uploaded images, rendered on first request
+image_variants = variants.VariantCache(os.path.join(UPLOAD_FOLDER, 'variants'),
+                                       int(os.environ.get('VARIANT_CACHE_BYTES', 256 * 1024 * 1024)))
+
+# Queued notification emails are delivered by a background sender in each app
+# process (not in thumbnail workers, which re-import app.py when it is run directly)
+if mailer.env_flag('OUTBOX_SENDER', True) and __name__ != '__mp_main__':
+    outbox.start_sender()
+
+# Rendered payment QR codes, shared by every buyer of a raffle
+payment_qr_cache = qrcodes.QrCache(int(os.environ.get('QR_CACHE_SIZE', 256)))
+
+# Content-hashed, precompressed copies of style.css/script.js/config.js
+assets = AssetManifest(app.root_path)
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def asset_response(asset, cache_control):
+    """Serve a prebuilt asset in the best encoding the client accepts"""
+    encoding, body = asset.select(request.headers.get('Accept-Encoding'))
+    response = app.response_class(body, content_type=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(asset.etag(encoding))
+    return response.make_conditional(request)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def create_thumbnail(image_path, thumbnail_path, max_size=(300, 300)):
-    """Create a thumbnail from the original image"""
-    try:
-        with Image.open(image_path) as img:
-            # Convert RGBA to RGB if necessary
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            
-            # Create thumbnail
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            img.save(thumbnail_path, 'JPEG', quality=85, optimize=True)
-            return True
-    except Exception as e:
-        app.logger.error(f"Error creating thumbnail: {str(e)}")
-        return False
+def thumbnail_done(raffle_id, rendered, error, timing):
+    """Record a processed upload on its raffle (runs inside a store transaction)"""
+    raffle = store.get_raffle(raffle_id)
+    if raffle is None:
+        return
+    if error is None:
+        old_image, old_thumbnail = raffle.get('image'), raffle.get('thumbnail')
+        raffle['image'] = blobs.put_file(rendered['image'], rendered['format'])
+        raffle['thumbnail'] = blobs.put_file(rendered['thumbnail'], 'jpg')
+        raffle['thumbnailStatus'] = 'ready'
+        app.logger.info(f"Image processed: {raffle['image']} (thumbnail {raffle['thumbnail']}) "
+                        f"in {timing['renderMs']}ms ({timing['totalMs']}ms after upload)")
+        if old_image and old_image != raffle['image']:
+            # Files from before the blob store are not shared and can go straight away;
+            # the blobs of a replaced image are left to the garbage collector
+            delete_legacy_upload(app.config['UPLOAD_FOLDER'], old_image)
+            delete_legacy_upload(app.config['THUMBNAIL_FOLDER'], old_thumbnail)
+            collect_blobs()
+    else:
+        # A replaced image stays in place
+        raffle['thumbnailStatus'] = 'failed'
+        app.logger.error(f"Error processing image for raffle {raffle_id}: {str(error)}")
+    store.put_raffle(raffle)
 
-def load_raffles():
-    try:
-        if not os.path.exists(RAFFLES_FILE):
-            save_raffles({"raffles": [], "current_raffle": None})
-            return {"raffles": [], "current_raffle": None}
-        with open(RAFFLES_FILE, 'r') as f:
-            data = json.load(f)
-            # Ensure the data has the correct structure
-            if not isinstance(data, dict):
-                data = {"raffles": [], "current_raffle": None}
-            if "raffles" not in data:
-                data["raffles"] = []
-            if "current_raffle" not in data:
-                data["current_raffle"] = None
-            return data
-    except Exception as e:
-        app.logger.error(f"Error loading raffles: {str(e)}")
-        return {"raffles": [], "current_raffle": None}
+# Uploads are decoded, normalized and thumbnailed in worker processes; the
+# raffle is returned with thumbnailStatus 'pending' (and its previous image,
+# if any) and gets its new image and thumbnail when they are ready
+thumbnail_queue = ThumbnailQueue(thumbnail_done, workers=int(os.environ.get('THUMBNAIL_WORKERS', 2)),
+                                 guard=store.transaction)
 
-def save_raffles(data):
-    try:
-        with open(RAFFLES_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        app.logger.error(f"Error saving raffles: {str(e)}")
-        raise
+def queue_thumbnail(raffle, upload_path):
+    """Start processing a received upload for the raffle; call inside the transaction that saves it"""
+    raffle['thumbnailStatus'] = 'pending'
+    thumbnail_queue.submit(raffle['id'], upload_path, blobs.root)
 
-def load_buyers(raffle_id):
-    try:
-        if not os.path.exists(BUYERS_FILE):
-            save_buyers({})
-            return []
-            
-        with open(BUYERS_FILE, 'r') as f:
-            buyers_data = json.load(f)
-            return buyers_data.get(str(raffle_id), [])
-    except json.JSONDecodeError:
-        # If file is empty or invalid, initialize it
-        save_buyers({})
-        return []
-    except Exception as e:
-        app.logger.error(f"Error loading buyers: {str(e)}")
-        return []
+def receive_upload(file):
+    """Check an uploaded image's header and spool it to a temporary file for processing.
 
-def save_buyers(data):
+    Returns the file's path, or None if there is no upload. Raises
+    UploadRejected for files that are not images, or too large ones.
+    """
+    if not (file and file.filename):
+        return None
+    if not allowed_file(file.filename):
+        raise UploadRejected(f"Unsupported file type (use {', '.join(sorted(ALLOWED_EXTENSIONS))})")
+    inspect_upload(file.stream, image_limits()[0])
+    fd, upload_path = tempfile.mkstemp(dir=blobs.root, prefix='.upload-', suffix='.tmp')
+    os.close(fd)
+    file.save(upload_path)
+    return upload_path
+
+def discard_upload(upload_path):
+    """Remove a spooled upload that was not handed to the thumbnail queue"""
+    if upload_path:
+        try:
+            os.remove(upload_path)
+        except FileNotFoundError:
+            pass
+
+def delete_legacy_upload(folder, filename):
+    """Delete an upload stored under its pre-blob-store name (raffle_<id>.<ext>)"""
+    if filename and not is_blob(filename):
+        path = os.path.join(folder, secure_filename(filename))
+        if os.path.exists(path):
+            os.remove(path)
+            app.logger.info(f"Deleted old image: {filename}")
+
+def collect_blobs():
+    """Remove blobs no raffle refers to any more, in the background"""
+    def collect():
+        try:
+            result = blobs.gc(referenced_blobs(store.load_raffles()['raffles']), BLOB_GC_GRACE)
+            if result['removed']:
+                app.logger.info(f"Removed {result['removed']} unreferenced blobs ({result['bytesFreed']} bytes)")
+        except Exception as e:
+            app.logger.error(f"Error collecting blobs: {str(e)}")
+    threading.Thread(target=collect, name='blob-gc', daemon=True).start()
+
+def blob_response(name):
+    """Serve a blob: immutable, with its content hash as strong ETag, and Range support"""
+    if not blobs.exists(name):
+        return jsonify({"error": "Not found"}), 404
+    response = send_file(blobs.path(name), conditional=True, etag=name.rsplit('.', 1)[0])
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    if is_blob(filename):
+        return blob_response(filename)
+    # Uploads from before the blob store change in place: revalidate them
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/uploads/<filename>/variant')
+def image_variant(filename):
+    """An uploaded image scaled to ?w= pixels wide, as ?fmt=webp|jpeg or negotiated from Accept"""
     try:
-        with open(BUYERS_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        app.logger.error(f"Error saving buyers: {str(e)}")
-        raise
+        width = int(request.args.get('w', ''))
+        if width <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "w must be a positive number of pixels"}), 400
+    try:
+        fmt = variants.parse_format(request.args.get('fmt'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    negotiated = fmt is None
+    if negotiated:
+        fmt = variants.negotiate_format(request.headers.get('Accept'))
+    # Only blobs: their names change with their content, so variants of them never go stale
+    if not blobs.exists(filename):
+        return jsonify({"error": "Not found"}), 404
 
-def send_winner_notification_email(buyer_email, buyer_name, raffle_name, winner_info):
-    """Send email notification to a buyer about the draw result"""
+    width = variants.snap_width(width)
+    name = variants.variant_name(filename, width, fmt)
+    source = blobs.path(filename)
     try:
-        smtp_server = os.environ.get('SMTP_SERVER', '')
-        smtp_port = os.environ.get('SMTP_PORT', '')
-        sender_email = os.environ.get('SENDER_EMAIL', '')
-        sender_password = os.environ.get('SENDER_PASSWORD', '')
-        sender_name = os.environ.get('SENDER_NAME', 'Raffle System')
-        
-        # Check if email is configured
-        if not all([smtp_server, smtp_port, sender_email, sender_password]):
-            app.logger.warning("Email not configured - skipping notification")
-            return False
-        
-        # Create email message
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{sender_name} <{sender_email}>"
-        msg['To'] = buyer_email
-        msg['Subject'] = f"🎉 {raffle_name} - Draw Result Announcement"
-        
-        # Create plain text body
-        text_body = f"""
-Dear {buyer_name},
-
-Thank you for participating in {raffle_name}!
-
-The draw has been completed!
-
-{winner_info}
-
-We appreciate your participation in this raffle.
-
-Best regards,
-{sender_name}
-"""
-        
-        # Create HTML body with nicer formatting
-        html_body = f"""
-        <html>
-            <body style="font-family: Arial, sans-serif; color: #333;">
-                <div style="max-width: 600px; margin: 0 auto; padding: 20px; background: #f8f9fa; border-radius: 8px;">
-                    <div style="text-align: center; margin-bottom: 30px;">
-                        <h2 style="color: #2c5282; margin: 0;">🎉 Draw Result Announcement</h2>
-                        <p style="color: #666; margin: 10px 0 0 0;">{raffle_name}</p>
-                    </div>
-                    
-                    <div style="background: white; padding: 20px; border-radius: 6px; border-left: 4px solid #2c5282;">
-                        <p>Dear {buyer_name},</p>
-                        <p>Thank you for participating in <strong>{raffle_name}</strong>!</p>
-                        <p>The draw has been completed! Here are the results:</p>
-                        
-                        <div style="background: #f0f4ff; padding: 15px; border-radius: 4px; margin: 20px 0; text-align: center;">
-                            <p style="margin: 0; font-size: 18px; color: #2c5282;"><strong>{winner_info}</strong></p>
-                        </div>
-                        
-                        <p>We appreciate your participation in this raffle!</p>
-                        <p style="margin-bottom: 5px;">Best regards,</p>
-                        <p style="margin: 0; color: #666;"><strong>{sender_name}</strong></p>
-                    </div>
-                    
-                    <div style="text-align: center; margin-top: 20px; font-size: 12px; color: #999;">
-                        <p style="margin: 0;">This is an automated message. Please do not reply to this email.</p>
-                    </div>
-                </div>
-            </body>
-        </html>
-        """
-        
-        # Attach both plain text and HTML versions
-        part1 = MIMEText(text_body, 'plain')
-        part2 = MIMEText(html_body, 'html')
-        msg.attach(part1)
-        msg.attach(part2)
-        
-        # Send email via SMTP
-        with smtplib.SMTP(smtp_server, int(smtp_port)) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        
-        app.logger.info(f"Winner notification sent to {buyer_email}")
-        return True
-        
+        path = image_variants.get(name, lambda temp_path: variants.render_variant(source, temp_path, width, fmt))
     except Exception as e:
-        app.logger.error(f"Error sending winner notification email: {str(e)}")
-        return False
+        app.logger.error(f"Error rendering {name}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-@app.route('/uploads/<filename>')
-def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    response = send_file(path, mimetype=variants.FORMATS[fmt][1], conditional=True, etag=name)
+    response.headers['Cache-Control'] = IMMUTABLE
+    if negotiated:
+        response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/uploads/thumbnails/<filename>')
 def uploaded_thumbnail(filename):
-    return send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
+    if is_blob(filename):
+        return blob_response(filename)
+    response = send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/')
 def home():
-    response = send_from_directory('.', 'index.html')
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    # index.html itself must be revalidated; the assets it links to are immutable
+    page = assets.page('index.html')
+    if page is None:
+        return send_from_directory('.', 'index.html')
+    return asset_response(page, 'no-cache')
+
+@app.route('/assets/<filename>')
+def serve_asset(filename):
+    asset = assets.asset(filename)
+    if asset is None:
+        return jsonify({"error": "Asset not found"}), 404
+    return asset_response(asset, IMMUTABLE)
 
 @app.route('/api/raffles', methods=['GET'])
 def get_raffles():
     try:
-        data = load_raffles()
-        return jsonify(data['raffles'])
+        etag = store.raffles_etag()
+        cached = cached_response(etag)
+        if cached:
+            return cached
+        data = store.load_raffles()
+        return with_etag(jsonify(data['raffles']), etag)
     except Exception as e:
         app.logger.error(f"Error getting raffles: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -258,65 +356,56 @@ def create_raffle():
             app.logger.error(f"Missing required fields: {missing}")
             return jsonify({"error": f"Missing required fields: {', '.join(missing)}"}), 400
         
-        data = load_raffles()
-        
-        # Generate new raffle ID
-        new_id = str(max([int(r['id']) for r in data['raffles']], default=0) + 1)
+        try:
+            ticket_cost = float(ticket_cost)
+        except ValueError:
+            return jsonify({"error": "ticketCost must be a number"}), 400
         
         # Handle image upload
-        image_filename = None
-        thumbnail_filename = None
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename and allowed_file(file.filename):
-                # Create unique filename with raffle ID
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                image_filename = f"raffle_{new_id}.{ext}"
-                thumbnail_filename = f"raffle_{new_id}_thumb.jpg"
-                
-                # Save original image
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(image_path)
-                app.logger.info(f"Image saved: {image_filename}")
-                
-                # Create thumbnail
-                thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-                if create_thumbnail(image_path, thumbnail_path):
-                    app.logger.info(f"Thumbnail created: {thumbnail_filename}")
-                else:
-                    thumbnail_filename = None
-        
-        # Parse banking details if provided
-        banking_details = None
-        if banking_details_json:
-            try:
-                banking_details = json.loads(banking_details_json)
-            except json.JSONDecodeError:
-                app.logger.warning("Failed to parse banking details JSON")
-        
-        new_raffle = {
-            'id': new_id,
-            'name': name,
-            'organizerName': organizer_name,
-            'drawDate': draw_date,
-            'prize': prize,
-            'ticketCost': float(ticket_cost),
-            'paymentLink': payment_link,
-            'drawn': False,
-            'winner': None
-        }
-        
-        if image_filename:
-            new_raffle['image'] = image_filename
-            if thumbnail_filename:
-                new_raffle['thumbnail'] = thumbnail_filename
-        
-        if banking_details:
-            new_raffle['bankingDetails'] = banking_details
-        
-        # Add to raffles list
-        data['raffles'].append(new_raffle)
-        save_raffles(data)
+        try:
+            upload_path = receive_upload(request.files.get('image'))
+        except UploadRejected as e:
+            return jsonify({"error": str(e)}), 400
+        
+        try:
+            with store.transaction():
+                data = store.load_raffles()
+        
+                # Generate new raffle ID
+                new_id = str(max([int(r['id']) for r in data['raffles']], default=0) + 1)
+        
+                # Parse banking details if provided
+                banking_details = None
+                if banking_details_json:
+                    try:
+                        banking_details = json.loads(banking_details_json)
+                    except json.JSONDecodeError:
+                        app.logger.warning("Failed to parse banking details JSON")
+        
+                new_raffle = {
+                    'id': new_id,
+                    'name': name,
+                    'organizerName': organizer_name,
+                    'drawDate': draw_date,
+                    'prize': prize,
+                    'ticketCost': ticket_cost,
+                    'paymentLink': payment_link,
+                    'drawn': False,
+                    'winner': None,
+                    'winners': []
+                }
+        
+                if upload_path:
+                    queue_thumbnail(new_raffle, upload_path)
+                    upload_path = None  # the thumbnail queue owns it now
+        
+                if banking_details:
+                    new_raffle['bankingDetails'] = banking_details
+        
+                # Add to raffles list
+                store.put_raffle(new_raffle)
+        finally:
+            discard_upload(upload_path)
         
         app.logger.info(f"Raffle created successfully: {new_raffle}")
         return jsonify(new_raffle), 201
@@ -329,26 +418,175 @@ def create_raffle():
 def get_raffle(raffle_id):
     try:
         app.logger.debug(f"Loading raffle with ID: {raffle_id}")
-        raffles_data = load_raffles()
-        
-        if not raffles_data or 'raffles' not in raffles_data:
-            app.logger.error("No raffles data found")
-            return jsonify({"error": "No raffles data available"}), 404
-            
-        app.logger.debug(f"Found {len(raffles_data['raffles'])} raffles")
-        raffle = next((r for r in raffles_data['raffles'] if str(r['id']) == str(raffle_id)), None)
+        etag = store.raffles_etag(raffle_id)
+        cached = cached_response(etag)
+        if cached:
+            return cached
+        raffle = store.get_raffle(raffle_id)
         
         if raffle is None:
             app.logger.error(f"Raffle with ID {raffle_id} not found")
             return jsonify({"error": "Raffle not found"}), 404
             
         app.logger.debug(f"Successfully found raffle: {raffle['name']}")
-        return jsonify(raffle)
+        return with_etag(jsonify(raffle), etag)
         
     except Exception as e:
         app.logger.error(f"Error getting raffle {raffle_id}: {str(e)}")
         return jsonify({"error": f"Failed to load raffle: {str(e)}"}), 500
 
+@app.route('/api/raffles/<raffle_id>/stats', methods=['GET'])
+def get_raffle_stats(raffle_id):
+    try:
+        raffle = store.get_raffle(raffle_id)
+        if raffle is None:
+            return jsonify({"error": "Raffle not found"}), 404
+
+        # Counts come from totals the store keeps up to date on every buyer change
+        stats = store.payment_totals(raffle_id)
+        ticket_cost = raffle.get('ticketCost', 0)
+        stats['unpaidBuyers'] = stats['totalBuyers'] - stats['paidBuyers']
+        stats['unpaidTickets'] = stats['totalTickets'] - stats['paidTickets']
+        stats['ticketCost'] = ticket_cost
+        stats['revenue'] = round(stats['paidTickets'] * ticket_cost, 2)
+        stats['pendingRevenue'] = round(stats['unpaidTickets'] * ticket_cost, 2)
+        stats['potentialRevenue'] = round(stats['totalTickets'] * ticket_cost, 2)
+        return jsonify(stats)
+    except Exception as e:
+        app.logger.error(f"Error getting stats for raffle {raffle_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+EXPORT_PAGE_SIZE = 500
+EXPORT_BUYER_HEADER = ['Buyer #', 'Name', 'Surname', 'Email', 'Mobile', 'Tickets', 'Purchase Date',
+                       'Payment Status', 'Ticket Numbers']
+
+def export_date(value):
+    """Format an ISO date for export like the PWA does (YYYY/MM/DD)"""
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).strftime('%Y/%m/%d')
+    except ValueError:
+        return value or ''
+
+def export_summary_rows(raffle, stats):
+    """Raffle information and summary statistics rows of an export"""
+    cost = raffle.get('ticketCost', 0)
+    rows = [
+        ['RAFFLE INFORMATION'],
+        ['Raffle Name', raffle.get('name', '')],
+        ['Raffle ID', raffle.get('id', '')],
+        ['Draw Date', export_date(raffle.get('drawDate'))],
+        ['Prize', raffle.get('prize', '')],
+        ['Ticket Cost', f"R{cost:.2f}"],
+        ['Payment Link', raffle.get('paymentLink', '')],
+        ['Draw Status', 'Completed' if raffle.get('drawn') else 'Pending'],
+    ]
+    if raffle.get('winner'):
+        rows.append(['Winner', raffle['winner']])
+    unpaid_tickets = stats['totalTickets'] - stats['paidTickets']
+    rows += [
+        [],
+        ['SUMMARY STATISTICS'],
+        ['Total Buyers', stats['totalBuyers']],
+        ['Total Tickets Sold', stats['totalTickets']],
+        ['Paid Buyers', stats['paidBuyers']],
+        ['Paid Tickets', stats['paidTickets']],
+        ['Unpaid Buyers', stats['totalBuyers'] - stats['paidBuyers']],
+        ['Unpaid Tickets', unpaid_tickets],
+        ['Total Revenue (Paid)', f"R{stats['paidTickets'] * cost:.2f}"],
+        ['Pending Revenue (Unpaid)', f"R{unpaid_tickets * cost:.2f}"],
+        ['Potential Total Revenue', f"R{stats['totalTickets'] * cost:.2f}"],
+    ]
+    return rows
+
+def export_buyer_rows(raffle_id):
+    """Yield one export row per buyer, reading the store a page at a time"""
+    after = None
+    while True:
+        buyers, after = store.query_buyers(raffle_id, limit=EXPORT_PAGE_SIZE, after=after)
+        for buyer in buyers:
+            yield [
+                buyer.get('buyerNumber'),
+                buyer.get('name', ''),
+                buyer.get('surname', ''),
+                buyer.get('email', ''),
+                buyer.get('mobile') or 'N/A',
+                buyer.get('tickets', len(buyer.get('ticket_numbers', []))),
+                export_date(buyer.get('purchaseDate')),
+                'Paid' if buyer.get('paymentReceived') else 'Unpaid',
+                '; '.join(f"{t:06d}" for t in buyer.get('ticket_numbers', []))
+            ]
+        if after is None:
+            return
+
+def stream_csv(summary_rows, raffle_id):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerows(summary_rows)
+    writer.writerows([[], [], ['BUYER DETAILS'], EXPORT_BUYER_HEADER])
+    yield flush()
+    for i, row in enumerate(export_buyer_rows(raffle_id), 1):
+        writer.writerow(row)
+        if i % 100 == 0:
+            yield flush()
+    yield flush()
+
+def stream_xlsx(summary_rows, raffle_id):
+    # Write-only mode spools rows to disk instead of building a tree in memory
+    workbook = Workbook(write_only=True)
+    summary = workbook.create_sheet('Summary')
+    for row in summary_rows:
+        summary.append(row)
+    sheet = workbook.create_sheet('Buyers')
+    sheet.append(EXPORT_BUYER_HEADER)
+    for row in export_buyer_rows(raffle_id):
+        sheet.append(row)
+
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+@app.route('/api/raffles/<raffle_id>/export', methods=['GET'])
+def export_raffle(raffle_id):
+    try:
+        export_format = request.args.get('format', 'csv').lower()
+        if export_format not in ('csv', 'xlsx'):
+            return jsonify({"error": "format must be csv or xlsx"}), 400
+
+        raffle = store.get_raffle(raffle_id)
+        if raffle is None:
+            return jsonify({"error": "Raffle not found"}), 404
+
+        summary_rows = export_summary_rows(raffle, store.payment_totals(raffle_id))
+        file_name = f"{re.sub(r'[^A-Za-z0-9]', '_', raffle.get('name', 'raffle'))}_{datetime.now():%Y-%m-%d}.{export_format}"
+        if export_format == 'csv':
+            body = stream_csv(summary_rows, raffle_id)
+            mimetype = 'text/csv'
+        else:
+            body = stream_xlsx(summary_rows, raffle_id)
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        app.logger.info(f"Exporting raffle {raffle_id} as {export_format}")
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+        )
+    except Exception as e:
+        app.logger.error(f"Error exporting raffle {raffle_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/raffles/<raffle_id>', methods=['PUT'])
 def update_raffle(raffle_id):
     try:
@@ -371,91 +609,72 @@ def update_raffle(raffle_id):
             app.logger.error(f"Missing required fields: {missing}")
             return jsonify({"error": f"Missing required fields: {', '.join(missing)}"}), 400
         
-        # Load raffles data
-        data = load_raffles()
+        try:
+            ticket_cost = float(ticket_cost)
+        except ValueError:
+            return jsonify({"error": "ticketCost must be a number"}), 400
         
-        # Find the raffle to update
-        raffle_index = None
-        existing_raffle = None
-        for i, r in enumerate(data['raffles']):
-            if str(r['id']) == str(raffle_id):
-                raffle_index = i
-                existing_raffle = r
-                break
-        
-        if raffle_index is None:
+        if store.get_raffle(raffle_id) is None:
             app.logger.error(f"Raffle with ID {raffle_id} not found")
             return jsonify({"error": "Raffle not found"}), 404
         
-        # Handle image upload
-        image_filename = existing_raffle.get('image')  # Keep existing image by default
-        thumbnail_filename = existing_raffle.get('thumbnail')  # Keep existing thumbnail by default
+        # Handle image upload; the current image is kept until the new one is processed
+        try:
+            upload_path = receive_upload(request.files.get('image'))
+        except UploadRejected as e:
+            return jsonify({"error": str(e)}), 400
+        
+        try:
+            with store.transaction():
+                # Find the raffle to update
+                existing_raffle = store.get_raffle(raffle_id)
+        
+                if existing_raffle is None:
+                    app.logger.error(f"Raffle with ID {raffle_id} not found")
+                    return jsonify({"error": "Raffle not found"}), 404
+        
+                image_filename = existing_raffle.get('image')  # Keep existing image by default
+                thumbnail_filename = existing_raffle.get('thumbnail')  # Keep existing thumbnail by default
+        
+                # Parse banking details if provided
+                banking_details = None
+                if banking_details_json:
+                    try:
+                        banking_details = json.loads(banking_details_json)
+                    except json.JSONDecodeError:
+                        app.logger.warning("Failed to parse banking details JSON")
+        
+                # Update raffle data
+                updated_raffle = {
+                    'id': raffle_id,
+                    'name': name,
+                    'organizerName': organizer_name,
+                    'drawDate': draw_date,
+                    'prize': prize,
+                    'ticketCost': ticket_cost,
+                    'paymentLink': payment_link,
+                    'drawn': existing_raffle.get('drawn', False),  # Preserve drawn status
+                    'winner': existing_raffle.get('winner'),  # Preserve winner if exists
+                    'winners': existing_raffle.get('winners', [])
+                }
         
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename and allowed_file(file.filename):
-                # Delete old images if they exist
                 if image_filename:
-                    old_image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-                        app.logger.info(f"Deleted old image: {image_filename}")
-                
-                if thumbnail_filename:
-                    old_thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-                    if os.path.exists(old_thumbnail_path):
-                        os.remove(old_thumbnail_path)
-                        app.logger.info(f"Deleted old thumbnail: {thumbnail_filename}")
-                
-                # Create unique filename with raffle ID
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                image_filename = f"raffle_{raffle_id}.{ext}"
-                thumbnail_filename = f"raffle_{raffle_id}_thumb.jpg"
-                
-                # Save new image
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(image_path)
-                app.logger.info(f"Image saved: {image_filename}")
-                
-                # Create thumbnail
-                thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-                if create_thumbnail(image_path, thumbnail_path):
-                    app.logger.info(f"Thumbnail created: {thumbnail_filename}")
-                else:
-                    thumbnail_filename = None
-        
-        # Parse banking details if provided
-        banking_details = None
-        if banking_details_json:
-            try:
-                banking_details = json.loads(banking_details_json)
-            except json.JSONDecodeError:
-                app.logger.warning("Failed to parse banking details JSON")
-        
-        # Update raffle data
-        updated_raffle = {
-            'id': raffle_id,
-            'name': name,
-            'organizerName': organizer_name,
-            'drawDate': draw_date,
-            'prize': prize,
-            'ticketCost': float(ticket_cost),
-            'paymentLink': payment_link,
-            'drawn': existing_raffle.get('drawn', False),  # Preserve drawn status
-            'winner': existing_raffle.get('winner')  # Preserve winner if exists
-        }
-        
-        if image_filename:
-            updated_raffle['image'] = image_filename
-            if thumbnail_filename:
-                updated_raffle['thumbnail'] = thumbnail_filename
-        
-        if banking_details:
-            updated_raffle['bankingDetails'] = banking_details
-        
-        # Replace the raffle in the list
-        data['raffles'][raffle_index] = updated_raffle
-        save_raffles(data)
+                    updated_raffle['image'] = image_filename
+                    if thumbnail_filename:
+                        updated_raffle['thumbnail'] = thumbnail_filename
+                if existing_raffle.get('thumbnailStatus'):
+                    updated_raffle['thumbnailStatus'] = existing_raffle['thumbnailStatus']
+                if upload_path:
+                    queue_thumbnail(updated_raffle, upload_path)
+                    upload_path = None  # the thumbnail queue owns it now
+        
+                if banking_details:
+                    updated_raffle['bankingDetails'] = banking_details
+        
+                # Replace the stored raffle
+                store.put_raffle(updated_raffle)
+        finally:
+            discard_upload(upload_path)
         
         app.logger.info(f"Raffle updated successfully: {updated_raffle}")
         return jsonify(updated_raffle), 200
@@ -464,11 +683,50 @@ def update_raffle(raffle_id):
         app.logger.error(f"Error updating raffle: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+MAX_BUYERS_PAGE = 500
+
+def parse_bool_arg(value):
+    """Parse a true/false query string value; raises ValueError otherwise"""
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError(value)
+
 @app.route('/api/buyers/<raffle_id>', methods=['GET'])
 def get_buyers(raffle_id):
+    """List buyers, optionally paged (limit, after), filtered (paid, q) and projected (fields)"""
     try:
-        buyers = load_buyers(raffle_id)
-        return jsonify(buyers)
+        # Validators are per URL, so one tag covers every page and filter
+        etag = store.buyers_etag(raffle_id)
+        cached = cached_response(etag)
+        if cached:
+            return cached
+
+        args = request.args
+        if not args:
+            return with_etag(jsonify(store.load_buyers(raffle_id)), etag)
+
+        try:
+            limit = int(args['limit']) if 'limit' in args else None
+            after = int(args['after']) if 'after' in args else None
+            paid = parse_bool_arg(args['paid']) if 'paid' in args else None
+        except ValueError:
+            return jsonify({"error": "limit and after must be integers, paid must be true or false"}), 400
+        if limit is not None and not 1 <= limit <= MAX_BUYERS_PAGE:
+            return jsonify({"error": f"limit must be between 1 and {MAX_BUYERS_PAGE}"}), 400
+        q = args.get('q', '').strip() or None
+
+        buyers, next_cursor = store.query_buyers(raffle_id, limit=limit, after=after, paid=paid, q=q)
+
+        if args.get('fields'):
+            # buyerNumber is always kept, it is the pagination cursor
+            fields = {'buyerNumber'} | {f.strip() for f in args['fields'].split(',') if f.strip()}
+            buyers = [{k: v for k, v in b.items() if k in fields} for b in buyers]
+
+        if limit is None and after is None:
+            return with_etag(jsonify(buyers), etag)
+        return with_etag(jsonify({"buyers": buyers, "nextCursor": next_cursor}), etag)
     except Exception as e:
         app.logger.error(f"Error getting buyers: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -480,36 +738,98 @@ def add_buyer(raffle_id):
             return jsonify({"error": "Content-Type must be application/json"}), 400
 
         data = request.json
-        all_buyers = json.load(open(BUYERS_FILE, 'r')) if os.path.exists(BUYERS_FILE) else {}
-        buyers = all_buyers.get(str(raffle_id), [])
-        
-        # Generate buyer number
-        buyer_number = len(buyers) + 1
-        data["buyerNumber"] = buyer_number
-        
-        # Generate unique ticket numbers
-        existing_tickets = []
-        for buyer in buyers:
-            existing_tickets.extend(buyer.get("ticket_numbers", []))
+        with store.transaction():
+            # Generate buyer number (never reuses the number of a deleted buyer)
+            data["buyerNumber"] = store.next_buyer_number(raffle_id)
         
-        new_tickets = []
-        tickets_needed = data["tickets"]
-        while len(new_tickets) < tickets_needed:
-            ticket_num = random.randint(100000, 999999)
-            if ticket_num not in existing_tickets and ticket_num not in new_tickets:
-                new_tickets.append(ticket_num)
-        
-        data["ticket_numbers"] = new_tickets
-        buyers.append(data)
-        
-        all_buyers[str(raffle_id)] = buyers
-        save_buyers(all_buyers)
+            # Generate unique ticket numbers
+            data["ticket_numbers"] = store.allocate_tickets(raffle_id, data["tickets"])
+            store.put_buyer(raffle_id, data)
         
         return jsonify({"message": "Buyer added successfully", "buyer": data})
+    except TicketSpaceExhausted as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Error adding buyer: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def validate_new_buyer(data):
+    """Error message for an invalid buyer payload, or None if it can be added"""
+    if not isinstance(data, dict):
+        return "Buyer must be an object"
+    for field in ('name', 'surname', 'email'):
+        if not data.get(field):
+            return f"Missing required field: {field}"
+    tickets = data.get('tickets')
+    if not isinstance(tickets, int) or isinstance(tickets, bool) or tickets < 1:
+        return "tickets must be a positive integer"
+    return None
+
+@app.route('/api/buyers/<raffle_id>/batch', methods=['POST'])
+def add_buyers_batch(raffle_id):
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Content-Type must be application/json"}), 400
+
+        payload = request.json
+        items = payload.get('buyers') if isinstance(payload, dict) else payload
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Expected a non-empty array of buyers"}), 400
+
+        results = [None] * len(items)
+        valid = []
+        for i, data in enumerate(items):
+            error = validate_new_buyer(data)
+            if error:
+                results[i] = {"index": i, "success": False, "error": error}
+            else:
+                valid.append(i)
+
+        added = []
+        with store.transaction():
+            # Draw every ticket number in one pass; if the raffle can't take
+            # them all, fall back to per-buyer allocation so the ones that fit
+            # still get in
+            try:
+                numbers = store.allocate_tickets(raffle_id, sum(items[i]['tickets'] for i in valid))
+                tickets_for = {}
+                for i in valid:
+                    count = items[i]['tickets']
+                    tickets_for[i], numbers = numbers[:count], numbers[count:]
+            except TicketSpaceExhausted:
+                tickets_for = {}
+                for i in valid:
+                    try:
+                        tickets_for[i] = store.allocate_tickets(raffle_id, items[i]['tickets'])
+                    except TicketSpaceExhausted as e:
+                        results[i] = {"index": i, "success": False, "error": str(e)}
+
+            accepted = [i for i in valid if i in tickets_for]
+            for i, buyer_number in zip(accepted, store.next_buyer_numbers(raffle_id, len(accepted))):
+                buyer = dict(items[i])
+                buyer["buyerNumber"] = buyer_number
+                buyer["ticket_numbers"] = tickets_for[i]
+                added.append(buyer)
+                results[i] = {"index": i, "success": True, "buyer": buyer}
+
+            if added:
+                store.put_buyers(raffle_id, added)
+
+        failed = len(items) - len(added)
+        app.logger.info(f"Batch added {len(added)} buyers to raffle {raffle_id} ({failed} failed)")
+        response = {
+            "message": f"Added {len(added)} of {len(items)} buyers",
+            "added": len(added),
+            "failed": failed,
+            "results": results
+        }
+        if not added:
+            return jsonify(response), 400
+        return jsonify(response), 207 if failed else 200
+    except Exception as e:
+        app.logger.error(f"Error adding buyers in batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/buyers/<raffle_id>/<int:buyer_number>', methods=['PUT'])
 def update_buyer(raffle_id, buyer_number):
     try:
@@ -517,116 +837,132 @@ def update_buyer(raffle_id, buyer_number):
             return jsonify({"error": "Content-Type must be application/json"}), 400
 
         data = request.json
-        all_buyers = load_buyers(raffle_id)
-        
-        if not all_buyers:
-            return jsonify({"error": "No buyers found for this raffle"}), 404
-        
-        # Find the buyer to update
-        buyer_index = None
-        for i, buyer in enumerate(all_buyers):
-            if buyer.get('buyerNumber') == buyer_number:
-                buyer_index = i
-                break
-        
-        if buyer_index is None:
-            return jsonify({"error": "Buyer not found"}), 404
-        
-        # Update buyer information (keep existing ticket numbers and buyer number)
-        updated_buyer = all_buyers[buyer_index]
-        updated_buyer['name'] = data.get('name', updated_buyer['name'])
-        updated_buyer['surname'] = data.get('surname', updated_buyer['surname'])
-        updated_buyer['email'] = data.get('email', updated_buyer['email'])
-        updated_buyer['mobile'] = data.get('mobile', updated_buyer.get('mobile', ''))
-        
-        # Update tickets count if changed
-        new_ticket_count = data.get('tickets', updated_buyer['tickets'])
-        if new_ticket_count != updated_buyer['tickets']:
-            # Get all existing ticket numbers from all buyers except current
-            existing_tickets = []
-            for i, buyer in enumerate(all_buyers):
-                if i != buyer_index:
-                    existing_tickets.extend(buyer.get("ticket_numbers", []))
-            
-            # Keep existing tickets or generate new ones if count increased
-            current_tickets = updated_buyer['ticket_numbers']
-            if new_ticket_count > len(current_tickets):
-                # Need more tickets
-                while len(current_tickets) < new_ticket_count:
-                    ticket_num = random.randint(100000, 999999)
-                    if ticket_num not in existing_tickets and ticket_num not in current_tickets:
-                        current_tickets.append(ticket_num)
-            elif new_ticket_count < len(current_tickets):
-                # Remove excess tickets
-                current_tickets = current_tickets[:new_ticket_count]
+        with store.transaction():
+            # Find the buyer to update
+            updated_buyer = store.get_buyer(raffle_id, buyer_number)
+        
+            if updated_buyer is None:
+                return jsonify({"error": "Buyer not found"}), 404
+        
+            # Update buyer information (keep existing ticket numbers and buyer number)
+            updated_buyer['name'] = data.get('name', updated_buyer['name'])
+            updated_buyer['surname'] = data.get('surname', updated_buyer['surname'])
+            updated_buyer['email'] = data.get('email', updated_buyer['email'])
+            updated_buyer['mobile'] = data.get('mobile', updated_buyer.get('mobile', ''))
+        
+            # Update tickets count if changed
+            new_ticket_count = data.get('tickets', updated_buyer['tickets'])
+            tickets_changed = new_ticket_count != updated_buyer['tickets']
+            if tickets_changed:
+                # Keep existing tickets or generate new ones if count increased
+                current_tickets = updated_buyer['ticket_numbers']
+                if new_ticket_count > len(current_tickets):
+                    # Need more tickets
+                    current_tickets = current_tickets + store.allocate_tickets(
+                        raffle_id, new_ticket_count - len(current_tickets)
+                    )
+                elif new_ticket_count < len(current_tickets):
+                    # Remove excess tickets
+                    current_tickets = current_tickets[:new_ticket_count]
             
-            updated_buyer['ticket_numbers'] = current_tickets
-            updated_buyer['tickets'] = new_ticket_count
+                updated_buyer['ticket_numbers'] = current_tickets
+                updated_buyer['tickets'] = new_ticket_count
         
-        # Save updated buyers
-        buyers_by_raffle = json.load(open(BUYERS_FILE, 'r')) if os.path.exists(BUYERS_FILE) else {}
-        buyers_by_raffle[str(raffle_id)] = all_buyers
-        save_buyers(buyers_by_raffle)
+            # Save updated buyer
+            store.put_buyer(raffle_id, updated_buyer)
         
+        if tickets_changed:
+            # A confirmation listing the old tickets must not stop one for the new ones
+            supersede_payment_confirmations(raffle_id, [buyer_number])
         return jsonify({"message": "Buyer updated successfully", "buyer": updated_buyer})
+    except TicketSpaceExhausted as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Error updating buyer: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def ordinal(n):
+    return f"{n}{'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')}"
+
+def winner_summary(winners, buyers_by_number):
+    """Display line for the drawn winners, in the format the PWA and emails have always used"""
+    def describe(record):
+        buyer = buyers_by_number.get(record['buyerNumber'], {})
+        return f"Ticket #{str(record['ticket']).zfill(6)} - {buyer.get('name', '')} {buyer.get('surname', '')}".rstrip()
+    if len(winners) == 1:
+        return f"Winner: {describe(winners[0])}"
+    return "Winners: " + "; ".join(f"{ordinal(w['prize'] + 1)} prize: {describe(w)}" for w in winners)
+
 @app.route('/api/draw/<raffle_id>', methods=['POST'])
 def draw_winner(raffle_id):
     try:
-        all_buyers = load_buyers(raffle_id)
-        if not all_buyers:
-            return jsonify({"error": "No tickets available for draw"}), 400
+        # No body draws a single winner
+        options = request.get_json(silent=True)
+        if options is None:
+            options = {}
+        if not isinstance(options, dict):
+            return jsonify({"error": "Draw options must be an object"}), 400
+        count = options.get('count', 1)
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            return jsonify({"error": "count must be a positive integer"}), 400
+        one_win_per_buyer = options.get('oneWinPerBuyer', False)
+        if not isinstance(one_win_per_buyer, bool):
+            return jsonify({"error": "oneWinPerBuyer must be true or false"}), 400
 
-        # Filter to only include buyers who have paid
-        paid_buyers = [buyer for buyer in all_buyers if buyer.get('paymentReceived') == True]
-        
-        if not paid_buyers:
-            return jsonify({"error": "No paid tickets available for draw"}), 400
+        with store.transaction():
+            all_buyers = store.load_buyers(raffle_id)
+            if not all_buyers:
+                return jsonify({"error": "No tickets available for draw"}), 400
 
-        # Only add tickets from paid buyers
-        tickets = []
-        for buyer in paid_buyers:
-            for ticket in buyer["ticket_numbers"]:
-                tickets.append({
-                    "number": ticket,
-                    "name": f"{buyer['name']} {buyer['surname']}"
-                })
+            # Filter to only include buyers who have paid
+            paid_buyers = [buyer for buyer in all_buyers if buyer.get('paymentReceived') == True]
+        
+            if not paid_buyers or not any(buyer.get('ticket_numbers') for buyer in paid_buyers):
+                return jsonify({"error": "No paid tickets available for draw"}), 400
 
-        if not tickets:
-            return jsonify({"error": "No paid tickets available for draw"}), 400
+            # Weighted by ticket count with cryptographic randomness; see draw.py
+            try:
+                drawn = draw_winners(paid_buyers, count, one_win_per_buyer)
+            except DrawError as e:
+                return jsonify({"error": str(e)}), 400
 
-        # Improved randomization: shuffle tickets thoroughly and use secure random selection
-        # This ensures fair distribution across all buyers, not biased towards the first buyer
-        random.shuffle(tickets)  # Shuffle the entire list
-        winner_index = secrets.randbelow(len(tickets))  # Use cryptographic randomness
-        winner = tickets[winner_index]
-        
-        winner_text = f"Winner: Ticket #{str(winner['number']).zfill(6)} - {winner['name']}"
+            winners = [
+                {"prize": prize, "ticket": ticket, "buyerNumber": buyer['buyerNumber']}
+                for prize, (buyer, ticket) in enumerate(drawn)
+            ]
+            buyers_by_number = {buyer['buyerNumber']: buyer for buyer, _ in drawn}
+            winner_text = winner_summary(winners, buyers_by_number)
 
-        # Save the winner in the raffle data
-        raffles_data = load_raffles()
-        for raffle in raffles_data['raffles']:
-            if raffle['id'] == raffle_id:
+            # Save the winners in the raffle data; winner is the display line kept for older clients
+            raffle = store.get_raffle(raffle_id)
+            if raffle:
+                raffle['winners'] = winners
                 raffle['winner'] = winner_text
                 raffle['drawn'] = True
-                break
-        save_raffles(raffles_data)
+                store.put_raffle(raffle)
+
+        # Announcements of an earlier draw are stale: cancel unsent ones, allow the new one
+        outbox.get_outbox().supersede(raffle_id, 'winner')
 
-        return jsonify({"winner": winner_text})
+        app.logger.info(f"Drew {len(winners)} winner(s) for raffle {raffle_id}")
+        return jsonify({
+            "winner": winner_text,
+            "winners": [
+                dict(w, name=buyers_by_number[w['buyerNumber']]['name'],
+                     surname=buyers_by_number[w['buyerNumber']]['surname'])
+                for w in winners
+            ]
+        })
     except Exception as e:
         app.logger.error(f"Error drawing winner: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/notify-all/<raffle_id>', methods=['POST'])
 def notify_all_buyers(raffle_id):
-    """Send winner notification email to all ticket buyers"""
+    """Queue the winner notification email to all ticket buyers; progress is at /api/jobs/<job id>"""
     try:
         # Get raffle details
-        raffles_data = load_raffles()
-        raffle = next((r for r in raffles_data['raffles'] if r['id'] == raffle_id), None)
+        raffle = store.get_raffle(raffle_id)
         
         if not raffle:
             return jsonify({"error": "Raffle not found"}), 404
@@ -635,80 +971,64 @@ def notify_all_buyers(raffle_id):
             return jsonify({"error": "No winner has been drawn yet"}), 400
         
         # Get all buyers for this raffle
-        all_buyers = load_buyers(raffle_id)
+        all_buyers = store.load_buyers(raffle_id)
         
         if not all_buyers:
             return jsonify({"error": "No buyers registered for this raffle"}), 400
         
-        # Send notification to all buyers
-        successful_emails = 0
-        failed_emails = []
-        
-        for buyer in all_buyers:
-            if buyer.get('email'):
-                try:
-                    buyer_name = f"{buyer['name']} {buyer['surname']}"
-                    success = send_winner_notification_email(
-                        buyer['email'],
-                        buyer_name,
-                        raffle['name'],
-                        raffle['winner']
-                    )
-                    
-                    if success:
-                        successful_emails += 1
-                    else:
-                        failed_emails.append(buyer['email'])
-                        
-                except Exception as e:
-                    app.logger.error(f"Error sending email to {buyer['email']}: {str(e)}")
-                    failed_emails.append(buyer['email'])
-        
-        # Prepare response message
-        if successful_emails > 0 and len(failed_emails) == 0:
-            message = f"✓ Successfully sent notifications to {successful_emails} buyer(s)!"
-            return jsonify({
-                "message": message,
-                "successful": successful_emails,
-                "failed": 0
-            }), 200
-        elif successful_emails > 0:
-            message = f"Sent to {successful_emails} buyer(s). Failed to send to {len(failed_emails)} buyer(s)."
-            return jsonify({
-                "message": message,
-                "successful": successful_emails,
-                "failed": len(failed_emails),
-                "failed_emails": failed_emails
-            }), 207  # 207 Multi-Status for partial success
+        settings = mailer.get_pool().settings
+        if not settings.configured:
+            app.logger.warning("Email not configured - skipping notification")
+            return jsonify({"error": "Email is not configured on the server"}), 500
+        
+        # Render the announcement once and queue it per buyer; the outbox sender delivers it
+        template = mailer.winner_notification(settings, raffle['name'], raffle['winner'])
+        recipients = [
+            (buyer['buyerNumber'], buyer['email'], {"buyer_name": f"{buyer['name']} {buyer['surname']}"})
+            for buyer in all_buyers if buyer.get('email')
+        ]
+        if not recipients:
+            return jsonify({"error": "No buyer email addresses found for this raffle"}), 400
+        
+        job_id, queued, skipped = outbox.get_outbox().enqueue(raffle_id, 'winner', template, recipients)
+        outbox.start_sender().wake()
+        app.logger.info(f"Queued {queued} winner notifications for raffle {raffle_id} ({skipped} already queued)")
+        
+        if queued:
+            message = f"Queued notifications to {queued} buyer(s)"
         else:
-            return jsonify({
-                "error": "Failed to send notifications to all buyers. Email may not be configured.",
-                "successful": 0,
-                "failed": len(all_buyers)
-            }), 500
+            message = "All buyers have already been notified or are queued"
+        return jsonify({
+            "message": message,
+            "jobId": job_id,
+            "queued": queued,
+            "skipped": skipped
+        }), 202 if queued else 200
             
     except Exception as e:
         app.logger.error(f"Error notifying all buyers: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Progress of a queued mailing: sent, failed and pending message counts"""
+    try:
+        job = outbox.get_outbox().job(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job)
+    except Exception as e:
+        app.logger.error(f"Error getting job {job_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/raffles/<raffle_id>', methods=['DELETE'])
 def delete_raffle(raffle_id):
     try:
-        # Load raffles
-        raffles_data = load_raffles()
-        
-        # Find and remove the raffle
-        raffles_data['raffles'] = [r for r in raffles_data['raffles'] if r['id'] != raffle_id]
-        save_raffles(raffles_data)
-        
-        # Remove associated buyers
-        if os.path.exists(BUYERS_FILE):
-            with open(BUYERS_FILE, 'r') as f:
-                buyers_data = json.load(f)
-            
-            if str(raffle_id) in buyers_data:
-                del buyers_data[str(raffle_id)]
-                save_buyers(buyers_data)
+        # Remove the raffle and its associated buyers
+        store.delete_raffle(raffle_id)
+        thumbnail_queue.cancel(raffle_id)
+        outbox.get_outbox().supersede(raffle_id)
+        collect_blobs()
         
         return jsonify({"message": "Raffle deleted successfully"}), 200
     except Exception as e:
@@ -728,48 +1048,45 @@ def import_raffle():
         if not raffle_data or not buyers_data:
             return jsonify({"error": "Both raffle and buyers data are required"}), 400
         
-        # Load existing raffles
-        raffles_data = load_raffles()
+        with store.transaction():
+            # Load existing raffles
+            raffles_data = store.load_raffles()
         
-        # Get the next available raffle ID
-        existing_ids = [int(r['id']) for r in raffles_data['raffles'] if r['id'].isdigit()]
-        next_id = str(max(existing_ids) + 1) if existing_ids else "1"
+            # Get the next available raffle ID
+            existing_ids = [int(r['id']) for r in raffles_data['raffles'] if r['id'].isdigit()]
+            next_id = str(max(existing_ids) + 1) if existing_ids else "1"
         
-        # Extract the raffle from the imported data (assuming single raffle in array)
-        if isinstance(raffle_data, dict) and 'raffles' in raffle_data:
-            imported_raffle = raffle_data['raffles'][0] if raffle_data['raffles'] else None
-        else:
-            imported_raffle = raffle_data
-        
-        if not imported_raffle:
-            return jsonify({"error": "No raffle found in imported data"}), 400
+            # Extract the raffle from the imported data (assuming single raffle in array)
+            if isinstance(raffle_data, dict) and 'raffles' in raffle_data:
+                imported_raffle = raffle_data['raffles'][0] if raffle_data['raffles'] else None
+            else:
+                imported_raffle = raffle_data
         
-        # Assign new ID to imported raffle
-        old_id = imported_raffle.get('id')
-        imported_raffle['id'] = next_id
+            if not imported_raffle:
+                return jsonify({"error": "No raffle found in imported data"}), 400
         
-        # Reset draw status for imported raffle
-        imported_raffle['drawn'] = False
-        imported_raffle['winner'] = None
+            # Assign new ID to imported raffle
+            old_id = imported_raffle.get('id')
+            imported_raffle['id'] = next_id
         
-        # Add imported raffle to existing raffles
-        raffles_data['raffles'].append(imported_raffle)
-        save_raffles(raffles_data)
+            # Reset draw status for imported raffle
+            imported_raffle['drawn'] = False
+            imported_raffle['winner'] = None
+            imported_raffle['winners'] = []
         
-        # Load existing buyers
-        all_buyers = json.load(open(BUYERS_FILE, 'r')) if os.path.exists(BUYERS_FILE) else {}
+            # Add imported raffle to existing raffles
+            store.put_raffle(imported_raffle)
         
-        # Extract buyers for the old raffle ID
-        if isinstance(buyers_data, dict):
-            # Find the buyers for the old raffle ID
-            imported_buyers = buyers_data.get(str(old_id), [])
-        else:
-            imported_buyers = buyers_data
+            # Extract buyers for the old raffle ID
+            if isinstance(buyers_data, dict):
+                # Find the buyers for the old raffle ID
+                imported_buyers = buyers_data.get(str(old_id), [])
+            else:
+                imported_buyers = buyers_data
         
-        # Add imported buyers under new raffle ID
-        if imported_buyers:
-            all_buyers[next_id] = imported_buyers
-            save_buyers(all_buyers)
+            # Add imported buyers under new raffle ID
+            if imported_buyers:
+                store.replace_buyers(next_id, imported_buyers)
         
         return jsonify({
             "message": "Raffle imported successfully",
@@ -784,29 +1101,10 @@ def import_raffle():
 @app.route('/api/buyers/<raffle_id>/<buyer_number>', methods=['DELETE'])
 def delete_buyer(raffle_id, buyer_number):
     try:
-        # Load all buyers data
-        if not os.path.exists(BUYERS_FILE):
-            return jsonify({"error": "No buyers found"}), 404
-            
-        with open(BUYERS_FILE, 'r') as f:
-            buyers_data = json.load(f)
-        
-        # Get buyers for this raffle
-        raffle_buyers = buyers_data.get(str(raffle_id), [])
-        
         # Find and remove buyer with matching number
         buyer_number = int(buyer_number)  # Convert to integer for comparison
-        updated_buyers = [b for b in raffle_buyers if b.get('buyerNumber') != buyer_number]
-        
-        if len(updated_buyers) == len(raffle_buyers):
+        if not store.delete_buyer(raffle_id, buyer_number):
             return jsonify({"error": f"Buyer #{buyer_number} not found"}), 404
-            
-        # Update the buyers data
-        buyers_data[str(raffle_id)] = updated_buyers
-        
-        # Save updated data
-        with open(BUYERS_FILE, 'w') as f:
-            json.dump(buyers_data, f, indent=2)
         
         return jsonify({"message": f"Buyer #{buyer_number} deleted successfully"}), 200
         
@@ -817,14 +1115,17 @@ def delete_buyer(raffle_id, buyer_number):
 @app.route('/api/buyers/<raffle_id>/<buyer_number>', methods=['GET'])
 def get_buyer(raffle_id, buyer_number):
     try:
-        buyers = load_buyers(raffle_id)
         buyer_number = int(buyer_number)  # Convert to integer for comparison
-        buyer = next((b for b in buyers if b.get('buyerNumber') == buyer_number), None)
+        etag = store.buyers_etag(raffle_id, buyer_number)
+        cached = cached_response(etag)
+        if cached:
+            return cached
+        buyer = store.get_buyer(raffle_id, buyer_number)
         
         if not buyer:
             return jsonify({"error": f"Buyer #{buyer_number} not found"}), 404
             
-        return jsonify(buyer)
+        return with_etag(jsonify(buyer), etag)
     except Exception as e:
         app.logger.error(f"Error getting buyer: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -855,38 +1156,92 @@ def open_chrome():
 def get_winner_details(raffle_id):
     try:
         # Load raffle data to get winning ticket
-        raffles_data = load_raffles()
-        raffle = next((r for r in raffles_data['raffles'] if r['id'] == raffle_id), None)
+        raffle = store.get_raffle(raffle_id)
         
-        if not raffle or not raffle.get('winner'):
+        if not raffle or not (raffle.get('winners') or raffle.get('winner')):
             return jsonify({"error": "No winner found for this raffle"}), 404
             
-        # Extract ticket number from winner string
-        ticket_number = int(raffle['winner'].split('#')[1].split(' ')[0])
-        
-        # Load buyers to find winner details
-        buyers = load_buyers(raffle_id)
-        winner = next(
-            (buyer for buyer in buyers 
-             if ticket_number in buyer['ticket_numbers']),
-            None
-        )
+        records = raffle.get('winners')
+        if not records:
+            # Raffles drawn before structured winners: extract ticket number from winner string
+            records = [{"prize": 0, "ticket": int(raffle['winner'].split('#')[1].split(' ')[0])}]
+        
+        winners = []
+        for record in records:
+            # Look up the ticket holder in the ticket index
+            winner = store.find_ticket(raffle_id, record['ticket'])
+            if winner:
+                winners.append({
+                    "prize": record['prize'],
+                    "buyerNumber": winner['buyerNumber'],
+                    "name": winner['name'],
+                    "surname": winner['surname'],
+                    "email": winner['email'],
+                    "mobile": winner.get('mobile'),
+                    "ticket": record['ticket']
+                })
         
-        if not winner:
+        if not winners:
             return jsonify({"error": "Winner details not found"}), 404
             
+        # First prize at the top level, as before; every prize under "winners"
+        return jsonify(dict(winners[0], winners=winners))
+        
+    except Exception as e:
+        app.logger.error(f"Error getting winner details: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/tickets/<raffle_id>/<int:ticket_number>', methods=['GET'])
+def get_ticket_holder(raffle_id, ticket_number):
+    """Look up who holds a ticket number in a raffle"""
+    try:
+        buyer = store.find_ticket(raffle_id, ticket_number)
+        
+        if not buyer:
+            return jsonify({"error": f"Ticket #{str(ticket_number).zfill(6)} not found"}), 404
+            
         return jsonify({
-            "name": winner['name'],
-            "surname": winner['surname'],
-            "email": winner['email'],
-            "mobile": winner.get('mobile'),
-            "ticket": ticket_number
+            "raffleId": raffle_id,
+            "ticket": ticket_number,
+            "buyerNumber": buyer['buyerNumber'],
+            "name": buyer['name'],
+            "surname": buyer['surname'],
+            "email": buyer.get('email'),
+            "mobile": buyer.get('mobile'),
+            "paymentReceived": buyer.get('paymentReceived', False)
         })
         
     except Exception as e:
-        app.logger.error(f"Error getting winner details: {str(e)}")
+        app.logger.error(f"Error looking up ticket: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def queue_payment_confirmations(raffle, buyers):
+    """Queue payment confirmation emails to buyers; (job_id, queued), or None if email isn't configured"""
+    settings = mailer.get_pool().settings
+    if not settings.configured:
+        return None
+    if raffle.get('thumbnail'):
+        image_url = f"{request.host_url}uploads/thumbnails/{raffle['thumbnail']}"
+    elif raffle.get('image'):
+        image_url = f"{request.host_url}uploads/{raffle['image']}"
+    else:
+        image_url = ''
+    template = mailer.payment_confirmation(settings, raffle, image_url)
+    recipients = [
+        (buyer['buyerNumber'], buyer['email'], mailer.payment_fields(buyer, raffle))
+        for buyer in buyers if buyer.get('email')
+    ]
+    if not recipients:
+        return None
+    job_id, queued, _ = outbox.get_outbox().enqueue(raffle['id'], 'payment', template, recipients)
+    outbox.start_sender().wake()
+    app.logger.info(f"Queued {queued} payment confirmations for raffle {raffle['id']}")
+    return job_id, queued
+
+def supersede_payment_confirmations(raffle_id, buyer_numbers):
+    """Forget the buyers' payment confirmations (unpaid again, or tickets changed) so a new one can be queued"""
+    outbox.get_outbox().supersede(raffle_id, 'payment', buyer_numbers)
+
 @app.route('/api/buyers/<raffle_id>/<buyer_number>/payment', methods=['POST'])
 def update_payment_status(raffle_id, buyer_number):
     try:
@@ -894,26 +1249,13 @@ def update_payment_status(raffle_id, buyer_number):
         if 'paymentReceived' not in data:
             return jsonify({"error": "Payment status required"}), 400
 
-        with open(BUYERS_FILE, 'r') as f:
-            buyers_data = json.load(f)
-
-        raffle_buyers = buyers_data.get(str(raffle_id), [])
         buyer_number = int(buyer_number)
-        
-        buyer_found = None
-        for buyer in raffle_buyers:
-            if buyer.get('buyerNumber') == buyer_number:
-                buyer['paymentReceived'] = data['paymentReceived']
-                buyer_found = buyer
-                break
+        buyer_found = store.set_payment(raffle_id, buyer_number, data['paymentReceived'])
 
         if not buyer_found:
             return jsonify({"error": "Buyer not found"}), 404
-
-        buyers_data[str(raffle_id)] = raffle_buyers
-        
-        with open(BUYERS_FILE, 'w') as f:
-            json.dump(buyers_data, f, indent=2)
+        if not data['paymentReceived']:
+            supersede_payment_confirmations(raffle_id, [buyer_number])
         
         # If marking as paid, return buyer and raffle data for email generation
         response_data = {
@@ -922,12 +1264,15 @@ def update_payment_status(raffle_id, buyer_number):
         
         if data['paymentReceived'] and data.get('sendEmail', False):
             # Get raffle details for email
-            raffles_data = load_raffles()
-            raffle = next((r for r in raffles_data['raffles'] if r['id'] == raffle_id), None)
+            raffle = store.get_raffle(raffle_id)
             
             if raffle:
                 response_data['buyer'] = buyer_found
                 response_data['raffle'] = raffle
+                # With email configured the server sends the confirmation; otherwise the client composes it
+                job = queue_payment_confirmations(raffle, [buyer_found])
+                if job:
+                    response_data['emailJobId'], response_data['emailQueued'] = job[0], bool(job[1])
         
         return jsonify(response_data), 200
         
@@ -935,18 +1280,69 @@ def update_payment_status(raffle_id, buyer_number):
         app.logger.error(f"Error updating payment status: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/buyers/<raffle_id>/payments', methods=['POST'])
+def update_payment_statuses(raffle_id):
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Content-Type must be application/json"}), 400
+
+        payload = request.json
+        items = payload.get('payments') if isinstance(payload, dict) else payload
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Expected a non-empty array of payments"}), 400
+
+        payments = {}
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or 'buyerNumber' not in item or 'paymentReceived' not in item:
+                return jsonify({"error": f"Payment {i} needs buyerNumber and paymentReceived"}), 400
+            try:
+                buyer_number = int(item['buyerNumber'])
+            except (TypeError, ValueError):
+                return jsonify({"error": f"Payment {i} has an invalid buyerNumber"}), 400
+            if not isinstance(item['paymentReceived'], bool):
+                return jsonify({"error": f"Payment {i} paymentReceived must be true or false"}), 400
+            # A later entry for the same buyer wins
+            payments[buyer_number] = item['paymentReceived']
+
+        with store.transaction():
+            updated = store.set_payments(raffle_id, payments)
+            totals = store.payment_totals(raffle_id)
+
+        updated_numbers = {b['buyerNumber'] for b in updated}
+        not_found = [n for n in payments if n not in updated_numbers]
+        unpaid = [b['buyerNumber'] for b in updated if not b.get('paymentReceived')]
+        if unpaid:
+            supersede_payment_confirmations(raffle_id, unpaid)
+        app.logger.info(f"Updated payment status of {len(updated)} buyers in raffle {raffle_id}")
+        response_data = {
+            "message": f"Updated payment status for {len(updated)} buyers",
+            "updated": len(updated),
+            "notFound": not_found,
+            "totals": totals
+        }
+
+        # Optionally confirm by email to the buyers now marked as paid
+        if isinstance(payload, dict) and payload.get('sendEmail'):
+            raffle = store.get_raffle(raffle_id)
+            paid = [b for b in updated if b.get('paymentReceived')]
+            job = queue_payment_confirmations(raffle, paid) if raffle and paid else None
+            if job:
+                response_data['emailJobId'], response_data['emailsQueued'] = job
+        return jsonify(response_data), 200
+    except Exception as e:
+        app.logger.error(f"Error updating payment statuses: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/payment-qr/<raffle_id>/<buyer_number>', methods=['GET'])
 def generate_payment_qr(raffle_id, buyer_number):
     try:
         # Get buyer and raffle details
-        buyers = load_buyers(raffle_id)
-        buyer = next((b for b in buyers if b.get('buyerNumber') == int(buyer_number)), None)
+        buyer = store.get_buyer(raffle_id, int(buyer_number))
         
         if not buyer:
             return jsonify({"error": "Buyer not found"}), 404
             
-        raffles_data = load_raffles()
-        raffle = next((r for r in raffles_data['raffles'] if r['id'] == raffle_id), None)
+        raffle = store.get_raffle(raffle_id)
         
         if not raffle:
             return jsonify({"error": "Raffle not found"}), 404
@@ -965,21 +1361,12 @@ def generate_payment_qr(raffle_id, buyer_number):
             f"Link: {payment_url}"
         )
         
-        # Generate QR code with payment link
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(payment_url)
-        qr.make(fit=True)
-        
-        # Create image
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
+        # The QR code only holds the payment link, the same for every buyer:
+        # link to the cached image rather than rendering it here
+        version = qrcodes.payload_version(payment_url)
         return jsonify({
-            "qr_code": img_str,
+            "qr_url": f"/api/raffles/{raffle_id}/payment-qr.png?v={version}",
+            "qr_svg_url": f"/api/raffles/{raffle_id}/payment-qr.svg?v={version}",
             "payment_info": payment_info,
             "payment_url": payment_url
         })
@@ -988,6 +1375,49 @@ def generate_payment_qr(raffle_id, buyer_number):
         app.logger.error(f"Error generating QR code: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/raffles/<raffle_id>/payment-qr.<fmt>', methods=['GET'])
+def payment_qr_image(raffle_id, fmt):
+    """The raffle's payment link as a QR code image (png or svg); ?box= sets the module size in pixels"""
+    if fmt not in qrcodes.FORMATS:
+        return jsonify({"error": f"Unsupported format: {fmt} (use png or svg)"}), 404
+    try:
+        box_size = int(request.args.get('box', qrcodes.BOX_SIZE))
+        if not 1 <= box_size <= qrcodes.MAX_BOX_SIZE:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"box must be between 1 and {qrcodes.MAX_BOX_SIZE}"}), 400
+    try:
+        raffle = store.get_raffle(raffle_id)
+        if not raffle:
+            return jsonify({"error": "Raffle not found"}), 404
+        payment_url = raffle.get('paymentLink', '')
+
+        response = app.response_class(mimetype=qrcodes.FORMATS[fmt])
+        response.set_etag(qrcodes.qr_etag(payment_url, fmt, box_size))
+        # A URL with the current link's version always means this image; others must revalidate
+        if request.args.get('v') == qrcodes.payload_version(payment_url):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        if request.if_none_match.contains_weak(response.get_etag()[0]):
+            return response.make_conditional(request)
+        response.set_data(payment_qr_cache.get(payment_url, fmt, box_size))
+        return response.make_conditional(request)
+    except Exception as e:
+        app.logger.error(f"Error generating QR code: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/storage/stats', methods=['GET'])
+def get_storage_stats():
+    """Report the storage backend in use, its cache/row counters, the response compression cache, thumbnail jobs, blobs, image variants and QR codes"""
+    stats = store.stats()
+    stats["compression"] = compressed_responses.stats()
+    stats["thumbnails"] = thumbnail_queue.stats()
+    stats["blobs"] = blobs.stats()
+    stats["variants"] = image_variants.stats()
+    stats["qrCodes"] = payment_qr_cache.stats()
+    return jsonify(stats)
+
 # Add these routes to serve PWA files
 @app.route('/manifest.json')
 def serve_manifest():
@@ -995,25 +1425,19 @@ def serve_manifest():
 
 @app.route('/sw.js')
 def serve_sw():
-    response = send_from_directory('.', 'sw.js')
+    page = assets.page('sw.js')
+    response = send_from_directory('.', 'sw.js') if page is None else asset_response(page, 'no-cache')
     response.headers['Service-Worker-Allowed'] = '/'
     return response
 
+# Unhashed URLs, for pages loaded before the asset pipeline; revalidated by ETag
 @app.route('/style.css')
 def serve_css():
-    response = send_from_directory('.', 'style.css')
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    return send_from_directory('.', 'style.css')
 
 @app.route('/script.js')
 def serve_js():
-    response = send_from_directory('.', 'script.js')
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    return send_from_directory('.', 'script.js')
 
 @app.route('/icons/<path:filename>')
 def serve_icon(filename):
@@ -0,0 +1,177 @@
+"""
+Fingerprinted, precompressed static assets for the PWA.
+
+AssetManifest reads the stylesheet and scripts the app serves, names each
+copy after a hash of its content (style.css -> /assets/style.1a2b3c4d5e6f.css)
+and keeps gzip and, when the optional brotli package is installed, brotli
+encodings of it. index.html and sw.js are rewritten to reference the hashed
+URLs, and the service worker's cache name is derived from the same hashes,
+so a deploy with changed assets invalidates old caches without a hand-edited
+version bump. Because a hashed URL never changes content it can be cached
+for a year as immutable.
+
+The source files are left untouched (the GitHub Pages deploy publishes them
+as they are). The manifest rebuilds itself when a source file changes on
+disk, and hashed URLs of earlier builds keep working.
+
+Run `python assets.py` to build and list the assets with their sizes.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+
+from compression import available_encodings, brotli, compress as compress_with, negotiate
+
+logger = logging.getLogger(__name__)
+
+# Files served under /assets/ by content hash
+FINGERPRINTED = ('style.css', 'script.js', 'config.js')
+# Entry points that stay at fixed URLs but are rewritten to the hashed names
+PAGES = ('index.html', 'sw.js')
+
+ASSET_PREFIX = '/assets/'
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+HASH_LENGTH = 12
+
+MIMETYPES = {
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+}
+
+# References as written in index.html and sw.js, with or without a ?v= cache buster
+REFERENCE_RE = re.compile(r'''(["'])/(%s)(?:\?v=[^"']*)?\1''' % '|'.join(re.escape(n) for n in FINGERPRINTED))
+CACHE_NAME_RE = re.compile(r'''(const CACHE_NAME = )(["']).*?\2;''')
+
+
+def compress(data):
+    """Every encoding of data worth serving, keyed by Content-Encoding token"""
+    encodings = {'identity': data}
+    for encoding in available_encodings():
+        if encoding == 'identity':
+            continue
+        compressed = compress_with(data, encoding, GZIP_LEVEL if encoding == 'gzip' else BROTLI_QUALITY)
+        if len(compressed) < len(data):
+            encodings[encoding] = compressed
+    return encodings
+
+
+class Asset:
+    """One static file with its precomputed encodings"""
+
+    def __init__(self, name, url, data):
+        self.name = name
+        self.url = url
+        self.mimetype = MIMETYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.encodings = compress(data)
+
+    def etag(self, encoding):
+        # Each representation needs its own strong validator
+        return f"{self.digest[:HASH_LENGTH * 2]}-{encoding}"
+
+    def select(self, accept_encoding):
+        """(encoding, body) to send for the request's Accept-Encoding"""
+        encoding = negotiate(accept_encoding, self.encodings)
+        return encoding, self.encodings[encoding]
+
+
+class AssetManifest:
+    """Hashed assets and rewritten pages built from the files in root"""
+
+    def __init__(self, root='.'):
+        self.root = root
+        self._lock = threading.Lock()
+        self._signature = None
+        self.assets = {}   # hashed file name -> Asset, including earlier builds
+        self.urls = {}     # source name -> hashed URL of the current build
+        self.pages = {}    # page name -> Asset
+        self.builds = 0
+        self.refresh()
+
+    def _source_signature(self):
+        signature = []
+        for name in FINGERPRINTED + PAGES:
+            try:
+                st = os.stat(os.path.join(self.root, name))
+                signature.append((name, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append((name, None, None))
+        return tuple(signature)
+
+    def _read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return f.read()
+
+    def refresh(self):
+        """Rebuild if any source file changed since the last build"""
+        signature = self._source_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            self._build()
+            self._signature = signature
+
+    def _build(self):
+        urls = {}
+        digests = []
+        for name in FINGERPRINTED:
+            try:
+                data = self._read(name)
+            except FileNotFoundError:
+                logger.warning(f"Static asset {name} not found, serving it unhashed")
+                continue
+            stem, ext = os.path.splitext(name)
+            digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+            hashed = f"{stem}.{digest}{ext}"
+            if hashed not in self.assets:
+                self.assets[hashed] = Asset(name, ASSET_PREFIX + hashed, data)
+            urls[name] = ASSET_PREFIX + hashed
+            digests.append(digest)
+
+        def rewrite(match):
+            quote, name = match.group(1), match.group(2)
+            return f"{quote}{urls.get(name, '/' + name)}{quote}"
+
+        cache_name = 'raffle-cache-' + hashlib.sha256(''.join(digests).encode()).hexdigest()[:HASH_LENGTH]
+        pages = {}
+        for name in PAGES:
+            try:
+                text = self._read(name).decode('utf-8')
+            except FileNotFoundError:
+                continue
+            text = REFERENCE_RE.sub(rewrite, text)
+            if name == 'sw.js':
+                text = CACHE_NAME_RE.sub(lambda m: f"{m.group(1)}{m.group(2)}{cache_name}{m.group(2)};", text)
+            pages[name] = Asset(name, '/' + name, text.encode('utf-8'))
+
+        self.urls = urls
+        self.pages = pages
+        self.builds += 1
+        logger.info(f"Built static assets: {', '.join(urls.values())}")
+
+    def asset(self, hashed_name):
+        """Asset for a /assets/ file name, or None"""
+        self.refresh()
+        return self.assets.get(hashed_name)
+
+    def page(self, name):
+        """Rewritten index.html / sw.js, or None if the source file is missing"""
+        self.refresh()
+        return self.pages.get(name)
+
+
+if __name__ == "__main__":
+    manifest = AssetManifest(os.path.dirname(os.path.abspath(__file__)))
+    print("=" * 50)
+    print("Static assets" + ("" if brotli else " (brotli not installed, gzip only)"))
+    print("=" * 50)
+    for asset in list(manifest.assets.values()) + list(manifest.pages.values()):
+        sizes = ', '.join(f"{enc} {len(body):,}" for enc, body in asset.encodings.items())
+        print(f"{asset.url}\n    {sizes}")
@@ -0,0 +1,178 @@
+"""
+Content-addressed storage for uploaded images.
+
+Every upload and thumbnail is stored once under a name derived from a hash
+of its bytes (uploads/blobs/1a/1a2b...ef.jpg), and raffle records reference
+it by that name. Identical images shared by several raffles are stored
+once, and since a name always means the same bytes, blobs can be served
+with year-long immutable caching and the hash as a strong ETag. Replacing a
+raffle's image stores a new blob; blobs no raffle refers to any more are
+removed by gc().
+
+Freshly written blobs are protected from gc() for a grace period (and a
+deduplicated write refreshes that), so an upload whose raffle record is
+not saved yet is never collected.
+
+Run `python blobs.py migrate` to move images stored under the old
+raffle_<id>.<ext> names into the blob store, `python blobs.py gc` to
+collect unreferenced blobs.
+"""
+
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import time
+
+HASH_LENGTH = 32
+BLOB_NAME_RE = re.compile(r'^[0-9a-f]{%d}\.[a-z0-9]{1,5}$' % HASH_LENGTH)
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_blob(name):
+    """Whether name is a blob name (as opposed to a legacy upload file name)"""
+    return bool(name) and BLOB_NAME_RE.match(name) is not None
+
+
+class BlobStore:
+    """Files named by a hash of their content, under root/<first two hex digits>/"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        if not is_blob(name):
+            raise ValueError(f"Not a blob name: {name}")
+        return os.path.join(self.root, name[:2], name)
+
+    def exists(self, name):
+        return is_blob(name) and os.path.exists(self.path(name))
+
+    def put_stream(self, stream, ext):
+        """Store the contents of a binary file object; returns the blob name"""
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            return self._commit(temp_path, digest, ext)
+        except BaseException:
+            self._discard(temp_path)
+            raise
+
+    def put_file(self, path, ext):
+        """Move the file at path (on the same filesystem) into the store; returns the blob name"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return self._commit(path, digest, ext)
+
+    def _commit(self, temp_path, digest, ext):
+        name = f"{digest.hexdigest()[:HASH_LENGTH]}.{ext.lower()}"
+        path = self.path(name)
+        if os.path.exists(path):
+            # Same bytes already stored; refresh the gc grace period for the new reference
+            self._discard(temp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return name
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        """(path, name or None for leftovers of interrupted writes, stat) of every file in the store"""
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, (file_name if is_blob(file_name) else None), st
+
+    def gc(self, referenced, grace=3600):
+        """Remove blobs not in referenced that are older than grace seconds"""
+        cutoff = time.time() - grace
+        kept = removed = freed = 0
+        for path, name, st in self._entries():
+            if (name is None or name not in referenced) and st.st_mtime < cutoff:
+                self._discard(path)
+                removed += 1
+                freed += st.st_size
+            else:
+                kept += 1
+        return {"kept": kept, "removed": removed, "bytesFreed": freed}
+
+    def stats(self):
+        count = size = 0
+        for _, name, st in self._entries():
+            if name is not None:
+                count += 1
+                size += st.st_size
+        return {"blobs": count, "bytes": size}
+
+
+def referenced_blobs(raffles):
+    """Blob names used by raffle records"""
+    return {raffle.get(key) for raffle in raffles for key in ('image', 'thumbnail') if is_blob(raffle.get(key))}
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from storage import open_backend
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command not in ('migrate', 'gc'):
+        print("Usage: python blobs.py [migrate|gc]")
+        sys.exit(1)
+
+    load_dotenv()
+    store = open_backend()
+    blobs = BlobStore(os.path.join('uploads', 'blobs'))
+    print("=" * 50)
+    if command == 'migrate':
+        print("Moving uploads into the blob store")
+        print("=" * 50)
+        moved = 0
+        for raffle in store.load_raffles().get('raffles', []):
+            changes = {}
+            for key, folder in (('image', 'uploads'), ('thumbnail', os.path.join('uploads', 'thumbnails'))):
+                name = raffle.get(key)
+                if not name or is_blob(name):
+                    continue
+                legacy_path = os.path.join(folder, name)
+                if not os.path.exists(legacy_path):
+                    print(f"Raffle #{raffle['id']}: {legacy_path} not found")
+                    continue
+                with open(legacy_path, 'rb') as f:
+                    changes[key] = blobs.put_stream(f, name.rsplit('.', 1)[-1] if '.' in name else 'jpg')
+            if changes:
+                with store.transaction():
+                    current = store.get_raffle(raffle['id'])
+                    if current:
+                        current.update(changes)
+                        store.put_raffle(current)
+                for key, name in changes.items():
+                    print(f"Raffle #{raffle['id']}: {raffle[key]} -> {name}")
+                moved += len(changes)
+        print(f"\nFiles moved: {moved} (the originals are left in place)")
+    else:
+        print("Collecting unreferenced blobs")
+        print("=" * 50)
+        grace = float(os.environ.get('BLOB_GC_GRACE', 3600))
+        result = blobs.gc(referenced_blobs(store.load_raffles().get('raffles', [])), grace)
+        print(f"Kept: {result['kept']}")
+        print(f"Removed: {result['removed']} ({result['bytesFreed']:,} bytes)")
+    print("\nDone!")
@@ -0,0 +1,121 @@
+"""
+Content-Encoding negotiation and gzip/brotli compression.
+
+Used for the precompressed static assets (assets.py) and for API responses,
+which app.py compresses on the way out. brotli is optional: without the
+package only gzip is offered.
+"""
+
+import gzip
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is used alone without it
+    brotli = None
+
+# Content types worth compressing; raster images, zips (xlsx) and the like are not
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'image/svg+xml')
+
+
+def negotiate(accept_encoding, available):
+    """Pick the best of the available encodings the client accepts (br > gzip > identity)"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        accepted[token] = q
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+
+def available_encodings():
+    return ('br', 'gzip', 'identity') if brotli is not None else ('gzip', 'identity')
+
+
+def compress(data, encoding, level):
+    """data compressed with encoding; level is the gzip level or brotli quality"""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return data
+
+
+def compress_stream(chunks, encoding, level):
+    """Compress an iterable of str/bytes chunks incrementally, flushing after each chunk.
+
+    Flushing keeps a slow stream (e.g. an export) arriving progressively
+    instead of waiting for the compressor's buffer to fill.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    else:
+        compressor = brotli.Compressor(quality=level)
+        process = compressor.process
+        flush = compressor.flush
+        finish = compressor.finish
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+class CompressedCache:
+    """LRU of compressed bodies, bounded by total size in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,94 @@
+"""
+Weighted raffle draws.
+
+Every paid ticket has the same chance of winning, but tickets are never
+expanded into a list. The engine keeps one count per buyer in a Fenwick
+(binary indexed) tree of cumulative ticket counts. A draw takes a single
+secrets.randbelow(total_tickets), binary-searches the tree for the buyer
+whose range contains that position, and uses the remainder as the index of
+the ticket inside that buyer's ticket_numbers. Building the tree is
+O(buyers) and each winner costs O(log buyers), however many tickets were
+sold.
+
+For raffles with several prizes the tree is updated after each winner:
+either the winning ticket is taken out (a buyer can win again with another
+ticket) or the winner's whole weight is (one win per buyer).
+"""
+
+import secrets
+
+
+class DrawError(ValueError):
+    """The draw can't be made, e.g. more prizes than eligible tickets or buyers"""
+
+
+class CumulativeCounts:
+    """Fenwick tree over non-negative integer weights"""
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.total = 0
+        tree = [0] * (self.size + 1)
+        for i, weight in enumerate(weights, 1):
+            tree[i] += weight
+            self.total += weight
+            parent = i + (i & -i)
+            if parent <= self.size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def add(self, index, delta):
+        """Change the weight at 0-based index by delta"""
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def find(self, position):
+        """(index, offset) of the weight slot holding position, 0 <= position < total"""
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            candidate = index + step
+            if candidate <= self.size and self._tree[candidate] <= position:
+                index = candidate
+                position -= self._tree[candidate]
+            step >>= 1
+        return index, position
+
+
+def draw_winners(buyers, count=1, one_win_per_buyer=False, randbelow=secrets.randbelow):
+    """Draw count distinct winning tickets, each uniformly from the tickets still in play.
+
+    buyers is a list of buyer dicts (already filtered to the eligible ones).
+    Returns [(buyer, ticket_number), ...] in prize order. With
+    one_win_per_buyer a buyer leaves the draw after winning; otherwise only
+    the winning ticket does.
+    """
+    tickets = [buyer.get('ticket_numbers') or [] for buyer in buyers]
+    counts = CumulativeCounts([len(t) for t in tickets])
+    available = sum(1 for t in tickets if t) if one_win_per_buyer else counts.total
+    if count < 1:
+        raise DrawError("At least one winner must be drawn")
+    if count > available:
+        unit = "buyers" if one_win_per_buyer else "tickets"
+        raise DrawError(f"Cannot draw {count} winners from {available} eligible {unit}")
+
+    # Tickets still in play for buyers that already won a prize (copied on first win)
+    remaining = {}
+    winners = []
+    for _ in range(count):
+        index, offset = counts.find(randbelow(counts.total))
+        if one_win_per_buyer:
+            ticket = tickets[index][offset]
+            counts.add(index, -len(tickets[index]))
+        else:
+            pool = remaining.setdefault(index, list(tickets[index]))
+            ticket = pool[offset]
+            # Swap-remove: pool order doesn't matter, every position is equally likely
+            pool[offset] = pool[-1]
+            pool.pop()
+            counts.add(index, -1)
+        winners.append((buyers[index], ticket))
+    return winners
@@ -1,121 +1,174 @@
 """
 Script to generate thumbnails for existing raffle images
+
+Thumbnails are rendered in parallel worker processes and stored in the blob
+store. A thumbnail is only rebuilt if its source image changed, the
+thumbnail is missing, or the size/quality settings (THUMBNAIL_MAX_SIZE /
+THUMBNAIL_QUALITY, or --size and --quality) differ from the ones it was
+made with: the key of each image's thumbnail (a hash of the source content
+and the settings) is kept in uploads/thumbnails/.manifest.json. Raffles
+sharing an image share its thumbnail.
+
+Usage: python generate_thumbnails.py [--force] [--size 300] [--quality 85] [--workers N]
 """
+import argparse
 import json
 import os
-from PIL import Image
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from blobs import BlobStore, is_blob, referenced_blobs
+from storage import atomic_write, open_backend
+from thumbnails import refresh_thumbnail, thumbnail_settings
 
-RAFFLES_FILE = 'raffle_data.json'
 UPLOAD_FOLDER = 'uploads'
 THUMBNAIL_FOLDER = 'uploads/thumbnails'
+MANIFEST_FILE = os.path.join(THUMBNAIL_FOLDER, '.manifest.json')
 
-def create_thumbnail(image_path, thumbnail_path, max_size=(300, 300)):
-    """Create a thumbnail from the original image"""
+
+def load_manifest():
     try:
-        with Image.open(image_path) as img:
-            # Convert RGBA to RGB if necessary
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            
-            # Create thumbnail
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            img.save(thumbnail_path, 'JPEG', quality=85, optimize=True)
-            print(f"✓ Created thumbnail: {thumbnail_path}")
-            return True
-    except Exception as e:
-        print(f"✗ Error creating thumbnail: {str(e)}")
-        return False
-
-def generate_missing_thumbnails():
-    """Generate thumbnails for all raffles that have images but no thumbnails"""
-    
+        with open(MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def generate_thumbnails(force=False, max_size=None, quality=None, workers=None):
+    """Build missing or stale thumbnails for every raffle with an image"""
+    default_size, default_quality = thumbnail_settings()
+    max_size = max_size or default_size
+    quality = quality or default_quality
+
     # Create thumbnails folder if it doesn't exist
     if not os.path.exists(THUMBNAIL_FOLDER):
         os.makedirs(THUMBNAIL_FOLDER)
         print(f"Created thumbnails folder: {THUMBNAIL_FOLDER}")
-    
-    # Load raffle data
-    if not os.path.exists(RAFFLES_FILE):
-        print(f"Error: {RAFFLES_FILE} not found")
-        return
-    
-    with open(RAFFLES_FILE, 'r') as f:
-        data = json.load(f)
-    
-    raffles = data.get('raffles', [])
+
+    store = open_backend()
+    blobs = BlobStore(os.path.join(UPLOAD_FOLDER, 'blobs'))
+    raffles = store.load_raffles().get('raffles', [])
     if not raffles:
         print("No raffles found")
         return
-    
-    updated = False
-    processed = 0
-    created = 0
-    skipped = 0
-    
-    print(f"\nProcessing {len(raffles)} raffles...\n")
-    
+
+    manifest = {} if force else load_manifest()
+    no_image = 0
+    missing = 0
+    jobs = {}   # image name -> (raffles using it, refresh_thumbnail arguments)
+
     for raffle in raffles:
         raffle_id = raffle.get('id')
         image_filename = raffle.get('image')
-        
+
         # Skip if no image
         if not image_filename:
-            print(f"Raffle #{raffle_id} ({raffle.get('name')}): No image")
-            skipped += 1
+            no_image += 1
             continue
-        
-        # Skip if already has thumbnail
-        if raffle.get('thumbnail'):
-            print(f"Raffle #{raffle_id} ({raffle.get('name')}): Already has thumbnail")
-            skipped += 1
+
+        if image_filename in jobs:
+            jobs[image_filename][0].append(raffle)
             continue
-        
-        processed += 1
-        
-        # Generate thumbnail filename
-        ext = image_filename.rsplit('.', 1)[1] if '.' in image_filename else 'jpg'
-        thumbnail_filename = f"raffle_{raffle_id}_thumb.jpg"
-        
+
         # Check if image file exists
-        image_path = os.path.join(UPLOAD_FOLDER, image_filename)
+        image_path = blobs.path(image_filename) if is_blob(image_filename) else os.path.join(UPLOAD_FOLDER, image_filename)
         if not os.path.exists(image_path):
             print(f"Raffle #{raffle_id} ({raffle.get('name')}): Image file not found: {image_path}")
+            missing += 1
+            continue
+
+        entry = manifest.get(image_filename) or {}
+        known_key = entry.get('key') if blobs.exists(entry.get('thumbnail')) else None
+        output_path = os.path.join(blobs.root, f".thumb-batch-{len(jobs)}-{os.getpid()}.tmp")
+        jobs[image_filename] = ([raffle], (image_path, output_path, max_size, quality, known_key))
+
+    print(f"\nChecking {len(jobs)} images with {workers or os.cpu_count()} workers "
+          f"({max_size[0]}x{max_size[1]}, quality {quality}{', forced' if force else ''})...\n")
+
+    created = 0
+    unchanged = 0
+    failed = 0
+    source_bytes = 0
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(refresh_thumbnail, *args): image for image, (_, args) in jobs.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            image_filename = futures[future]
+            users, args = jobs[image_filename]
+            names = ', '.join(f"#{r.get('id')} ({r.get('name')})" for r in users)
+            label = f"[{done}/{len(jobs)}] Raffle {names}"
+            try:
+                was_created, key, ms, size = future.result()
+            except Exception as e:
+                print(f"✗ {label}: Error creating thumbnail: {str(e)}")
+                if os.path.exists(args[1]):
+                    os.remove(args[1])
+                failed += 1
+                continue
+            source_bytes += size
+            if was_created:
+                thumbnail = blobs.put_file(args[1], 'jpg')
+                manifest[image_filename] = {"key": key, "thumbnail": thumbnail}
+                created += 1
+                print(f"✓ {label}: Created {thumbnail} in {ms:.0f} ms")
+            else:
+                unchanged += 1
+
+    elapsed = time.perf_counter() - started
+    atomic_write(MANIFEST_FILE, json.dumps(manifest, indent=2, sort_keys=True))
+
+    # Point raffles at their thumbnails (re-read each one, the app may be running)
+    updated = 0
+    for image_filename, (users, _) in jobs.items():
+        thumbnail = (manifest.get(image_filename) or {}).get('thumbnail')
+        if not blobs.exists(thumbnail):
             continue
-        
-        # Create thumbnail
-        thumbnail_path = os.path.join(THUMBNAIL_FOLDER, thumbnail_filename)
-        print(f"Raffle #{raffle_id} ({raffle.get('name')}): Generating thumbnail...")
-        
-        if create_thumbnail(image_path, thumbnail_path):
-            raffle['thumbnail'] = thumbnail_filename
-            updated = True
-            created += 1
-        else:
-            print(f"Failed to create thumbnail for raffle #{raffle_id}")
-    
-    # Save updated data if any thumbnails were created
-    if updated:
-        with open(RAFFLES_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-        print(f"\n✓ Updated {RAFFLES_FILE} with thumbnail references")
-    
+        for raffle in users:
+            with store.transaction():
+                current = store.get_raffle(raffle['id'])
+                if (current and current.get('image') == image_filename
+                        and (current.get('thumbnail') != thumbnail or current.get('thumbnailStatus') != 'ready')):
+                    current['thumbnail'] = thumbnail
+                    current['thumbnailStatus'] = 'ready'
+                    store.put_raffle(current)
+                    updated += 1
+
+    # Thumbnails that were replaced are no longer referenced
+    collected = blobs.gc(referenced_blobs(store.load_raffles().get('raffles', [])),
+                         float(os.environ.get('BLOB_GC_GRACE', 3600)))
+
     # Summary
+    processed = created + unchanged
     print("\n" + "="*50)
     print("SUMMARY")
     print("="*50)
     print(f"Total raffles: {len(raffles)}")
-    print(f"Processed: {processed}")
+    print(f"Without image: {no_image}")
+    print(f"Image file missing: {missing}")
     print(f"Thumbnails created: {created}")
-    print(f"Skipped: {skipped}")
+    print(f"Up to date: {unchanged}")
+    print(f"Failed: {failed}")
+    print(f"Raffle records updated: {updated}")
+    print(f"Unreferenced blobs removed: {collected['removed']}")
+    print(f"Time: {elapsed:.2f}s ({processed / elapsed if elapsed else 0:.1f} images/s, "
+          f"{source_bytes / 1048576 / elapsed if elapsed else 0:.1f} MB/s of source images)")
     print("="*50)
 
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate missing or stale raffle thumbnails")
+    parser.add_argument('--force', action='store_true', help="rebuild every thumbnail")
+    parser.add_argument('--size', type=int, help="maximum width/height in pixels (default: THUMBNAIL_MAX_SIZE or 300)")
+    parser.add_argument('--quality', type=int, help="JPEG quality (default: THUMBNAIL_QUALITY or 85)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    load_dotenv()
     print("="*50)
     print("Raffle Thumbnail Generator")
     print("="*50)
-    generate_missing_thumbnails()
+    generate_thumbnails(args.force, args.size and (args.size, args.size), args.quality, args.workers)
     print("\nDone!")
@@ -0,0 +1,365 @@
+"""
+Outgoing mail over a small pool of reusable SMTP sessions.
+
+Opening an SMTP connection (TCP, STARTTLS handshake, AUTH) costs far more
+than sending one message on it, so SmtpPool keeps up to SMTP_POOL_SIZE
+authenticated sessions and sends many messages over each. A session that
+the server dropped, or that sat idle for longer than SMTP_IDLE_TIMEOUT
+seconds, is replaced by a fresh connection before the message is retried.
+send_many() spreads a batch over the pool's sessions concurrently.
+
+Templates are rendered once per mailing: MessageTemplate holds the subject
+and bodies with the per-recipient fields left as placeholders, which are
+substituted for each recipient when the message is built.
+
+For a local SMTP stand-in (e.g. `python -m aiosmtpd -n -l localhost:1025`)
+set SMTP_SERVER=localhost, SMTP_PORT=1025, SMTP_STARTTLS=false and
+SMTP_AUTH=false.
+"""
+
+import atexit
+import html
+import logging
+import os
+import queue
+import smtplib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the session is no longer usable; anything else (e.g. a
+# refused recipient) concerns the message, and the session stays in the pool
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                     smtplib.SMTPHeloError, ConnectionError, socket.timeout)
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class SmtpSettings:
+    """Where and as whom to send mail"""
+
+    def __init__(self, server, port, sender_email, password='', sender_name='Raffle System',
+                 starttls=True, auth=True, timeout=30):
+        self.server = server
+        self.port = int(port) if port else 0
+        self.sender_email = sender_email
+        self.password = password
+        self.sender_name = sender_name
+        self.starttls = starttls
+        self.auth = auth
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get('SMTP_SERVER', ''),
+            os.environ.get('SMTP_PORT', ''),
+            os.environ.get('SENDER_EMAIL', ''),
+            password=os.environ.get('SENDER_PASSWORD', ''),
+            sender_name=os.environ.get('SENDER_NAME', 'Raffle System'),
+            starttls=env_flag('SMTP_STARTTLS', True),
+            auth=env_flag('SMTP_AUTH', True),
+            timeout=float(os.environ.get('SMTP_TIMEOUT', 30)),
+        )
+
+    @property
+    def configured(self):
+        return bool(self.server and self.port and self.sender_email and (self.password or not self.auth))
+
+    @property
+    def sender(self):
+        return f"{self.sender_name} <{self.sender_email}>"
+
+
+class SmtpPool:
+    """Up to size authenticated SMTP sessions, each reused for many messages"""
+
+    def __init__(self, settings, size=4, idle_timeout=60, connect=smtplib.SMTP):
+        self.settings = settings
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._connect_smtp = connect
+        # One slot per session: (smtp, last_used) when connected, None when not.
+        # LIFO so the most recently used (least likely to have timed out) goes first.
+        self._slots = queue.LifoQueue()
+        for _ in range(size):
+            self._slots.put(None)
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.sent = 0
+        self.failed = 0
+
+    def _connect(self):
+        s = self.settings
+        smtp = self._connect_smtp(s.server, s.port, timeout=s.timeout)
+        try:
+            if s.starttls:
+                smtp.starttls()
+            if s.auth:
+                smtp.login(s.sender_email, s.password)
+        except Exception:
+            self._close(smtp)
+            raise
+        with self._lock:
+            self.connections += 1
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def send(self, msg):
+        """Send msg over a pooled session, reconnecting once if the session has gone away"""
+        slot = self._slots.get()
+        smtp = None
+        try:
+            if slot is not None:
+                smtp, last_used = slot
+                if time.monotonic() - last_used > self.idle_timeout:
+                    self._close(smtp)
+                    smtp = None
+            for attempt in (1, 2):
+                reused = smtp is not None
+                if smtp is None:
+                    smtp = self._connect()
+                try:
+                    smtp.send_message(msg)
+                    break
+                except CONNECTION_ERRORS as e:
+                    logger.info(f"SMTP session lost ({e!r}), reconnecting")
+                    self._close(smtp)
+                    smtp = None
+                    # A fresh connection that fails straight away won't do better on a retry
+                    if attempt == 2 or not reused:
+                        raise
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            self._slots.put((smtp, time.monotonic()) if smtp is not None else None)
+        with self._lock:
+            self.sent += 1
+
+    def send_many(self, messages, throttle=None):
+        """Send messages concurrently over the pool; [(msg, error or None), ...] in order.
+
+        throttle, if given, is called before each send and may block (rate limiting).
+        """
+        def send_one(msg):
+            try:
+                if throttle is not None:
+                    throttle()
+                self.send(msg)
+                return msg, None
+            except Exception as e:
+                return msg, e
+
+        messages = list(messages)
+        if not messages:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.size, len(messages))) as executor:
+            return list(executor.map(send_one, messages))
+
+    def close(self):
+        """Quit the idle sessions"""
+        for _ in range(self.size):
+            try:
+                slot = self._slots.get_nowait()
+            except queue.Empty:
+                break
+            if slot is not None:
+                self._close(slot[0])
+            self._slots.put(None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "connections": self.connections, "sent": self.sent, "failed": self.failed}
+
+
+class MessageTemplate:
+    """Subject and text/HTML bodies rendered once, with per-recipient fields filled in per message.
+
+    Fields are written as {{name}} in the rendered template; values are
+    HTML-escaped in the HTML body. Without an HTML body the message is plain text.
+    """
+
+    def __init__(self, sender, subject, text, html_body=None):
+        self.sender = sender
+        self.subject = subject
+        self.text = text
+        self.html = html_body
+
+    @staticmethod
+    def _fill(template, fields, escape=False):
+        for name, value in fields.items():
+            value = str(value)
+            template = template.replace('{{' + name + '}}', html.escape(value) if escape else value)
+        return template
+
+    def message(self, to, **fields):
+        if self.html is None:
+            msg = MIMEText(self._fill(self.text, fields), 'plain')
+        else:
+            msg = MIMEMultipart('alternative')
+            msg.attach(MIMEText(self._fill(self.text, fields), 'plain'))
+            msg.attach(MIMEText(self._fill(self.html, fields, escape=True), 'html'))
+        msg['From'] = self.sender
+        msg['To'] = to
+        msg['Subject'] = self._fill(self.subject, fields)
+        return msg
+
+
+def winner_notification(settings, raffle_name, winner_info):
+    """Draw result announcement for a raffle; per-recipient field: buyer_name"""
+    sender_name = settings.sender_name
+    subject = f"🎉 {raffle_name} - Draw Result Announcement"
+    text_body = f"""
+Dear {{{{buyer_name}}}},
+
+Thank you for participating in {raffle_name}!
+
+The draw has been completed!
+
+{winner_info}
+
+We appreciate your participation in this raffle.
+
+Best regards,
+{sender_name}
+"""
+    raffle_name, winner_info, sender_name = (html.escape(v) for v in (raffle_name, winner_info, sender_name))
+    html_body = f"""
+        <html>
+            <body style="font-family: Arial, sans-serif; color: #333;">
+                <div style="max-width: 600px; margin: 0 auto; padding: 20px; background: #f8f9fa; border-radius: 8px;">
+                    <div style="text-align: center; margin-bottom: 30px;">
+                        <h2 style="color: #2c5282; margin: 0;">🎉 Draw Result Announcement</h2>
+                        <p style="color: #666; margin: 10px 0 0 0;">{raffle_name}</p>
+                    </div>
+
+                    <div style="background: white; padding: 20px; border-radius: 6px; border-left: 4px solid #2c5282;">
+                        <p>Dear {{{{buyer_name}}}},</p>
+                        <p>Thank you for participating in <strong>{raffle_name}</strong>!</p>
+                        <p>The draw has been completed! Here are the results:</p>
+
+                        <div style="background: #f0f4ff; padding: 15px; border-radius: 4px; margin: 20px 0; text-align: center;">
+                            <p style="margin: 0; font-size: 18px; color: #2c5282;"><strong>{winner_info}</strong></p>
+                        </div>
+
+                        <p>We appreciate your participation in this raffle!</p>
+                        <p style="margin-bottom: 5px;">Best regards,</p>
+                        <p style="margin: 0; color: #666;"><strong>{sender_name}</strong></p>
+                    </div>
+
+                    <div style="text-align: center; margin-top: 20px; font-size: 12px; color: #999;">
+                        <p style="margin: 0;">This is an automated message. Please do not reply to this email.</p>
+                    </div>
+                </div>
+            </body>
+        </html>
+        """
+    return MessageTemplate(settings.sender, subject, text_body, html_body)
+
+
+
+def payment_confirmation(settings, raffle, image_url=''):
+    """Payment receipt for a raffle's buyers; per-recipient fields: buyer_name, tickets, amount, ticket_list"""
+    try:
+        draw_date = datetime.strptime(raffle.get('drawDate', ''), '%Y-%m-%d')
+        draw_date = f"{draw_date:%B} {draw_date.day}, {draw_date.year}"
+    except ValueError:
+        draw_date = raffle.get('drawDate', '')
+    rule = '━' * 40
+    image_info = f"\n{rule}\n🖼️ RAFFLE IMAGE\n{rule}\n\nView the raffle image: {image_url}\n" if image_url else ''
+    text_body = f"""Dear {{{{buyer_name}}}},
+
+🎉 RAFFLE PAYMENT CONFIRMED 🎉
+
+Thank you for your purchase! We're excited to confirm that your payment has been received and processed successfully.
+{image_info}
+{rule}
+🎟️ YOUR RAFFLE ENTRY
+{rule}
+
+Raffle: {raffle['name']}
+Number of Tickets: {{{{tickets}}}}
+Total Amount Paid: R{{{{amount}}}}
+
+{rule}
+🎫 YOUR TICKET NUMBERS
+{rule}
+
+{{{{ticket_list}}}}
+
+Keep these numbers safe! You'll need them if you win.
+
+{rule}
+🏆 PRIZE
+{rule}
+
+{raffle.get('prize', '')}
+
+{rule}
+📅 DRAW DATE
+{rule}
+
+{draw_date}
+
+Mark your calendar! The winner will be announced on this date.
+
+{rule}
+
+Good luck! We'll notify you if you're the winner.
+
+If you have any questions, please don't hesitate to contact us.
+
+Best regards,
+{raffle.get('organizerName') or 'Raffle Team'}"""
+    return MessageTemplate(settings.sender, f"Payment Confirmed - {raffle['name']}", text_body)
+
+
+def payment_fields(buyer, raffle):
+    """Per-recipient fields of payment_confirmation() for a buyer"""
+    try:
+        amount = f"{buyer.get('tickets', 0) * float(raffle.get('ticketCost', 0)):.2f}"
+    except (TypeError, ValueError):
+        amount = ''
+    return {
+        "buyer_name": f"{buyer.get('name', '')} {buyer.get('surname', '')}",
+        "tickets": buyer.get('tickets', 0),
+        "amount": amount,
+        "ticket_list": ', '.join(f"#{t}" for t in buyer.get('ticket_numbers') or []),
+    }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The process-wide pool, configured from the environment on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SmtpPool(SmtpSettings.from_env(),
+                             size=int(os.environ.get('SMTP_POOL_SIZE', 4)),
+                             idle_timeout=float(os.environ.get('SMTP_IDLE_TIMEOUT', 60)))
+            atexit.register(_pool.close)
+        return _pool
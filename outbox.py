@@ -0,0 +1,473 @@
+"""
+Persistent outbox for notification emails.
+
+Mailings are not sent from the request that asks for them. The request
+enqueues one message per buyer in a local SQLite database (OUTBOX_PATH) and
+gets a job id back straight away; a background sender thread in each app
+process drains the queue over the pooled SMTP sessions of mailer.py.
+
+- Messages are unique per (raffle, buyer number, kind), so asking twice (or
+  again after a worker was killed mid-mailing) never sends a buyer the same
+  notification twice. A re-draw supersedes the earlier announcement (unsent
+  copies are cancelled), which makes room for the new one.
+- A failed send is retried with exponential backoff, up to
+  OUTBOX_MAX_ATTEMPTS; rejections that can't succeed later (5xx replies)
+  fail at once.
+- Sends are rate limited per SMTP provider (OUTBOX_RATE_LIMIT messages a
+  second, OUTBOX_RATE_LIMITS for per-server overrides). The token bucket is
+  kept in the database, so the limit holds for all app processes together.
+- Senders in several processes share the queue: a batch is claimed in one
+  transaction, and a claim left behind by a dead process is taken over after
+  OUTBOX_LEASE seconds.
+
+The job's template (see mailer.MessageTemplate) is stored once with the job
+and each message only keeps its recipient and per-buyer fields.
+
+Run `python outbox.py` to print the queue counters.
+"""
+
+import json
+import logging
+import os
+import random
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import mailer
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = 'outbox.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    raffle_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    text_body TEXT NOT NULL,
+    html_body TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    raffle_id TEXT NOT NULL,
+    buyer_number INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    last_error TEXT,
+    sent_at REAL,
+    superseded INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_once
+    ON messages (raffle_id, buyer_number, kind) WHERE superseded = 0;
+CREATE INDEX IF NOT EXISTS idx_messages_due ON messages (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_messages_job ON messages (job_id, status);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    provider TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Message states; 'sending' is claimed by a sender and counts as pending
+STATUSES = ('pending', 'sending', 'sent', 'failed', 'cancelled')
+
+
+def is_permanent(error):
+    """Whether the server rejected a message in a way a retry can't fix"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False  # credentials may be fixed while the message waits
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def describe(error):
+    """Short text for an error, e.g. '550 no such user' for an SMTP reply"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        message = error.smtp_error.decode('utf-8', 'replace') if isinstance(error.smtp_error, bytes) else error.smtp_error
+        return f"{error.smtp_code} {message}"
+    return str(error) or type(error).__name__
+
+
+class Outbox:
+    """Jobs and their messages in a SQLite database"""
+
+    def __init__(self, path=OUTBOX_PATH, max_attempts=5, retry_base=30, retry_max=3600, lease=300):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode: transactions are started explicitly by transaction()
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def enqueue(self, raffle_id, kind, template, recipients):
+        """Queue template for recipients, [(buyer_number, email, fields), ...].
+
+        Returns (job_id, queued, skipped); skipped recipients already have a
+        message of this kind. If every recipient was skipped no job is
+        created and job_id is that of the latest job already covering them.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        queued = 0
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, raffle_id, kind, created_at, sender, subject, text_body, html_body) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, str(raffle_id), kind, now, template.sender, template.subject, template.text, template.html)
+            )
+            for buyer_number, email, fields in recipients:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO messages '
+                    '(job_id, raffle_id, buyer_number, kind, recipient, fields, next_attempt_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, str(raffle_id), int(buyer_number), kind, email, json.dumps(fields), now)
+                )
+                queued += cursor.rowcount
+            if not queued:
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                row = conn.execute(
+                    'SELECT job_id FROM messages WHERE raffle_id = ? AND kind = ? AND superseded = 0 '
+                    'ORDER BY id DESC LIMIT 1', (str(raffle_id), kind)
+                ).fetchone()
+                job_id = row[0] if row else None
+        return job_id, queued, len(recipients) - queued
+
+    def supersede(self, raffle_id, kind=None, buyer_numbers=None):
+        """Cancel the raffle's unsent messages (of kind, or all; to buyer_numbers, or everyone)
+        and allow them to be sent anew"""
+        where = 'raffle_id = ? AND superseded = 0'
+        params = (str(raffle_id),)
+        if kind is not None:
+            where += ' AND kind = ?'
+            params += (kind,)
+        if buyer_numbers is not None:
+            buyer_numbers = [int(n) for n in buyer_numbers]
+            if not buyer_numbers:
+                return
+            where += f" AND buyer_number IN ({','.join('?' * len(buyer_numbers))})"
+            params += tuple(buyer_numbers)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE messages SET status = 'cancelled' WHERE {where} AND status IN ('pending', 'sending')", params)
+            conn.execute(f'UPDATE messages SET superseded = 1 WHERE {where}', params)
+
+    def claim(self, worker, limit):
+        """Claim up to limit due messages for worker; [(id, job_id, recipient, fields), ...]"""
+        now = time.time()
+        with self.transaction() as conn:
+            # Take over claims of senders that died mid-batch
+            conn.execute(
+                "UPDATE messages SET status = 'pending' WHERE status = 'sending' AND claimed_at < ?",
+                (now - self.lease,)
+            )
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM messages WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (now, limit)
+            )]
+            if not ids:
+                return []
+            marks = ','.join('?' * len(ids))
+            conn.execute(
+                f"UPDATE messages SET status = 'sending', claimed_by = ?, claimed_at = ? WHERE id IN ({marks})",
+                [worker, now] + ids
+            )
+            rows = conn.execute(
+                f'SELECT id, job_id, recipient, fields FROM messages WHERE id IN ({marks}) ORDER BY id', ids
+            ).fetchall()
+        return [(id_, job_id, recipient, json.loads(fields)) for id_, job_id, recipient, fields in rows]
+
+    def take_token(self, provider, rate, burst, worker=None):
+        """Take one send token from provider's bucket; 0, or the seconds to wait before trying again.
+
+        A sender waiting for tokens keeps its claimed batch: taking a token
+        renews the claims of worker.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE provider = ?', (provider,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO rate_limits (provider, tokens, updated_at) VALUES (?, ?, ?)',
+                         (provider, tokens, now))
+            if worker is not None:
+                conn.execute("UPDATE messages SET claimed_at = ? WHERE status = 'sending' AND claimed_by = ?",
+                             (now, worker))
+        return wait
+
+    def templates(self, job_ids):
+        """MessageTemplate of each job id"""
+        job_ids = list(set(job_ids))
+        marks = ','.join('?' * len(job_ids))
+        rows = self._connect().execute(
+            f'SELECT id, sender, subject, text_body, html_body FROM jobs WHERE id IN ({marks})', job_ids
+        )
+        return {row[0]: mailer.MessageTemplate(*row[1:]) for row in rows}
+
+    def record(self, worker, results):
+        """Store the outcome of claimed messages, [(id, error or None), ...]"""
+        now = time.time()
+        with self.transaction() as conn:
+            for message_id, error in results:
+                # A message cancelled while it was being sent stays cancelled
+                where = "WHERE id = ? AND status = 'sending' AND claimed_by = ?"
+                if error is None:
+                    conn.execute(
+                        f"UPDATE messages SET status = 'sent', attempts = attempts + 1, sent_at = ?, "
+                        f"last_error = NULL, claimed_by = NULL {where}", (now, message_id, worker)
+                    )
+                    continue
+                row = conn.execute('SELECT attempts FROM messages WHERE id = ?', (message_id,)).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                if is_permanent(error) or attempts >= self.max_attempts:
+                    status, next_attempt = 'failed', now
+                else:
+                    delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+                    status, next_attempt = 'pending', now + delay * random.uniform(1, 1.25)
+                conn.execute(
+                    f"UPDATE messages SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+                    f"claimed_by = NULL {where}", (status, attempts, next_attempt, describe(error)[:500], message_id, worker)
+                )
+
+    def job(self, job_id, max_failures=50):
+        """Progress of a job, or None if there is no such job"""
+        conn = self._connect()
+        row = conn.execute('SELECT raffle_id, kind, created_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        raffle_id, kind, created_at = row
+        counts = dict.fromkeys(STATUSES, 0)
+        for status, count in conn.execute(
+                'SELECT status, COUNT(*) FROM messages WHERE job_id = ? GROUP BY status', (job_id,)):
+            counts[status] = count
+        pending = counts['pending'] + counts['sending']
+        failures = [
+            {"buyerNumber": number, "email": recipient, "error": error}
+            for number, recipient, error in conn.execute(
+                "SELECT buyer_number, recipient, last_error FROM messages WHERE job_id = ? AND status = 'failed' "
+                'ORDER BY buyer_number LIMIT ?', (job_id, max_failures)
+            )
+        ]
+        retrying = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE job_id = ? AND status = 'pending' AND attempts > 0", (job_id,)
+        ).fetchone()[0]
+        return {
+            "id": job_id,
+            "raffleId": raffle_id,
+            "kind": kind,
+            "createdAt": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(created_at)),
+            "total": sum(counts.values()),
+            "sent": counts['sent'],
+            "failed": counts['failed'],
+            "pending": pending,
+            "retrying": retrying,
+            "cancelled": counts['cancelled'],
+            "done": pending == 0,
+            "failures": failures
+        }
+
+    def stats(self):
+        counts = dict.fromkeys(STATUSES, 0)
+        conn = self._connect()
+        for status, count in conn.execute('SELECT status, COUNT(*) FROM messages GROUP BY status'):
+            counts[status] = count
+        counts["jobs"] = conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        return counts
+
+
+class RateLimiter:
+    """Token bucket allowing rate sends a second, with bursts of up to burst.
+
+    The bucket lives in the outbox database and is shared by the senders of
+    every process using it.
+    """
+
+    def __init__(self, outbox, provider, rate, burst=None, worker=None):
+        self.outbox = outbox
+        self.provider = provider
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.worker = worker
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self.outbox.take_token(self.provider, self.rate, self.burst, self.worker)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def rate_limits_from_env():
+    """{smtp server: messages per second} from OUTBOX_RATE_LIMITS=host=rate,host=rate"""
+    limits = {}
+    for item in os.environ.get('OUTBOX_RATE_LIMITS', '').split(','):
+        host, _, rate = item.partition('=')
+        if host.strip() and rate.strip():
+            limits[host.strip().lower()] = float(rate)
+    return limits
+
+
+class OutboxSender:
+    """Background thread sending due outbox messages over the SMTP pool"""
+
+    def __init__(self, outbox, pool, poll_interval=2.0, default_rate=10.0, rate_limits=None):
+        self.outbox = outbox
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.default_rate = default_rate
+        self.rate_limits = rate_limits or {}
+        self._limiters = {}
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def limiter(self, provider):
+        provider = (provider or '').lower()
+        if provider not in self._limiters:
+            self._limiters[provider] = RateLimiter(self.outbox, provider, self.rate_limits.get(provider, self.default_rate),
+                                                   worker=self.worker)
+        return self._limiters[provider]
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='outbox-sender', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        """Look for due messages now instead of at the next poll"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent_any = self.send_due()
+            except Exception as e:
+                logger.error(f"Outbox sender error: {str(e)}")
+                sent_any = False
+            if not sent_any:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def send_due(self):
+        """Send one batch of due messages; whether there was anything to send"""
+        limiter = self.limiter(self.pool.settings.server)
+        batch = self.pool.size * 10
+        if limiter.rate > 0:
+            # Small enough to be sent well within the lease even when this sender gets only a
+            # share of the rate (waiting for tokens also renews the claim)
+            batch = max(1, min(batch, int(limiter.rate * self.outbox.lease / 2)))
+        claimed = self.outbox.claim(self.worker, batch)
+        if not claimed:
+            return False
+        templates = self.outbox.templates(job_id for _, job_id, _, _ in claimed)
+        messages = []
+        results = []
+        for message_id, job_id, recipient, fields in claimed:
+            try:
+                messages.append((message_id, templates[job_id].message(recipient, **fields)))
+            except Exception as e:
+                results.append((message_id, e))
+        sent = self.pool.send_many([msg for _, msg in messages], throttle=limiter.acquire)
+        results.extend((message_id, error) for (message_id, _), (_, error) in zip(messages, sent))
+        self.outbox.record(self.worker, results)
+        failed = sum(1 for _, error in results if error is not None)
+        logger.info(f"Outbox: sent {len(results) - failed}, failed {failed} of {len(results)} messages")
+        return True
+
+
+_outbox = None
+_sender = None
+_lock = threading.Lock()
+
+
+def get_outbox():
+    """The process-wide outbox, configured from the environment on first use"""
+    global _outbox
+    with _lock:
+        if _outbox is None:
+            _outbox = Outbox(
+                os.environ.get('OUTBOX_PATH', OUTBOX_PATH),
+                max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5)),
+                retry_base=float(os.environ.get('OUTBOX_RETRY_BASE', 30)),
+                retry_max=float(os.environ.get('OUTBOX_RETRY_MAX', 3600)),
+                lease=float(os.environ.get('OUTBOX_LEASE', 300)),
+            )
+        return _outbox
+
+
+def start_sender():
+    """Start this process's background sender (once) and return it"""
+    global _sender
+    outbox = get_outbox()
+    with _lock:
+        if _sender is None:
+            _sender = OutboxSender(
+                outbox, mailer.get_pool(),
+                poll_interval=float(os.environ.get('OUTBOX_POLL_SECONDS', 2)),
+                default_rate=float(os.environ.get('OUTBOX_RATE_LIMIT', 10)),
+                rate_limits=rate_limits_from_env(),
+            )
+        _sender.start()
+        return _sender
+
+
+if __name__ == "__main__":
+    path = os.environ.get('OUTBOX_PATH', OUTBOX_PATH)
+    counts = Outbox(path).stats()
+    print("=" * 50)
+    print(f"Outbox ({path})")
+    print("=" * 50)
+    for status, count in counts.items():
+        print(f"{status:>10}: {count:,}")
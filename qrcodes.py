@@ -0,0 +1,83 @@
+"""
+Payment QR codes, rendered once per payload and kept in memory.
+
+A raffle's payment QR code only encodes its paymentLink, so every buyer of
+the raffle gets the same image. QrCache keeps the rendered PNG/SVG bodies
+in an LRU keyed by the payload and the render options, and the app serves
+them as plain images whose URL carries a version of the payload: browsers
+keep them for good, and a changed payment link gets a new URL.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+
+FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+BOX_SIZE = 10
+BORDER = 5
+MAX_BOX_SIZE = 20
+
+
+def payload_version(payload):
+    """Short hash of a QR payload, for URLs and ETags"""
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def qr_etag(payload, fmt, box_size=BOX_SIZE, border=BORDER):
+    """ETag of a rendered QR code, known without rendering it"""
+    return f"{payload_version(payload)}-{box_size}-{border}-{fmt}"
+
+
+def render_qr(payload, fmt, box_size=BOX_SIZE, border=BORDER):
+    """The QR code of payload as PNG or SVG bytes"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported QR code format: {fmt}")
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border,
+                       image_factory=qrcode.image.svg.SvgPathImage if fmt == 'svg' else None)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    buffered = BytesIO()
+    if fmt == 'svg':
+        qr.make_image().save(buffered)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+class QrCache:
+    """LRU of rendered QR codes, keyed by payload, format and render options"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, payload, fmt, box_size=BOX_SIZE, border=BORDER):
+        key = (payload, fmt, box_size, border)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        # Rendered outside the lock; two concurrent misses just render twice
+        body = render_qr(payload, fmt, box_size, border)
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "bytes": sum(len(body) for body in self._entries.values()),
+                    "hits": self.hits, "misses": self.misses}
@@ -289,6 +289,37 @@ window.onerror = function(msg, url, lineNo, columnNo, error) {
     return false;
 };
 
+// Uploads stored under a content hash can be fetched resized (and as WebP where supported)
+const BLOB_IMAGE_RE = /^[0-9a-f]{32}\.[a-z0-9]{1,5}$/;
+
+// src and srcset attributes for a raffle's image shown `width` CSS pixels wide
+function raffleImageAttrs(raffle, width) {
+    if (BLOB_IMAGE_RE.test(raffle.image || '')) {
+        const variant = w => `/uploads/${raffle.image}/variant?w=${w}`;
+        return `src="${variant(width)}" srcset="${variant(width)} 1x, ${variant(width * 2)} 2x"`;
+    }
+    return `src="/uploads/${raffle.thumbnail ? 'thumbnails/' + raffle.thumbnail : raffle.image}"`;
+}
+
+// Uploaded images are processed in the background (thumbnailStatus 'pending');
+// reload a view a few times until they are ready
+const IMAGE_REFRESH_DELAY = 2000;
+const IMAGE_REFRESH_ATTEMPTS = 15;
+const imageRefreshTimers = {};
+
+function refreshWhileImagesPending(view, raffles, reload) {
+    const timer = imageRefreshTimers[view] || { id: null, attempts: 0 };
+    imageRefreshTimers[view] = timer;
+    clearTimeout(timer.id);
+    if (!raffles.some(raffle => raffle.thumbnailStatus === 'pending')) {
+        timer.attempts = 0;
+        return;
+    }
+    if (++timer.attempts <= IMAGE_REFRESH_ATTEMPTS) {
+        timer.id = setTimeout(reload, IMAGE_REFRESH_DELAY);
+    }
+}
+
 function createConfetti() {
     const colors = ['#ffd700', '#ff0000', '#00ff00', '#0099ff', '#ff69b4'];
     const confettiCount = 200;
@@ -372,8 +403,8 @@ async function loadRaffles() {
                 <div class="raffle-card-layout">
                     ${raffle.thumbnail || raffle.image ? `
                     <div class="raffle-image">
-                        <img src="/uploads/${raffle.thumbnail ? 'thumbnails/' + raffle.thumbnail : raffle.image}" 
-                             alt="${raffle.name}">
+                        <img ${raffleImageAttrs(raffle, 200)} 
+                             alt="${raffle.name}" loading="lazy">
                         ${statusBadge}
                     </div>` : ''}
                     <div class="raffle-card-content">
@@ -406,6 +437,7 @@ async function loadRaffles() {
                 </div>
             </div>
         `}).join("");
+        refreshWhileImagesPending('list', raffles, loadRaffles);
     } catch (error) {
         console.error('Error:', error);
         document.getElementById("raffle-list").innerHTML = `
@@ -608,6 +640,35 @@ async function createRaffle() {
     }
 }
 
+// Display thumbnail/image if available, and update it once a new upload is processed
+function showRaffleHeaderImage(raffle) {
+    const headerImageContainer = document.getElementById('raffle-header-image');
+    const headerImg = document.getElementById('raffle-header-img');
+    if (raffle.thumbnail || raffle.image) {
+        if (BLOB_IMAGE_RE.test(raffle.image || '')) {
+            // Full width on phones, so allow for the wider layout there
+            headerImg.src = `/uploads/${raffle.image}/variant?w=480`;
+            headerImg.srcset = `/uploads/${raffle.image}/variant?w=480 1x, /uploads/${raffle.image}/variant?w=960 2x`;
+        } else {
+            headerImg.removeAttribute('srcset');
+            headerImg.src = raffle.thumbnail ? `/uploads/thumbnails/${raffle.thumbnail}` : `/uploads/${raffle.image}`;
+        }
+        headerImg.alt = raffle.name;
+        headerImageContainer.style.display = 'block';
+    } else {
+        headerImageContainer.style.display = 'none';
+    }
+    refreshWhileImagesPending('header', [raffle], async () => {
+        if (currentRaffle !== raffle.id) return;
+        const res = await fetch(`/api/raffles/${raffle.id}`);
+        if (res.ok && currentRaffle === raffle.id) {
+            const updated = await res.json();
+            window.currentRaffleData = updated;
+            showRaffleHeaderImage(updated);
+        }
+    });
+}
+
 async function selectRaffle(raffleId) {
     try {
         const res = await fetch(`/api/raffles/${raffleId}`);
@@ -632,17 +693,7 @@ async function selectRaffle(raffleId) {
         document.getElementById("prize-display").textContent = raffle.prize;
         document.getElementById("ticket-cost-display").textContent = `R${raffle.ticketCost.toFixed(2)}`;
         
-        // Display thumbnail/image if available
-        const headerImageContainer = document.getElementById('raffle-header-image');
-        const headerImg = document.getElementById('raffle-header-img');
-        if (raffle.thumbnail || raffle.image) {
-            const imagePath = raffle.thumbnail ? `/uploads/thumbnails/${raffle.thumbnail}` : `/uploads/${raffle.image}`;
-            headerImg.src = imagePath;
-            headerImg.alt = raffle.name;
-            headerImageContainer.style.display = 'block';
-        } else {
-            headerImageContainer.style.display = 'none';
-        }
+        showRaffleHeaderImage(raffle);
         
         // Display previous winner if exists
         const winnerElement = document.getElementById("winner");
@@ -1096,8 +1147,11 @@ async function togglePaymentStatus(buyerNumber, paid) {
 
         const result = await res.json();
         
-        // If user wants to send email and we have the data, open mailto
-        if (sendEmail && result.buyer && result.raffle) {
+        // If the server queued the confirmation email it sends it itself;
+        // otherwise, if user wants to send email and we have the data, open mailto
+        if (sendEmail && result.emailQueued) {
+            console.log(`Payment confirmation email queued (job ${result.emailJobId})`);
+        } else if (sendEmail && result.buyer && result.raffle) {
             const buyer = result.buyer;
             const raffle = result.raffle;
             
@@ -1416,6 +1470,7 @@ async function drawWinner() {
         const prizeName = raffleData ? raffleData.prize : 'Amazing Prize';
         
         prizeDisplay.innerHTML = `
+            ${raffleData && raffleData.image ? `<img class="prize-image" ${raffleImageAttrs(raffleData, 320)} alt="${prizeName}">` : ''}
             <div class="prize-label">🎁 TODAY'S PRIZE</div>
             <div class="prize-name">${prizeName}</div>
         `;
@@ -2036,6 +2091,18 @@ async function exportRaffleData() {
                             Spreadsheet format with summary statistics and buyer details
                         </div>
                     </button>
+                    <button class="btn-primary" onclick="exportAsXLSX()" 
+                        style="padding: 20px; font-size: 1em; background: linear-gradient(135deg, #38b2ac 0%, #319795 100%); border: none; border-radius: 10px; color: white; cursor: pointer; transition: all 0.3s; box-shadow: 0 4px 12px rgba(56, 178, 172, 0.3); text-align: left;"
+                        onmouseover="this.style.transform='translateY(-2px)'; this.style.boxShadow='0 6px 16px rgba(56, 178, 172, 0.4)'"
+                        onmouseout="this.style.transform='translateY(0)'; this.style.boxShadow='0 4px 12px rgba(56, 178, 172, 0.3)'">
+                        <div style="display: flex; align-items: center; gap: 12px; margin-bottom: 8px;">
+                            <span style="font-size: 1.8em;">📗</span>
+                            <span style="font-size: 1.1em; font-weight: 600;">Export as Excel</span>
+                        </div>
+                        <div style="font-size: 0.88em; opacity: 0.95; padding-left: 46px; line-height: 1.5;">
+                            XLSX workbook with a summary sheet and a buyers sheet
+                        </div>
+                    </button>
                     <button class="btn-primary" onclick="exportAsJSON()" 
                         style="padding: 20px; font-size: 1em; background: linear-gradient(135deg, #4299e1 0%, #3182ce 100%); border: none; border-radius: 10px; color: white; cursor: pointer; transition: all 0.3s; box-shadow: 0 4px 12px rgba(66, 153, 225, 0.3); text-align: left;"
                         onmouseover="this.style.transform='translateY(-2px)'; this.style.boxShadow='0 6px 16px rgba(66, 153, 225, 0.4)'"
@@ -2056,6 +2123,14 @@ async function exportRaffleData() {
 }
 
 async function exportAsCSV() {
+    downloadExport('csv');
+}
+
+async function exportAsXLSX() {
+    downloadExport('xlsx');
+}
+
+function downloadExport(format) {
     // Close modal
     document.querySelector('.payment-modal')?.remove();
     
@@ -2064,104 +2139,27 @@ async function exportAsCSV() {
         return;
     }
 
-    try {
-        // Get raffle and buyers data
-        const [raffleRes, buyersRes] = await Promise.all([
-            fetch(`/api/raffles/${currentRaffle}`),
-            fetch(`/api/buyers/${currentRaffle}`)
-        ]);
-
-        if (!raffleRes.ok || !buyersRes.ok) {
-            throw new Error('Failed to fetch data');
-        }
-
-        const raffle = await raffleRes.json();
-        const buyers = await buyersRes.json();
-
-        // Create CSV content
-        let csv = '';
-        
-        // Raffle information section
-        csv += 'RAFFLE INFORMATION\n';
-        csv += `Raffle Name,${escapeCSV(raffle.name)}\n`;
-        csv += `Raffle ID,${raffle.id}\n`;
-        csv += `Draw Date,${new Date(raffle.drawDate).toLocaleDateString('en-ZA')}\n`;
-        csv += `Prize,${escapeCSV(raffle.prize)}\n`;
-        csv += `Ticket Cost,R${raffle.ticketCost.toFixed(2)}\n`;
-        csv += `Payment Link,${raffle.paymentLink}\n`;
-        csv += `Draw Status,${raffle.drawn ? 'Completed' : 'Pending'}\n`;
-        if (raffle.winner) {
-            csv += `Winner,${escapeCSV(raffle.winner)}\n`;
-        }
-        csv += '\n';
-
-        // Summary statistics
-        const totalBuyers = buyers.length;
-        const totalTickets = buyers.reduce((sum, b) => sum + b.tickets, 0);
-        const paidBuyers = buyers.filter(b => b.paymentReceived).length;
-        const paidTickets = buyers.filter(b => b.paymentReceived).reduce((sum, b) => sum + b.tickets, 0);
-        const totalRevenue = buyers.filter(b => b.paymentReceived).reduce((sum, b) => sum + (b.tickets * raffle.ticketCost), 0);
-        const pendingRevenue = buyers.filter(b => !b.paymentReceived).reduce((sum, b) => sum + (b.tickets * raffle.ticketCost), 0);
-
-        csv += 'SUMMARY STATISTICS\n';
-        csv += `Total Buyers,${totalBuyers}\n`;
-        csv += `Total Tickets Sold,${totalTickets}\n`;
-        csv += `Paid Buyers,${paidBuyers}\n`;
-        csv += `Paid Tickets,${paidTickets}\n`;
-        csv += `Unpaid Buyers,${totalBuyers - paidBuyers}\n`;
-        csv += `Unpaid Tickets,${totalTickets - paidTickets}\n`;
-        csv += `Total Revenue (Paid),R${totalRevenue.toFixed(2)}\n`;
-        csv += `Pending Revenue (Unpaid),R${pendingRevenue.toFixed(2)}\n`;
-        csv += `Potential Total Revenue,R${(totalRevenue + pendingRevenue).toFixed(2)}\n`;
-        csv += '\n\n';
-
-        // Buyers table header
-        csv += 'BUYER DETAILS\n';
-        csv += 'Buyer #,Name,Surname,Email,Mobile,Tickets,Purchase Date,Payment Status,Ticket Numbers\n';
-
-        // Buyers data
-        buyers.forEach(buyer => {
-            const ticketNumbers = buyer.ticket_numbers.map(t => t.toString().padStart(6, '0')).join('; ');
-            csv += `${buyer.buyerNumber},`;
-            csv += `${escapeCSV(buyer.name)},`;
-            csv += `${escapeCSV(buyer.surname)},`;
-            csv += `${escapeCSV(buyer.email)},`;
-            csv += `${buyer.mobile || 'N/A'},`;
-            csv += `${buyer.tickets},`;
-            csv += `${new Date(buyer.purchaseDate).toLocaleDateString('en-ZA')},`;
-            csv += `${buyer.paymentReceived ? 'Paid' : 'Unpaid'},`;
-            csv += `"${ticketNumbers}"\n`;
-        });
-
-        // Create and download file
-        const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
-        const link = document.createElement('a');
-        const fileName = `${raffle.name.replace(/[^a-z0-9]/gi, '_')}_${new Date().toISOString().split('T')[0]}.csv`;
-        
-        link.href = URL.createObjectURL(blob);
-        link.download = fileName;
-        link.style.display = 'none';
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
-        
-        // Show success message - find the export button
-        const exportButtons = document.querySelectorAll('.btn-export');
-        exportButtons.forEach(btn => {
-            const originalText = btn.textContent;
-            const originalBg = btn.style.background;
-            btn.textContent = '✓ Exported!';
-            btn.style.background = '#48bb78';
-            setTimeout(() => {
-                btn.textContent = originalText;
-                btn.style.background = originalBg;
-            }, 2000);
-        });
-
-    } catch (error) {
-        console.error('Error exporting data:', error);
-        alert('Failed to export data: ' + error.message);
-    }
+    // The server streams the file, so let the browser download it directly
+    // instead of building it in memory here
+    const link = document.createElement('a');
+    link.href = `/api/raffles/${currentRaffle}/export?format=${format}`;
+    link.style.display = 'none';
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+    
+    // Show success message - find the export button
+    const exportButtons = document.querySelectorAll('.btn-export');
+    exportButtons.forEach(btn => {
+        const originalText = btn.textContent;
+        const originalBg = btn.style.background;
+        btn.textContent = '✓ Exported!';
+        btn.style.background = '#48bb78';
+        setTimeout(() => {
+            btn.textContent = originalText;
+            btn.style.background = originalBg;
+        }, 2000);
+    });
 }
 
 async function exportAsJSON() {
@@ -2244,15 +2242,6 @@ async function exportAsJSON() {
     }
 }
 
-function escapeCSV(str) {
-    if (str === null || str === undefined) return '';
-    str = str.toString();
-    if (str.includes(',') || str.includes('"') || str.includes('\n')) {
-        return `"${str.replace(/"/g, '""')}"`;
-    }
-    return str;
-}
-
 function showImportRaffleDialog() {
     const modal = document.createElement('div');
     modal.className = 'payment-modal';
@@ -2751,7 +2740,7 @@ async function showQRCode(buyerNumber, tickets) {
                     <p class="modal-subtitle">For Capitec account holders only</p>
                 </div>
                 <div class="qr-code-container">
-                    <img src="data:image/png;base64,${data.qr_code}" alt="Payment QR Code">
+                    <img src="${data.qr_url}" alt="Payment QR Code">
                 </div>
                 <div class="payment-info-card">
                     <div class="info-label">Payment Information</div>
@@ -0,0 +1,1635 @@
+"""
+Storage layer for raffle and buyer data.
+
+All routes go through a backend object returned by open_backend(). Backends
+expose the same small API (load/get/put/delete of raffles and buyers), so a
+mutation touches a single record instead of the caller rewriting a whole
+document. The backend is selected with STORAGE_BACKEND:
+
+- json (default): raffle_data.json and buyers.json. Parsed documents are kept
+  in memory and revalidated on every access against the file's stat
+  signature (mtime, size, inode), so several gunicorn workers still see each
+  other's writes without re-parsing unchanged files.
+- sharded: raffle_data.json plus one buyers/<raffle_id>.json file per raffle,
+  so a buyer mutation only re-reads and rewrites that raffle's shard. Raffles
+  without a shard are still read from a legacy buyers.json; run
+  `python storage.py migrate sharded` to split it.
+- journal: buyers.json is a snapshot and every buyer mutation is appended to
+  buyers.journal as one fsynced JSON line. Reads replay the journal over the
+  snapshot, and a background compactor folds it into a new snapshot once it
+  passes JOURNAL_MAX_RECORDS / JOURNAL_MAX_BYTES.
+- sqlite: a local database (SQLITE_PATH, default raffles.db) with tables for
+  raffles, buyers and tickets. It is populated from the JSON files the first
+  time it is created; run `python storage.py migrate sqlite` to do that
+  explicitly.
+
+Every backend has a transaction() context manager. Routes wrap each
+read-modify-write in it, and each mutating method takes it too. The file
+backends hold an advisory lock (flock on .store.lock) for the duration, so
+any number of gunicorn workers and threads can write safely. Their files
+are replaced atomically (temp file + fsync + rename), so lock-free readers
+always parse a complete document. SQLite uses BEGIN IMMEDIATE transactions
+in WAL mode for the same effect.
+
+open_backend() wraps the backend in a Store, which keeps per-raffle indexes
+derived from the buyer list (see RaffleIndex). Each index is tagged with the
+backend's buyers_version() for its raffle: mutations made through the Store
+update the index in place, and a write by any other worker changes the
+version so the index is rebuilt on next use. The version is per raffle (a
+generation counter bumped by each write to that raffle's buyers, or the
+raffle's shard signature), so a write to one raffle leaves the indexes of
+the others alone.
+"""
+import bisect
+import copy
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads within one process are serialized
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RAFFLES_FILE = 'raffle_data.json'
+BUYERS_FILE = 'buyers.json'
+BUYERS_DIR = 'buyers'
+BUYERS_JOURNAL = 'buyers.journal'
+BUYER_COUNTERS_FILE = 'buyer_counters.journal'
+BUYER_COUNTERS_MAX_RECORDS = 1000
+BUYER_VERSIONS_FILE = 'buyer_versions.journal'
+JOURNAL_MAX_RECORDS = 500
+JOURNAL_MAX_BYTES = 1024 * 1024
+SQLITE_PATH = 'raffles.db'
+LOCK_FILE = '.store.lock'
+TICKET_MIN = 100000
+TICKET_MAX = 999999
+
+
+class TicketSpaceExhausted(Exception):
+    """Raised when a raffle has fewer unused ticket numbers than requested"""
+
+
+def _signature(st):
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class FileLock:
+    """Exclusive advisory lock shared by the threads and processes using one path.
+
+    Reentrant within a thread; the flock is taken on the outermost acquire and
+    released (by closing the descriptor) on the matching release.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    self._thread_lock.release()
+                    return False
+            self._fd = fd
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _write_temp(path, text):
+    """Write text to a fsynced temp file next to path and return the temp file's path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def atomic_write(path, text):
+    """Replace path with text so readers see either the old or the new file, never a partial one"""
+    tmp_path = _write_temp(path, text)
+    try:
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _merge_buyers(buyers, updates):
+    """Replace buyers in place by buyerNumber, appending the ones not present yet"""
+    positions = {b.get('buyerNumber'): i for i, b in enumerate(buyers)}
+    for buyer in updates:
+        i = positions.get(buyer['buyerNumber'])
+        if i is None:
+            positions[buyer['buyerNumber']] = len(buyers)
+            buyers.append(buyer)
+        else:
+            buyers[i] = buyer
+
+
+def _transactional(method):
+    """Run a backend method inside the backend's transaction()"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DocumentCache:
+    """Parsed JSON documents keyed by path, revalidated by stat signature"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """Return the parsed document at path, re-parsing only if the file changed.
+
+        Raises FileNotFoundError / json.JSONDecodeError like a plain json.load.
+        The returned object is shared: callers that mutate it must save it.
+        """
+        signature = _signature(os.stat(path))
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        with open(path, 'r') as f:
+            # fstat the open file so the signature matches what we parse
+            signature = _signature(os.fstat(f.fileno()))
+            data = json.load(f)
+
+        with self._lock:
+            self._entries[path] = (signature, data)
+        return data
+
+    def store(self, path, data):
+        """Record data as the current contents of path after a successful write"""
+        signature = _signature(os.stat(path))
+        with self._lock:
+            self._entries[path] = (signature, data)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "entries": len(self._entries)
+            }
+
+
+class CounterLog:
+    """Named integer counters in an append-only file of {"key": ..., "value": ...} lines.
+
+    The last line for a key holds its value, so setting a counter costs one
+    short fsynced append. Once the file has max_records lines it is
+    rewritten with just the current values; another process notices by the
+    changed inode and re-reads it. Writers hold the store lock; get() may be
+    called without it. seed() supplies the initial values when the file does
+    not exist yet.
+    """
+
+    def __init__(self, path, max_records=BUYER_COUNTERS_MAX_RECORDS, seed=None):
+        self.path = path
+        self.max_records = max_records
+        self.seed = seed
+        self._values = {}
+        self._inode = None
+        self._offset = 0
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._values = dict(self.seed()) if self.seed else {}
+            self._inode = None
+            self._offset = self._records = 0
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._values = {}
+            self._inode = st.st_ino
+            self._offset = self._records = 0
+        if st.st_size > self._offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    self._offset += len(line)
+                    if line.strip():
+                        record = json.loads(line)
+                        self._values[record['key']] = record['value']
+                        self._records += 1
+
+    def get(self, key):
+        with self._lock:
+            self._refresh()
+            return self._values.get(key, 0)
+
+    def set(self, key, value):
+        with self._lock:
+            self._refresh()
+            self._values[key] = value
+            try:
+                if self._inode is None or self._records >= self.max_records:
+                    # First write (which carries the seeded values along) or compaction
+                    atomic_write(self.path, ''.join(json.dumps({"key": k, "value": v}) + '\n'
+                                                    for k, v in self._values.items() if v))
+                else:
+                    with open(self.path, 'a') as f:
+                        f.write(json.dumps({"key": key, "value": value}) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+            except Exception:
+                # The in-memory values no longer match the file; re-read it next time
+                self._inode = -1
+                raise
+
+    def increment(self, key):
+        """Add one to a counter; call with the store lock held"""
+        self.set(key, self.get(key) + 1)
+
+
+class JsonBackend:
+    """raffle_data.json + buyers.json, rewritten as whole documents"""
+
+    name = 'json'
+
+    def __init__(self, raffles_file=RAFFLES_FILE, buyers_file=BUYERS_FILE):
+        self.raffles_file = raffles_file
+        self.buyers_file = buyers_file
+        self.cache = DocumentCache()
+        directory = os.path.dirname(os.path.abspath(raffles_file))
+        self.lock = FileLock(os.path.join(directory, LOCK_FILE))
+        # Counters written before they had a file of their own were kept in raffle_data.json
+        self.buyer_counters = CounterLog(os.path.join(directory, BUYER_COUNTERS_FILE),
+                                         seed=lambda: self.load_raffles().get('buyer_counters', {}))
+        # Generation of each raffle's buyers, bumped after every write to them
+        self.buyer_versions = CounterLog(os.path.join(directory, BUYER_VERSIONS_FILE))
+
+    @contextmanager
+    def transaction(self):
+        """Hold the store lock; cached documents are dropped if the block fails"""
+        with self.lock:
+            try:
+                yield self
+            except BaseException:
+                # Callers may have edited cached objects they never saved
+                self._discard_cached_state()
+                raise
+
+    def _discard_cached_state(self):
+        self.cache.invalidate()
+
+    def _write_json(self, path, data):
+        try:
+            atomic_write(path, json.dumps(data, indent=2))
+            self.cache.store(path, data)
+        except Exception:
+            # Whatever is on disk no longer matches the cached copy
+            self.cache.invalidate(path)
+            raise
+
+    # Raffles
+
+    def load_raffles(self):
+        try:
+            if not os.path.exists(self.raffles_file):
+                self.save_raffles({"raffles": [], "current_raffle": None})
+                return {"raffles": [], "current_raffle": None}
+            data = self.cache.load(self.raffles_file)
+            # Ensure the data has the correct structure
+            if not isinstance(data, dict):
+                data = {"raffles": [], "current_raffle": None}
+            if "raffles" not in data:
+                data["raffles"] = []
+            if "current_raffle" not in data:
+                data["current_raffle"] = None
+            return data
+        except Exception as e:
+            logger.error(f"Error loading raffles: {str(e)}")
+            return {"raffles": [], "current_raffle": None}
+
+    @_transactional
+    def save_raffles(self, data):
+        try:
+            self._write_json(self.raffles_file, data)
+        except Exception as e:
+            logger.error(f"Error saving raffles: {str(e)}")
+            raise
+
+    def get_raffle(self, raffle_id):
+        return next((r for r in self.load_raffles()['raffles'] if str(r['id']) == str(raffle_id)), None)
+
+    def raffles_version(self):
+        """Token that changes whenever the raffles may have changed"""
+        try:
+            return _signature(os.stat(self.raffles_file))
+        except FileNotFoundError:
+            return None
+
+    @_transactional
+    def put_raffle(self, raffle):
+        """Insert a raffle, or replace the one with the same id"""
+        data = self.load_raffles()
+        for i, r in enumerate(data['raffles']):
+            if str(r['id']) == str(raffle['id']):
+                data['raffles'][i] = raffle
+                break
+        else:
+            data['raffles'].append(raffle)
+        self.save_raffles(data)
+
+    @_transactional
+    def delete_raffle(self, raffle_id):
+        """Remove a raffle together with its buyers"""
+        data = self.load_raffles()
+        data['raffles'] = [r for r in data['raffles'] if str(r['id']) != str(raffle_id)]
+        self.save_raffles(data)
+        if self.buyer_counters.get(str(raffle_id)):
+            self.buyer_counters.set(str(raffle_id), 0)
+        self.delete_buyers(raffle_id)
+
+    @_transactional
+    def allocate_buyer_number(self, raffle_id, highest_existing=0, count=1):
+        """Reserve count consecutive buyerNumbers and return the first one.
+
+        Numbers come from a persisted per-raffle counter that never goes
+        backwards. The counters live in buyer_counters.journal next to
+        raffle_data.json, so every file backend shares them, and adding a
+        buyer appends one line there instead of rewriting the raffles.
+        """
+        first = max(self.buyer_counters.get(str(raffle_id)), highest_existing) + 1
+        self.buyer_counters.set(str(raffle_id), first + count - 1)
+        return first
+
+    # Buyers
+
+    def load_all_buyers(self):
+        """Return the buyers of every raffle, keyed by raffle id.
+
+        Unlike load_buyers this lets I/O errors propagate, because callers use
+        the result to rewrite the whole file.
+        """
+        if not os.path.exists(self.buyers_file):
+            self.save_all_buyers({})
+            return {}
+        try:
+            return self.cache.load(self.buyers_file)
+        except json.JSONDecodeError:
+            # If file is empty or invalid, initialize it
+            self.save_all_buyers({})
+            return {}
+
+    @_transactional
+    def save_all_buyers(self, data):
+        try:
+            self._write_json(self.buyers_file, data)
+        except Exception as e:
+            logger.error(f"Error saving buyers: {str(e)}")
+            raise
+
+    def load_buyers(self, raffle_id):
+        try:
+            return self.load_all_buyers().get(str(raffle_id), [])
+        except Exception as e:
+            logger.error(f"Error loading buyers: {str(e)}")
+            return []
+
+    def buyers_version(self, raffle_id):
+        """Token that changes whenever the raffle's buyers may have changed.
+
+        Writes to other raffles leave it alone, so their indexes and ETags
+        stay valid.
+        """
+        return self.buyer_versions.get(str(raffle_id))
+
+    def _buyers_changed(self, raffle_id):
+        """Bump the raffle's buyers version; called after the write, so a reader
+        that sees the new version also sees the new buyers"""
+        self.buyer_versions.increment(str(raffle_id))
+
+    @_transactional
+    def put_buyer(self, raffle_id, buyer):
+        """Insert a buyer, or replace the one with the same buyerNumber"""
+        self.put_buyers(raffle_id, [buyer])
+
+    @_transactional
+    def put_buyers(self, raffle_id, buyers):
+        """Insert or replace several buyers with a single write"""
+        all_buyers = self.load_all_buyers()
+        _merge_buyers(all_buyers.setdefault(str(raffle_id), []), buyers)
+        self.save_all_buyers(all_buyers)
+        self._buyers_changed(raffle_id)
+
+    @_transactional
+    def set_payment(self, raffle_id, buyer_number, payment_received):
+        """Set a buyer's paymentReceived flag; returns the buyer, or None if not found"""
+        updated = self.set_payments(raffle_id, {buyer_number: payment_received})
+        return updated[0] if updated else None
+
+    @_transactional
+    def set_payments(self, raffle_id, payments):
+        """Apply {buyerNumber: paymentReceived} with a single write; returns the updated buyers"""
+        updated = []
+        for buyer in self.load_buyers(raffle_id):
+            if buyer.get('buyerNumber') in payments:
+                buyer['paymentReceived'] = payments[buyer['buyerNumber']]
+                updated.append(buyer)
+        if updated:
+            self.put_buyers(raffle_id, updated)
+        return updated
+
+    @_transactional
+    def delete_buyer(self, raffle_id, buyer_number):
+        """Remove a buyer; returns False if there was no such buyer"""
+        all_buyers = self.load_all_buyers()
+        buyers = all_buyers.get(str(raffle_id), [])
+        remaining = [b for b in buyers if b.get('buyerNumber') != buyer_number]
+        if len(remaining) == len(buyers):
+            return False
+        all_buyers[str(raffle_id)] = remaining
+        self.save_all_buyers(all_buyers)
+        self._buyers_changed(raffle_id)
+        return True
+
+    @_transactional
+    def replace_buyers(self, raffle_id, buyers):
+        all_buyers = self.load_all_buyers()
+        all_buyers[str(raffle_id)] = buyers
+        self.save_all_buyers(all_buyers)
+        self._buyers_changed(raffle_id)
+
+    @_transactional
+    def delete_buyers(self, raffle_id):
+        all_buyers = self.load_all_buyers()
+        if str(raffle_id) in all_buyers:
+            del all_buyers[str(raffle_id)]
+            self.save_all_buyers(all_buyers)
+            self._buyers_changed(raffle_id)
+
+    def stats(self):
+        return {"backend": self.name, "cache": self.cache.stats()}
+
+
+class ShardedJsonBackend(JsonBackend):
+    """raffle_data.json plus one buyers/<raffle_id>.json shard per raffle"""
+
+    name = 'sharded'
+    _shard_name = re.compile(r'^[A-Za-z0-9_-]+$')
+
+    def __init__(self, raffles_file=RAFFLES_FILE, buyers_dir=BUYERS_DIR, legacy_buyers_file=BUYERS_FILE):
+        super().__init__(raffles_file, legacy_buyers_file)
+        self.buyers_dir = buyers_dir
+        if not os.path.exists(buyers_dir):
+            os.makedirs(buyers_dir)
+
+    def _shard_path(self, raffle_id):
+        raffle_id = str(raffle_id)
+        if not self._shard_name.match(raffle_id):
+            raise ValueError(f"Invalid raffle id: {raffle_id}")
+        return os.path.join(self.buyers_dir, f"{raffle_id}.json")
+
+    def _load_legacy(self, raffle_id):
+        """Buyers of a raffle that has no shard yet, from the old single file"""
+        if not os.path.exists(self.buyers_file):
+            return []
+        buyers = self.cache.load(self.buyers_file).get(str(raffle_id), [])
+        # Copy so edits before the first shard write don't leak into the cached legacy document
+        return copy.deepcopy(buyers)
+
+    def _load_shard(self, raffle_id):
+        path = self._shard_path(raffle_id)
+        try:
+            return self.cache.load(path)
+        except FileNotFoundError:
+            return self._load_legacy(raffle_id)
+
+    def load_all_buyers(self):
+        all_buyers = {}
+        if os.path.exists(self.buyers_file):
+            all_buyers.update(self.cache.load(self.buyers_file))
+        for filename in os.listdir(self.buyers_dir):
+            if filename.endswith('.json'):
+                raffle_id = filename[:-len('.json')]
+                all_buyers[raffle_id] = self._load_shard(raffle_id)
+        return all_buyers
+
+    def load_buyers(self, raffle_id):
+        try:
+            return self._load_shard(raffle_id)
+        except Exception as e:
+            logger.error(f"Error loading buyers: {str(e)}")
+            return []
+
+    def buyers_version(self, raffle_id):
+        try:
+            return _signature(os.stat(self._shard_path(raffle_id)))
+        except FileNotFoundError:
+            pass
+        try:
+            return ('legacy', _signature(os.stat(self.buyers_file)))
+        except FileNotFoundError:
+            return ('legacy', None)
+
+    @_transactional
+    def replace_buyers(self, raffle_id, buyers):
+        try:
+            self._write_json(self._shard_path(raffle_id), buyers)
+        except Exception as e:
+            logger.error(f"Error saving buyers: {str(e)}")
+            raise
+
+    @_transactional
+    def put_buyers(self, raffle_id, new_buyers):
+        buyers = self._load_shard(raffle_id)
+        _merge_buyers(buyers, new_buyers)
+        self.replace_buyers(raffle_id, buyers)
+
+    @_transactional
+    def delete_buyer(self, raffle_id, buyer_number):
+        buyers = self._load_shard(raffle_id)
+        remaining = [b for b in buyers if b.get('buyerNumber') != buyer_number]
+        if len(remaining) == len(buyers):
+            return False
+        self.replace_buyers(raffle_id, remaining)
+        return True
+
+    @_transactional
+    def delete_buyers(self, raffle_id):
+        path = self._shard_path(raffle_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.cache.invalidate(path)
+        # Until the legacy file is migrated it would otherwise resurrect these buyers
+        if os.path.exists(self.buyers_file):
+            legacy = self.cache.load(self.buyers_file)
+            if str(raffle_id) in legacy:
+                del legacy[str(raffle_id)]
+                self.save_all_buyers(legacy)
+
+    def stats(self):
+        shards = sum(1 for f in os.listdir(self.buyers_dir) if f.endswith('.json'))
+        return {
+            "backend": self.name,
+            "cache": self.cache.stats(),
+            "shards": shards,
+            "legacy_file": os.path.exists(self.buyers_file)
+        }
+
+
+def split_buyers_file(buyers_file=BUYERS_FILE, buyers_dir=BUYERS_DIR):
+    """Split buyers.json into per-raffle shards, then rename it to buyers.json.migrated.
+
+    Raffles that already have a shard keep it; the shard is newer than the
+    legacy entry.
+    """
+    backend = ShardedJsonBackend(buyers_dir=buyers_dir, legacy_buyers_file=buyers_file)
+    if not os.path.exists(buyers_file):
+        return {"raffles": 0, "buyers": 0}
+
+    with open(buyers_file, 'r') as f:
+        all_buyers = json.load(f)
+
+    raffles = 0
+    buyers = 0
+    for raffle_id, raffle_buyers in all_buyers.items():
+        if os.path.exists(backend._shard_path(raffle_id)):
+            logger.warning(f"Raffle {raffle_id}: shard already exists, keeping it")
+            continue
+        backend.replace_buyers(raffle_id, raffle_buyers)
+        raffles += 1
+        buyers += len(raffle_buyers)
+
+    os.replace(buyers_file, buyers_file + '.migrated')
+    logger.info(f"Split {buyers_file} into {raffles} shards in {buyers_dir}/")
+    return {"raffles": raffles, "buyers": buyers}
+
+
+def _apply_journal_record(all_buyers, record):
+    """Apply one journal record to a {raffle_id: [buyers]} document.
+
+    Every operation sets state rather than modifying it relative to what was
+    there, so replaying records that were already folded into the snapshot
+    (after a crash mid-compaction) gives the same result.
+    """
+    op = record['op']
+    raffle_id = str(record['raffle'])
+    if op == 'drop':
+        all_buyers.pop(raffle_id, None)
+        return
+    if op == 'replace':
+        all_buyers[raffle_id] = record['buyers']
+        return
+
+    buyers = all_buyers.setdefault(raffle_id, [])
+    if op == 'put':
+        _merge_buyers(buyers, [record['buyer']])
+    elif op == 'payment':
+        for b in buyers:
+            if b.get('buyerNumber') == record['buyerNumber']:
+                b['paymentReceived'] = record['paymentReceived']
+                break
+    elif op == 'delete':
+        all_buyers[raffle_id] = [b for b in buyers if b.get('buyerNumber') != record['buyerNumber']]
+    else:
+        logger.warning(f"Skipping unknown journal operation: {op}")
+
+
+class JournaledJsonBackend(JsonBackend):
+    """buyers.json snapshot plus an append-only buyers.journal of mutations.
+
+    The materialized buyers document is kept in memory together with the
+    journal offset it has been replayed up to, so a read only parses the
+    lines appended since the previous read. A truncated trailing line (a
+    write still in progress, or a crash mid-append) is left for the next read.
+    """
+
+    name = 'journal'
+
+    def __init__(self, raffles_file=RAFFLES_FILE, buyers_file=BUYERS_FILE, journal_file=BUYERS_JOURNAL,
+                 max_records=JOURNAL_MAX_RECORDS, max_bytes=JOURNAL_MAX_BYTES):
+        super().__init__(raffles_file, buyers_file)
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + '.compacting'
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._state = None
+        self._snapshot_signature = None
+        self._journal_inode = None
+        self._offset = 0
+        self._records = 0
+        self._compactor = None
+        self.compaction_lock = FileLock(journal_file + '.lock')
+        self.compactions = 0
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.buyers_file):
+            return None, {}
+        with open(self.buyers_file, 'r') as f:
+            signature = _signature(os.fstat(f.fileno()))
+            try:
+                return signature, json.load(f)
+            except json.JSONDecodeError:
+                logger.error(f"Invalid buyers snapshot {self.buyers_file}, starting from an empty one")
+                return signature, {}
+
+    def _replay(self, path, offset=0):
+        """Apply complete journal lines from offset; returns (new offset, records applied)"""
+        applied = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    _apply_journal_record(self._state, json.loads(line))
+                    applied += 1
+        return offset, applied
+
+    def _refresh(self):
+        """Bring the in-memory document up to date with the snapshot and journal.
+
+        Runs without the store lock. A compaction can swap the snapshot while
+        it is being rebuilt, so the rebuild is retried until the snapshot it
+        read is still the current one.
+        """
+        for _ in range(5):
+            snapshot_signature = _signature(os.stat(self.buyers_file)) if os.path.exists(self.buyers_file) else None
+            try:
+                journal_stat = os.stat(self.journal_file)
+            except FileNotFoundError:
+                journal_stat = None
+            journal_inode = journal_stat.st_ino if journal_stat else None
+
+            # After our own compaction the fresh journal is adopted from offset 0
+            adopt_journal = self._journal_inode is None and self._offset == 0
+            if (self._state is not None and snapshot_signature == self._snapshot_signature
+                    and (journal_inode == self._journal_inode or adopt_journal)
+                    and not (journal_stat and journal_stat.st_size < self._offset)):
+                self.cache.hits += 1
+                break
+
+            # Someone compacted (or this is the first read): rebuild from scratch
+            self.cache.misses += 1
+            self._snapshot_signature, self._state = self._read_snapshot()
+            self._offset = 0
+            self._records = 0
+            if os.path.exists(self.rotated_file):
+                self._replay(self.rotated_file)
+            current = _signature(os.stat(self.buyers_file)) if os.path.exists(self.buyers_file) else None
+            if current == self._snapshot_signature:
+                break
+            self._state = None
+
+        self._journal_inode = journal_inode
+        if journal_stat and journal_stat.st_size > self._offset:
+            self._offset, applied = self._replay(self.journal_file, self._offset)
+            self._records += applied
+        return self._state
+
+    def _discard_cached_state(self):
+        super()._discard_cached_state()
+        with self._lock:
+            self._state = None
+
+    @_transactional
+    def _append(self, *records):
+        """Append records to the journal with one write and one fsync"""
+        line = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        with self._lock:
+            try:
+                self._refresh()
+                with open(self.journal_file, 'a') as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._refresh()
+            except Exception:
+                # In-memory state may hold the caller's unsaved edits; rebuild on next read
+                self._state = None
+                raise
+            for raffle_id in {record['raffle'] for record in records}:
+                self._buyers_changed(raffle_id)
+            if self._records >= self.max_records or self._offset >= self.max_bytes:
+                self._start_compaction()
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name='buyers-journal-compactor', daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        """Fold the journal into a new buyers.json snapshot.
+
+        Only one process compacts at a time (a non-blocking lock on
+        buyers.journal.lock; others just skip). The journal is renamed aside
+        under the store lock so appends can continue into a fresh one while
+        the snapshot is serialized and written. The new snapshot is renamed
+        into place, and the old journal removed, under the store lock again.
+        If an earlier compaction died half way, its renamed journal is folded
+        in first and the live journal is left for the next round.
+        """
+        if not self.compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with self.transaction(), self._lock:
+                state = self._refresh()
+                has_journal = os.path.exists(self.journal_file) and self._offset > 0
+                leftover = os.path.exists(self.rotated_file)
+                if not has_journal and not leftover:
+                    return False
+                if not leftover:
+                    os.replace(self.journal_file, self.rotated_file)
+                    self._journal_inode = None
+                    self._offset = 0
+                    self._records = 0
+                payload = json.dumps(state, indent=2)
+
+            tmp_path = _write_temp(self.buyers_file, payload)
+            with self.transaction(), self._lock:
+                os.replace(tmp_path, self.buyers_file)
+                os.remove(self.rotated_file)
+                # The in-memory document already includes everything in the new snapshot
+                self._snapshot_signature = _signature(os.stat(self.buyers_file))
+                self.compactions += 1
+            logger.info(f"Compacted {self.journal_file} into {self.buyers_file}")
+            return True
+        finally:
+            self.compaction_lock.release()
+
+    def load_all_buyers(self):
+        with self._lock:
+            return self._refresh()
+
+    def load_buyers(self, raffle_id):
+        try:
+            return self.load_all_buyers().get(str(raffle_id), [])
+        except Exception as e:
+            logger.error(f"Error loading buyers: {str(e)}")
+            return []
+
+    def put_buyers(self, raffle_id, buyers):
+        self._append(*({"op": "put", "raffle": str(raffle_id), "buyer": buyer} for buyer in buyers))
+
+    @_transactional
+    def set_payments(self, raffle_id, payments):
+        known = {b.get('buyerNumber') for b in self.load_buyers(raffle_id)}
+        numbers = [n for n in payments if n in known]
+        if not numbers:
+            return []
+        self._append(*({"op": "payment", "raffle": str(raffle_id), "buyerNumber": n,
+                        "paymentReceived": payments[n]} for n in numbers))
+        return [b for b in self.load_buyers(raffle_id) if b.get('buyerNumber') in payments]
+
+    @_transactional
+    def delete_buyer(self, raffle_id, buyer_number):
+        if not any(b.get('buyerNumber') == buyer_number for b in self.load_buyers(raffle_id)):
+            return False
+        self._append({"op": "delete", "raffle": str(raffle_id), "buyerNumber": buyer_number})
+        return True
+
+    def replace_buyers(self, raffle_id, buyers):
+        self._append({"op": "replace", "raffle": str(raffle_id), "buyers": buyers})
+
+    def delete_buyers(self, raffle_id):
+        self._append({"op": "drop", "raffle": str(raffle_id)})
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            return {
+                "backend": self.name,
+                "cache": self.cache.stats(),
+                "journal": {
+                    "records": self._records,
+                    "bytes": self._offset,
+                    "max_records": self.max_records,
+                    "max_bytes": self.max_bytes,
+                    "compactions": self.compactions
+                }
+            }
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS raffles (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buyers (
+    raffle_id TEXT NOT NULL,
+    buyer_number INTEGER NOT NULL,
+    payment_received INTEGER NOT NULL DEFAULT 0,
+    tickets INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_buyers_number ON buyers (raffle_id, buyer_number);
+CREATE TABLE IF NOT EXISTS tickets (
+    raffle_id TEXT NOT NULL,
+    ticket_number INTEGER NOT NULL,
+    buyer_number INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_number ON tickets (raffle_id, ticket_number);
+CREATE INDEX IF NOT EXISTS idx_tickets_buyer ON tickets (raffle_id, buyer_number);
+CREATE TABLE IF NOT EXISTS raffle_meta (
+    raffle_id TEXT PRIMARY KEY,
+    buyers_version INTEGER NOT NULL DEFAULT 0,
+    last_buyer_number INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _casefold(text):
+    """casefold() for SQL, so searches match the file backends' (Unicode) case folding"""
+    return text.casefold() if isinstance(text, str) else ''
+
+
+class SqliteBackend:
+    """Raffles, buyers and tickets as rows in a local SQLite database.
+
+    Buyer records are stored whole in the data column; buyer_number,
+    payment_received and tickets are copied out into indexed columns, and
+    every ticket number gets a row in the tickets table.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH, migrate=True):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+        # Setup is decided and done in one transaction: a worker opening the
+        # database at the same time waits for it, then finds the 'migrated' row
+        with self.transaction() as conn:
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(raffle_meta)')}
+            if 'last_buyer_number' not in columns:
+                conn.execute('ALTER TABLE raffle_meta ADD COLUMN last_buyer_number INTEGER NOT NULL DEFAULT 0')
+            existing = conn.execute("SELECT value FROM meta WHERE key = 'instance'").fetchone()
+            if existing is None:
+                # Random per-database id, so version counters of a recreated database
+                # can't be mistaken for the old one's
+                conn.execute("INSERT INTO meta (key, value) VALUES ('instance', ?)", (json.dumps(os.urandom(8).hex()),))
+            self.instance = json.loads(conn.execute("SELECT value FROM meta WHERE key = 'instance'").fetchone()[0])
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is None:
+                if existing is not None:
+                    # Created before the 'migrated' row existed, and migrated back then
+                    self._mark_migrated(conn)
+                elif migrate:
+                    migrate_json_to_sqlite(self)
+
+    @staticmethod
+    def _mark_migrated(conn):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', 'true')")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode: transactions are started explicitly by transaction()
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('casefold', 1, _casefold, deterministic=True)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE on the thread's connection; nested blocks join the outer one"""
+        conn = self._connect()
+        depth = self._local.depth
+        if depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                conn.rollback()
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            conn.commit()
+
+    # Raffles
+
+    def load_raffles(self):
+        conn = self._connect()
+        raffles = [json.loads(row[0]) for row in conn.execute('SELECT data FROM raffles ORDER BY rowid')]
+        row = conn.execute("SELECT value FROM meta WHERE key = 'current_raffle'").fetchone()
+        return {"raffles": raffles, "current_raffle": json.loads(row[0]) if row else None}
+
+    def get_raffle(self, raffle_id):
+        row = self._connect().execute('SELECT data FROM raffles WHERE id = ?', (str(raffle_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def raffles_version(self):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'raffles_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_raffles_version(self, conn):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('raffles_version', 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def put_raffle(self, raffle):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO raffles (id, data) VALUES (?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                (str(raffle['id']), json.dumps(raffle))
+            )
+            self._bump_raffles_version(conn)
+
+    def delete_raffle(self, raffle_id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM raffles WHERE id = ?', (str(raffle_id),))
+            self._bump_raffles_version(conn)
+            self._delete_buyers(conn, raffle_id)
+            # Keep the row (and its version) so a reused raffle id can't match a stale index
+            conn.execute('UPDATE raffle_meta SET last_buyer_number = 0 WHERE raffle_id = ?', (str(raffle_id),))
+
+    def allocate_buyer_number(self, raffle_id, highest_existing=0, count=1):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO raffle_meta (raffle_id) VALUES (?) ON CONFLICT (raffle_id) DO NOTHING', (str(raffle_id),)
+            )
+            conn.execute(
+                'UPDATE raffle_meta SET last_buyer_number = MAX(last_buyer_number, ?) + ? WHERE raffle_id = ?',
+                (highest_existing, count, str(raffle_id))
+            )
+            last = conn.execute(
+                'SELECT last_buyer_number FROM raffle_meta WHERE raffle_id = ?', (str(raffle_id),)
+            ).fetchone()[0]
+            return last - count + 1
+
+    # Buyers
+
+    def load_buyers(self, raffle_id):
+        rows = self._connect().execute(
+            'SELECT data FROM buyers WHERE raffle_id = ? ORDER BY rowid', (str(raffle_id),)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def buyers_version(self, raffle_id):
+        row = self._connect().execute(
+            'SELECT buyers_version FROM raffle_meta WHERE raffle_id = ?', (str(raffle_id),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn, raffle_id):
+        conn.execute(
+            'INSERT INTO raffle_meta (raffle_id, buyers_version) VALUES (?, 1) '
+            'ON CONFLICT (raffle_id) DO UPDATE SET buyers_version = buyers_version + 1',
+            (str(raffle_id),)
+        )
+
+    def _put_buyer(self, conn, raffle_id, buyer):
+        raffle_id = str(raffle_id)
+        buyer_number = buyer['buyerNumber']
+        tickets = buyer.get('ticket_numbers', [])
+        row = conn.execute(
+            'SELECT data FROM buyers WHERE raffle_id = ? AND buyer_number = ?', (raffle_id, buyer_number)
+        ).fetchone()
+        conn.execute(
+            'INSERT INTO buyers (raffle_id, buyer_number, payment_received, tickets, data) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (raffle_id, buyer_number) DO UPDATE SET '
+            'payment_received = excluded.payment_received, tickets = excluded.tickets, data = excluded.data',
+            (raffle_id, buyer_number, 1 if buyer.get('paymentReceived') else 0, len(tickets), json.dumps(buyer))
+        )
+        self._bump_version(conn, raffle_id)
+        # Only touch the ticket rows when the buyer's tickets actually changed
+        if row is None or json.loads(row[0]).get('ticket_numbers', []) != tickets:
+            conn.execute('DELETE FROM tickets WHERE raffle_id = ? AND buyer_number = ?', (raffle_id, buyer_number))
+            conn.executemany(
+                'INSERT INTO tickets (raffle_id, ticket_number, buyer_number) VALUES (?, ?, ?)',
+                [(raffle_id, t, buyer_number) for t in tickets]
+            )
+
+    def put_buyer(self, raffle_id, buyer):
+        self.put_buyers(raffle_id, [buyer])
+
+    def put_buyers(self, raffle_id, buyers):
+        with self.transaction() as conn:
+            for buyer in buyers:
+                self._put_buyer(conn, raffle_id, buyer)
+
+    def query_buyers(self, raffle_id, limit=None, after=None, paid=None, q=None):
+        sql = 'SELECT data FROM buyers WHERE raffle_id = ?'
+        params = [str(raffle_id)]
+        if after is not None:
+            sql += ' AND buyer_number > ?'
+            params.append(after)
+        if paid is not None:
+            sql += ' AND payment_received = ?'
+            params.append(1 if paid else 0)
+        if q:
+            # Same semantics as _buyer_matches: casefolded substring of "name surname" or email
+            sql += (
+                " AND (instr(casefold(COALESCE(json_extract(data, '$.name'), '') || ' ' || "
+                "COALESCE(json_extract(data, '$.surname'), '')), ?) > 0"
+                " OR instr(casefold(json_extract(data, '$.email')), ?) > 0)"
+            )
+            params += [q.casefold()] * 2
+        sql += ' ORDER BY buyer_number'
+        if limit is not None:
+            # One extra row tells us whether there is a next page
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+        page = [json.loads(row[0]) for row in self._connect().execute(sql, params)]
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            return page, page[-1]['buyerNumber']
+        return page, None
+
+    def set_payment(self, raffle_id, buyer_number, payment_received):
+        updated = self.set_payments(raffle_id, {buyer_number: payment_received})
+        return updated[0] if updated else None
+
+    def set_payments(self, raffle_id, payments):
+        updated = []
+        with self.transaction() as conn:
+            for buyer_number, payment_received in payments.items():
+                cur = conn.execute(
+                    'UPDATE buyers SET payment_received = ?, data = json_set(data, \'$.paymentReceived\', json(?)) '
+                    'WHERE raffle_id = ? AND buyer_number = ?',
+                    (1 if payment_received else 0, json.dumps(payment_received), str(raffle_id), buyer_number)
+                )
+                if cur.rowcount:
+                    row = conn.execute(
+                        'SELECT data FROM buyers WHERE raffle_id = ? AND buyer_number = ?',
+                        (str(raffle_id), buyer_number)
+                    ).fetchone()
+                    updated.append(json.loads(row[0]))
+            if updated:
+                self._bump_version(conn, raffle_id)
+        return updated
+
+    def delete_buyer(self, raffle_id, buyer_number):
+        with self.transaction() as conn:
+            cur = conn.execute(
+                'DELETE FROM buyers WHERE raffle_id = ? AND buyer_number = ?', (str(raffle_id), buyer_number)
+            )
+            if cur.rowcount == 0:
+                return False
+            conn.execute('DELETE FROM tickets WHERE raffle_id = ? AND buyer_number = ?', (str(raffle_id), buyer_number))
+            self._bump_version(conn, raffle_id)
+            return True
+
+    def replace_buyers(self, raffle_id, buyers):
+        with self.transaction() as conn:
+            self._delete_buyers(conn, raffle_id)
+            for buyer in buyers:
+                self._put_buyer(conn, raffle_id, buyer)
+
+    def _delete_buyers(self, conn, raffle_id):
+        conn.execute('DELETE FROM buyers WHERE raffle_id = ?', (str(raffle_id),))
+        conn.execute('DELETE FROM tickets WHERE raffle_id = ?', (str(raffle_id),))
+        self._bump_version(conn, raffle_id)
+
+    def delete_buyers(self, raffle_id):
+        with self.transaction() as conn:
+            self._delete_buyers(conn, raffle_id)
+
+    def stats(self):
+        conn = self._connect()
+        counts = {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('raffles', 'buyers', 'tickets')
+        }
+        return {"backend": self.name, "rows": counts}
+
+
+def migrate_json_to_sqlite(backend, raffles_file=RAFFLES_FILE, buyers_file=BUYERS_FILE):
+    """Copy raffle_data.json / buyers.json into a SQLite backend in one transaction.
+
+    Buyers that share a buyerNumber (possible with the old len(buyers) + 1
+    numbering after a delete) are renumbered, and ticket numbers already
+    held by another buyer of the same raffle are dropped from the index.
+    """
+    source = JsonBackend(raffles_file, buyers_file)
+    if not os.path.exists(raffles_file) and not os.path.exists(buyers_file):
+        with backend.transaction() as conn:
+            backend._mark_migrated(conn)
+        return {"raffles": 0, "buyers": 0}
+
+    raffles = source.load_raffles()
+    all_buyers = source.load_all_buyers() if os.path.exists(buyers_file) else {}
+    migrated_buyers = 0
+
+    with backend.transaction() as conn:
+        backend._mark_migrated(conn)
+        for raffle in raffles['raffles']:
+            conn.execute(
+                'INSERT OR REPLACE INTO raffles (id, data) VALUES (?, ?)',
+                (str(raffle['id']), json.dumps(raffle))
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('current_raffle', ?)",
+            (json.dumps(raffles.get('current_raffle')),)
+        )
+        backend._bump_raffles_version(conn)
+        for raffle_id, buyers in all_buyers.items():
+            backend._delete_buyers(conn, raffle_id)
+            seen_numbers = set()
+            seen_tickets = set()
+            next_number = max((b.get('buyerNumber', 0) for b in buyers), default=0) + 1
+            for buyer in buyers:
+                if buyer.get('buyerNumber') in seen_numbers or 'buyerNumber' not in buyer:
+                    logger.warning(f"Raffle {raffle_id}: renumbering duplicate buyer #{buyer.get('buyerNumber')} to #{next_number}")
+                    buyer['buyerNumber'] = next_number
+                    next_number += 1
+                seen_numbers.add(buyer['buyerNumber'])
+
+                tickets = buyer.get('ticket_numbers', [])
+                conn.execute(
+                    'INSERT INTO buyers (raffle_id, buyer_number, payment_received, tickets, data) VALUES (?, ?, ?, ?, ?)',
+                    (str(raffle_id), buyer['buyerNumber'], 1 if buyer.get('paymentReceived') else 0,
+                     len(tickets), json.dumps(buyer))
+                )
+                for ticket in tickets:
+                    if ticket in seen_tickets:
+                        logger.warning(f"Raffle {raffle_id}: ticket {ticket} is held by more than one buyer")
+                        continue
+                    seen_tickets.add(ticket)
+                    conn.execute(
+                        'INSERT INTO tickets (raffle_id, ticket_number, buyer_number) VALUES (?, ?, ?)',
+                        (str(raffle_id), ticket, buyer['buyerNumber'])
+                    )
+                migrated_buyers += 1
+
+    logger.info(f"Migrated {len(raffles['raffles'])} raffles and {migrated_buyers} buyers into {backend.path}")
+    return {"raffles": len(raffles['raffles']), "buyers": migrated_buyers}
+
+
+class TicketAllocator:
+    """Bitmap of the ticket numbers in use in one raffle (TICKET_MIN..TICKET_MAX).
+
+    One bit per number, so the full 900k space costs about 110 KB.
+    """
+
+    def __init__(self, used=()):
+        self.size = TICKET_MAX - TICKET_MIN + 1
+        self._bits = bytearray((self.size + 7) // 8)
+        self.used = 0
+        for number in used:
+            self.add(number)
+
+    def __contains__(self, number):
+        i = number - TICKET_MIN
+        return 0 <= i < self.size and bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def add(self, number):
+        i = number - TICKET_MIN
+        if 0 <= i < self.size and not self._bits[i >> 3] & (1 << (i & 7)):
+            self._bits[i >> 3] |= 1 << (i & 7)
+            self.used += 1
+
+    def discard(self, number):
+        i = number - TICKET_MIN
+        if 0 <= i < self.size and self._bits[i >> 3] & (1 << (i & 7)):
+            self._bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+            self.used -= 1
+
+    @property
+    def free(self):
+        return self.size - self.used
+
+    def _free_numbers(self):
+        free = []
+        for byte_index, byte in enumerate(self._bits):
+            if byte == 0xFF:
+                continue
+            for bit in range(8):
+                i = (byte_index << 3) + bit
+                if i < self.size and not byte & (1 << bit):
+                    free.append(TICKET_MIN + i)
+        return free
+
+    def allocate(self, count):
+        """Mark count random unused numbers as used and return them"""
+        if count <= 0:
+            return []
+        if count > self.free:
+            raise TicketSpaceExhausted(
+                f"Only {self.free} ticket numbers are left in this raffle, {count} requested"
+            )
+        if self.used + count <= self.size // 2:
+            # At most half the space is taken, so each draw succeeds with
+            # probability >= 1/2 and this stays O(count)
+            numbers = []
+            while len(numbers) < count:
+                number = random.randint(TICKET_MIN, TICKET_MAX)
+                if number not in self:
+                    self.add(number)
+                    numbers.append(number)
+            return numbers
+        # Dense raffle: sample straight from the remaining free pool
+        numbers = random.sample(self._free_numbers(), count)
+        for number in numbers:
+            self.add(number)
+        return numbers
+
+
+def _buyer_matches(buyer, paid=None, q=None):
+    """Whether a buyer passes the paid filter and the name/email search q"""
+    if paid is not None and bool(buyer.get('paymentReceived')) != paid:
+        return False
+    if q:
+        q = q.casefold()
+        full_name = f"{buyer.get('name') or ''} {buyer.get('surname') or ''}".casefold()
+        return q in full_name or q in (buyer.get('email') or '').casefold()
+    return True
+
+
+def _ticket_count(buyer):
+    try:
+        return int(buyer.get('tickets', len(buyer.get('ticket_numbers', []))))
+    except (TypeError, ValueError):
+        return len(buyer.get('ticket_numbers', []))
+
+
+class RaffleIndex:
+    """Lookup structures derived from one raffle's buyer list"""
+
+    def __init__(self, raffle_id, buyers, version):
+        self.raffle_id = str(raffle_id)
+        self.version = version
+        self.buyers = {}
+        # buyerNumbers in ascending order, for cursor pagination
+        self.numbers = []
+        self.ticket_owner = {}
+        # Tickets as last indexed, so an edit can be diffed even after the
+        # caller has already changed the buyer dict in place
+        self.tickets_of = {}
+        self.allocator = TicketAllocator()
+        # Running totals, adjusted by each put/remove instead of rescanning.
+        # counted remembers what each buyer contributed for the same reason
+        # as tickets_of.
+        self.counted = {}
+        self.totals = {"totalBuyers": 0, "totalTickets": 0, "paidBuyers": 0, "paidTickets": 0}
+        for buyer in buyers:
+            self.put(buyer)
+
+    def _count(self, buyer_number, sign):
+        tickets, paid = self.counted[buyer_number]
+        self.totals["totalBuyers"] += sign
+        self.totals["totalTickets"] += sign * tickets
+        if paid:
+            self.totals["paidBuyers"] += sign
+            self.totals["paidTickets"] += sign * tickets
+
+    def put(self, buyer):
+        number = buyer.get('buyerNumber')
+        old = self.tickets_of.get(number, ())
+        new = tuple(buyer.get('ticket_numbers', []))
+        for ticket in set(old) - set(new):
+            self.allocator.discard(ticket)
+            if self.ticket_owner.get(ticket) == number:
+                del self.ticket_owner[ticket]
+        for ticket in new:
+            self.allocator.add(ticket)
+            self.ticket_owner[ticket] = number
+        self.tickets_of[number] = new
+        if number in self.counted:
+            self._count(number, -1)
+        self.counted[number] = (_ticket_count(buyer), bool(buyer.get('paymentReceived')))
+        self._count(number, 1)
+        if number not in self.buyers:
+            if not self.numbers or number > self.numbers[-1]:
+                self.numbers.append(number)
+            else:
+                bisect.insort(self.numbers, number)
+        self.buyers[number] = buyer
+
+    def remove(self, buyer_number):
+        if self.buyers.pop(buyer_number, None) is not None:
+            del self.numbers[bisect.bisect_left(self.numbers, buyer_number)]
+            self._count(buyer_number, -1)
+            del self.counted[buyer_number]
+        for ticket in self.tickets_of.pop(buyer_number, ()):
+            self.allocator.discard(ticket)
+            if self.ticket_owner.get(ticket) == buyer_number:
+                del self.ticket_owner[ticket]
+
+
+class Store:
+    """A storage backend plus the per-raffle indexes derived from it.
+
+    Anything not defined here is delegated to the backend, so routes use a
+    Store exactly like a backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.index_builds = 0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @contextmanager
+    def transaction(self):
+        with self.backend.transaction():
+            try:
+                yield self
+            except BaseException:
+                # Writes may have been rolled back underneath updated indexes
+                with self._lock:
+                    self._indexes.clear()
+                raise
+
+    def raffle_index(self, raffle_id):
+        """Current index for raffle_id, rebuilt if the buyers changed since it was built"""
+        raffle_id = str(raffle_id)
+        version = self.backend.buyers_version(raffle_id)
+        with self._lock:
+            index = self._indexes.get(raffle_id)
+        if index is not None and index.version == version:
+            return index
+        index = RaffleIndex(raffle_id, self.backend.load_buyers(raffle_id), version)
+        with self._lock:
+            self._indexes[raffle_id] = index
+            self.index_builds += 1
+        return index
+
+    def _drop_index(self, raffle_id):
+        with self._lock:
+            self._indexes.pop(str(raffle_id), None)
+
+    def allocate_tickets(self, raffle_id, count):
+        """Reserve count unused random ticket numbers; call inside transaction()
+
+        Raises TicketSpaceExhausted if the raffle does not have that many left.
+        """
+        return self.raffle_index(raffle_id).allocator.allocate(count)
+
+    def get_buyer(self, raffle_id, buyer_number):
+        """Buyer with buyer_number in raffle_id, or None"""
+        return self.raffle_index(raffle_id).buyers.get(buyer_number)
+
+    def next_buyer_number(self, raffle_id):
+        """Allocate a buyerNumber that has never been used in this raffle; call inside transaction()"""
+        return self.next_buyer_numbers(raffle_id, 1)[0]
+
+    def next_buyer_numbers(self, raffle_id, count):
+        """Allocate count consecutive, never used buyerNumbers with one counter update"""
+        if count <= 0:
+            return []
+        index = self.raffle_index(raffle_id)
+        first = self.backend.allocate_buyer_number(raffle_id, max(index.buyers, default=0), count)
+        return list(range(first, first + count))
+
+    def query_buyers(self, raffle_id, limit=None, after=None, paid=None, q=None):
+        """One page of buyers in buyerNumber order, filtered by payment status and q.
+
+        Returns (buyers, next_cursor); next_cursor is the buyerNumber to pass
+        as after for the following page, or None on the last page. Backends
+        that can query natively do so, the others walk the index.
+        """
+        if hasattr(self.backend, 'query_buyers'):
+            return self.backend.query_buyers(raffle_id, limit, after, paid, q)
+        index = self.raffle_index(raffle_id)
+        numbers = index.numbers
+        start = 0 if after is None else bisect.bisect_right(numbers, after)
+        page = []
+        for number in numbers[start:]:
+            buyer = index.buyers[number]
+            if not _buyer_matches(buyer, paid, q):
+                continue
+            if limit is not None and len(page) == limit:
+                return page, page[-1]['buyerNumber']
+            page.append(buyer)
+        return page, None
+
+    def _etag(self, *parts):
+        key = repr((self.backend.name, getattr(self.backend, 'instance', None)) + parts)
+        return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+    def raffles_etag(self, raffle_id=None):
+        """Strong validator for the raffle list, or one raffle; changes on every raffle mutation"""
+        return self._etag('raffles', raffle_id and str(raffle_id), self.backend.raffles_version())
+
+    def buyers_etag(self, raffle_id, buyer_number=None):
+        """Strong validator for a raffle's buyers, or one buyer; changes on every buyer mutation"""
+        return self._etag('buyers', str(raffle_id), buyer_number, self.backend.buyers_version(raffle_id))
+
+    def find_ticket(self, raffle_id, ticket_number):
+        """Buyer holding ticket_number in raffle_id, or None"""
+        index = self.raffle_index(raffle_id)
+        buyer_number = index.ticket_owner.get(ticket_number)
+        return index.buyers.get(buyer_number) if buyer_number is not None else None
+
+    # Buyer mutations keep the index in step with the backend
+
+    def put_buyer(self, raffle_id, buyer):
+        self.put_buyers(raffle_id, [buyer])
+
+    def put_buyers(self, raffle_id, buyers):
+        with self.transaction():
+            index = self.raffle_index(raffle_id)
+            self.backend.put_buyers(raffle_id, buyers)
+            for buyer in buyers:
+                index.put(buyer)
+            index.version = self.backend.buyers_version(raffle_id)
+
+    def set_payment(self, raffle_id, buyer_number, payment_received):
+        updated = self.set_payments(raffle_id, {buyer_number: payment_received})
+        return updated[0] if updated else None
+
+    def set_payments(self, raffle_id, payments):
+        """Apply {buyerNumber: paymentReceived} under one lock and one write; returns the updated buyers"""
+        with self.transaction():
+            index = self.raffle_index(raffle_id)
+            payments = {n: paid for n, paid in payments.items() if n in index.buyers}
+            if not payments:
+                return []
+            updated = self.backend.set_payments(raffle_id, payments)
+            for buyer in updated:
+                index.put(buyer)
+            index.version = self.backend.buyers_version(raffle_id)
+            return updated
+
+    def payment_totals(self, raffle_id):
+        """Buyer and ticket counts for the raffle, split by payment status"""
+        return dict(self.raffle_index(raffle_id).totals)
+
+    def delete_buyer(self, raffle_id, buyer_number):
+        with self.transaction():
+            index = self.raffle_index(raffle_id)
+            if buyer_number not in index.buyers:
+                return False
+            deleted = self.backend.delete_buyer(raffle_id, buyer_number)
+            if deleted:
+                index.remove(buyer_number)
+                index.version = self.backend.buyers_version(raffle_id)
+            return deleted
+
+    def replace_buyers(self, raffle_id, buyers):
+        self.backend.replace_buyers(raffle_id, buyers)
+        self._drop_index(raffle_id)
+
+    def delete_buyers(self, raffle_id):
+        self.backend.delete_buyers(raffle_id)
+        self._drop_index(raffle_id)
+
+    def delete_raffle(self, raffle_id):
+        self.backend.delete_raffle(raffle_id)
+        self._drop_index(raffle_id)
+
+    def stats(self):
+        stats = self.backend.stats()
+        with self._lock:
+            stats["indexes"] = {"raffles": len(self._indexes), "builds": self.index_builds}
+        return stats
+
+
+BACKENDS = {
+    'json': JsonBackend,
+    'sharded': lambda: ShardedJsonBackend(buyers_dir=os.environ.get('BUYERS_DIR', BUYERS_DIR)),
+    'journal': lambda: JournaledJsonBackend(
+        max_records=int(os.environ.get('JOURNAL_MAX_RECORDS', JOURNAL_MAX_RECORDS)),
+        max_bytes=int(os.environ.get('JOURNAL_MAX_BYTES', JOURNAL_MAX_BYTES))
+    ),
+    'sqlite': lambda: SqliteBackend(os.environ.get('SQLITE_PATH', SQLITE_PATH)),
+}
+
+
+def open_backend(kind=None):
+    """Create a Store over the backend named by kind or the STORAGE_BACKEND env var"""
+    kind = (kind or os.environ.get('STORAGE_BACKEND', 'json')).lower()
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {kind} (expected one of {', '.join(BACKENDS)})")
+    return Store(BACKENDS[kind]())
+
+
+if __name__ == '__main__':
+    target = sys.argv[2] if len(sys.argv) > 2 else 'sqlite'
+    if sys.argv[1:2] != ['migrate'] or target not in ('sqlite', 'sharded'):
+        print("Usage: python storage.py migrate [sqlite|sharded]")
+        sys.exit(1)
+
+    print("=" * 50)
+    if target == 'sqlite':
+        print("Migrating JSON data to SQLite")
+        print("=" * 50)
+        db_path = os.environ.get('SQLITE_PATH', SQLITE_PATH)
+        result = migrate_json_to_sqlite(SqliteBackend(db_path, migrate=False))
+        print(f"Raffles: {result['raffles']}")
+        print(f"Buyers: {result['buyers']}")
+        print(f"Database: {db_path}")
+    else:
+        print("Splitting buyers.json into per-raffle shards")
+        print("=" * 50)
+        buyers_dir = os.environ.get('BUYERS_DIR', BUYERS_DIR)
+        result = split_buyers_file(buyers_dir=buyers_dir)
+        print(f"Raffles: {result['raffles']}")
+        print(f"Buyers: {result['buyers']}")
+        print(f"Shards: {buyers_dir}/")
+    print("\nDone!")
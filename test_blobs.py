@@ -0,0 +1,73 @@
+"""
+Tests for the content-addressed blob store.
+
+Usage:
+    python -m unittest test_blobs
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from blobs import BlobStore, referenced_blobs
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blobs = BlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def put(self, data, age=0):
+        name = self.blobs.put_stream(io.BytesIO(data), 'jpg')
+        if age:
+            past = time.time() - age
+            os.utime(self.blobs.path(name), (past, past))
+        return name
+
+    def test_identical_bytes_share_a_blob(self):
+        self.assertEqual(self.put(b'same'), self.put(b'same'))
+        self.assertNotEqual(self.put(b'same'), self.put(b'other'))
+        self.assertEqual(self.blobs.stats()['blobs'], 2)
+
+    def test_gc_keeps_referenced_and_recent_blobs(self):
+        referenced = self.put(b'referenced', age=7200)
+        recent = self.put(b'recent', age=60)
+        old = self.put(b'old', age=7200)
+        result = self.blobs.gc({referenced}, grace=3600)
+        self.assertEqual((result['kept'], result['removed']), (2, 1))
+        self.assertTrue(self.blobs.exists(referenced))
+        self.assertTrue(self.blobs.exists(recent))
+        self.assertFalse(self.blobs.exists(old))
+
+    def test_storing_the_same_bytes_again_restarts_the_grace_period(self):
+        name = self.put(b'reused', age=7200)
+        self.put(b'reused')
+        self.blobs.gc(set(), grace=3600)
+        self.assertTrue(self.blobs.exists(name))
+
+    def test_gc_removes_old_leftovers_of_interrupted_writes(self):
+        leftover = os.path.join(self.directory, '.upload-x.tmp')
+        fresh = os.path.join(self.directory, '.upload-y.tmp')
+        for path in (leftover, fresh):
+            open(path, 'wb').close()
+        past = time.time() - 7200
+        os.utime(leftover, (past, past))
+        self.blobs.gc(set(), grace=3600)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_referenced_blobs(self):
+        name = self.put(b'image')
+        raffles = [{"image": name, "thumbnail": "raffle_1_thumb.jpg"}, {"image": None}]
+        self.assertEqual(referenced_blobs(raffles), {name})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests for the weighted draw engine.
+
+Usage:
+    python -m unittest test_draw
+"""
+
+import random
+import unittest
+from collections import Counter
+
+from draw import CumulativeCounts, DrawError, draw_winners
+
+BUYERS = [
+    {"buyerNumber": 1, "ticket_numbers": [100001]},
+    {"buyerNumber": 2, "ticket_numbers": [100002, 100003, 100004]},
+    {"buyerNumber": 3, "ticket_numbers": []},
+    {"buyerNumber": 4, "ticket_numbers": [100005, 100006]},
+]
+TICKETS = [ticket for buyer in BUYERS for ticket in buyer['ticket_numbers']]
+
+
+class CumulativeCountsTest(unittest.TestCase):
+
+    def test_find_maps_every_position_to_its_slot(self):
+        weights = [3, 0, 1, 4, 0, 2]
+        counts = CumulativeCounts(weights)
+        expected = [(index, offset) for index, weight in enumerate(weights) for offset in range(weight)]
+        self.assertEqual([counts.find(p) for p in range(counts.total)], expected)
+
+    def test_add_updates_the_ranges(self):
+        counts = CumulativeCounts([2, 2, 2])
+        counts.add(1, -2)
+        self.assertEqual(counts.total, 4)
+        self.assertEqual([counts.find(p) for p in range(4)], [(0, 0), (0, 1), (2, 0), (2, 1)])
+
+
+class DrawWinnersTest(unittest.TestCase):
+
+    def test_every_ticket_has_exactly_one_position(self):
+        # Walking every value randbelow can return covers each ticket once: the draw is uniform per ticket
+        drawn = [draw_winners(BUYERS, randbelow=lambda n, p=p: p)[0] for p in range(len(TICKETS))]
+        self.assertEqual(sorted(ticket for _, ticket in drawn), sorted(TICKETS))
+        for buyer, ticket in drawn:
+            self.assertIn(ticket, buyer['ticket_numbers'])
+
+    def test_wins_follow_ticket_counts(self):
+        rng = random.Random(17)
+        wins = Counter(draw_winners(BUYERS, randbelow=rng.randrange)[0][0]['buyerNumber'] for _ in range(12000))
+        self.assertNotIn(3, wins)
+        for buyer in BUYERS:
+            expected = 12000 * len(buyer['ticket_numbers']) / len(TICKETS)
+            self.assertAlmostEqual(wins[buyer['buyerNumber']], expected, delta=expected * 0.1 + 1)
+
+    def test_several_winners_hold_distinct_tickets(self):
+        for seed in range(50):
+            drawn = draw_winners(BUYERS, count=len(TICKETS), randbelow=random.Random(seed).randrange)
+            self.assertEqual(sorted(ticket for _, ticket in drawn), sorted(TICKETS))
+
+    def test_one_win_per_buyer(self):
+        for seed in range(50):
+            drawn = draw_winners(BUYERS, count=3, one_win_per_buyer=True, randbelow=random.Random(seed).randrange)
+            self.assertEqual(sorted(buyer['buyerNumber'] for buyer, _ in drawn), [1, 2, 4])
+            for buyer, ticket in drawn:
+                self.assertIn(ticket, buyer['ticket_numbers'])
+
+    def test_too_many_winners_is_an_error(self):
+        with self.assertRaises(DrawError):
+            draw_winners(BUYERS, count=4, one_win_per_buyer=True)
+        with self.assertRaises(DrawError):
+            draw_winners(BUYERS, count=len(TICKETS) + 1)
+        with self.assertRaises(DrawError):
+            draw_winners(BUYERS, count=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests for the notification outbox.
+
+Usage:
+    python -m unittest test_outbox
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailer import MessageTemplate
+from outbox import Outbox
+
+TEMPLATE = MessageTemplate('raffles@example.com', 'Payment received', 'Thanks {{name}}')
+
+
+def recipient(buyer_number):
+    return (buyer_number, f"buyer{buyer_number}@example.com", {"name": f"Buyer {buyer_number}"})
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def send_all(self):
+        """Claim every due message and record it as sent; returns the recipients"""
+        claimed = self.outbox.claim('test', 100)
+        self.outbox.record('test', [(message_id, None) for message_id, _, _, _ in claimed])
+        return [to for _, _, to, _ in claimed]
+
+    def test_a_message_is_queued_once_per_buyer_and_kind(self):
+        job_id, queued, skipped = self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1), recipient(2)])
+        self.assertEqual((queued, skipped), (2, 0))
+        again, queued, skipped = self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1), recipient(2)])
+        self.assertEqual((again, queued, skipped), (job_id, 0, 2))
+        _, queued, _ = self.outbox.enqueue('1', 'winner', TEMPLATE, [recipient(1)])
+        self.assertEqual(queued, 1)
+        _, queued, _ = self.outbox.enqueue('2', 'payment', TEMPLATE, [recipient(1)])
+        self.assertEqual(queued, 1)
+
+    def test_paid_unpaid_paid_sends_a_new_confirmation(self):
+        self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1), recipient(2)])
+        self.assertEqual(sorted(self.send_all()), ['buyer1@example.com', 'buyer2@example.com'])
+        # Marked unpaid: the confirmation is forgotten for that buyer only
+        self.outbox.supersede('1', 'payment', [1])
+        job_id, queued, skipped = self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1), recipient(2)])
+        self.assertEqual((queued, skipped), (1, 1))
+        self.assertEqual(self.send_all(), ['buyer1@example.com'])
+        self.assertEqual(self.outbox.job(job_id)['sent'], 1)
+        # Paid again without being marked unpaid first: nothing new
+        _, queued, _ = self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1)])
+        self.assertEqual(queued, 0)
+
+    def test_supersede_cancels_unsent_messages(self):
+        job_id, _, _ = self.outbox.enqueue('1', 'winner', TEMPLATE, [recipient(1), recipient(2), recipient(3)])
+        claimed = self.outbox.claim('test', 1)
+        self.outbox.supersede('1', 'winner')
+        # One that was being sent when it was cancelled stays cancelled
+        self.outbox.record('test', [(claimed[0][0], None)])
+        job = self.outbox.job(job_id)
+        self.assertEqual((job['cancelled'], job['sent'], job['pending'], job['done']), (3, 0, 0, True))
+        self.assertEqual(self.outbox.claim('test', 100), [])
+        _, queued, _ = self.outbox.enqueue('1', 'winner', TEMPLATE, [recipient(1), recipient(2), recipient(3)])
+        self.assertEqual(queued, 3)
+
+    def test_supersede_leaves_other_kinds_and_raffles_alone(self):
+        self.outbox.enqueue('1', 'payment', TEMPLATE, [recipient(1)])
+        self.outbox.enqueue('1', 'winner', TEMPLATE, [recipient(1)])
+        self.outbox.enqueue('2', 'payment', TEMPLATE, [recipient(1)])
+        self.outbox.supersede('1', 'payment', [1])
+        self.assertEqual(self.outbox.stats()['cancelled'], 1)
+        self.assertEqual(len(self.send_all()), 2)
+
+    def test_rate_limit_tokens_are_shared(self):
+        other = Outbox(self.outbox.path)
+        self.assertEqual(self.outbox.take_token('smtp', 1, 2), 0)
+        self.assertEqual(other.take_token('smtp', 1, 2), 0)
+        # The bucket is empty for both, whichever one asks
+        self.assertGreater(self.outbox.take_token('smtp', 1, 2), 0)
+        self.assertGreater(other.take_token('smtp', 1, 2), 0)
+        self.assertEqual(other.take_token('other-smtp', 1, 2), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Tests for the storage backends.
+
+Usage:
+    python -m unittest test_storage
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import (TICKET_MAX, TICKET_MIN, JournaledJsonBackend, JsonBackend, ShardedJsonBackend,
+                     SqliteBackend, Store, TicketAllocator, TicketSpaceExhausted)
+
+BUYERS = [
+    {"buyerNumber": 1, "name": "Élodie", "surname": "Straße", "email": "elodie@example.com",
+     "tickets": 1, "ticket_numbers": [100001], "paymentReceived": True},
+    {"buyerNumber": 2, "name": "Zoë", "email": "zoe@example.com",
+     "tickets": 1, "ticket_numbers": [100002], "paymentReceived": False},
+    {"buyerNumber": 3, "name": "John", "surname": "Doe", "email": "JOHN@EXAMPLE.COM",
+     "tickets": 2, "ticket_numbers": [100003, 100004], "paymentReceived": False},
+    {"buyerNumber": 4, "surname": "Ngũgĩ", "email": "n@example.com",
+     "tickets": 1, "ticket_numbers": [100005], "paymentReceived": True},
+    {"buyerNumber": 5, "name": "Legacy", "surname": None, "email": None,
+     "tickets": 1, "ticket_numbers": [100006], "paymentReceived": False},
+]
+
+
+class BackendTestCase(unittest.TestCase):
+    """Runs against a fresh data directory; backends() opens each backend kind in it"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def backends(self):
+        return {
+            'json': lambda: JsonBackend(self.path('raffles.json'), self.path('buyers.json')),
+            'sharded': lambda: ShardedJsonBackend(self.path('raffles.json'), self.path('buyers'),
+                                                  self.path('buyers.json')),
+            'journal': lambda: JournaledJsonBackend(self.path('raffles.json'), self.path('buyers.json'),
+                                                    self.path('buyers.journal')),
+            'sqlite': lambda: SqliteBackend(self.path('raffles.db'), migrate=False),
+        }
+
+    def reset(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+
+class QueryBuyersTest(BackendTestCase):
+    """query_buyers gives the same results on every backend"""
+
+    def query(self, kind, **filters):
+        store = Store(self.backends()[kind]())
+        store.put_buyers('1', [dict(buyer) for buyer in BUYERS])
+        buyers, _ = store.query_buyers('1', **filters)
+        return [buyer['buyerNumber'] for buyer in buyers]
+
+    def test_search_matches_on_every_backend(self):
+        cases = [
+            ({"q": "élodie"}, [1]),
+            ({"q": "ÉLODIE STRASSE"}, [1]),   # casefold: ß matches ss
+            ({"q": "zoë"}, [2]),              # no surname
+            ({"q": "ZOË"}, [2]),
+            ({"q": "ngũgĩ"}, [4]),            # no name
+            ({"q": "legacy"}, [5]),           # null surname and email
+            ({"q": "john@example"}, [3]),
+            ({"q": "%"}, []),
+            ({"q": "example.com", "paid": True}, [1, 4]),
+        ]
+        for kind in self.backends():
+            for filters, expected in cases:
+                with self.subTest(backend=kind, **filters):
+                    self.assertEqual(self.query(kind, **filters), expected)
+            self.reset()
+
+
+class BuyerNumbersTest(BackendTestCase):
+    """buyerNumbers are never reused, even after the buyers holding them are deleted"""
+
+    def add(self, store, raffle_id, count):
+        with store.transaction():
+            numbers = store.next_buyer_numbers(raffle_id, count)
+            store.put_buyers(raffle_id, [{"buyerNumber": n, "name": f"Buyer {n}", "tickets": 0,
+                                          "ticket_numbers": []} for n in numbers])
+        return numbers
+
+    def test_numbers_are_not_reused_after_a_delete(self):
+        for kind, open_backend in self.backends().items():
+            with self.subTest(backend=kind):
+                store = Store(open_backend())
+                self.assertEqual(self.add(store, '1', 3), [1, 2, 3])
+                self.assertTrue(store.delete_buyer('1', 3))
+                self.assertEqual(self.add(store, '1', 1), [4])
+                store.delete_buyers('1')
+                self.assertEqual(self.add(store, '1', 2), [5, 6])
+                # The counter is persisted, not derived from the remaining buyers
+                self.assertEqual(self.add(Store(open_backend()), '1', 1), [7])
+                self.assertEqual(self.add(store, '2', 1), [1])
+            self.reset()
+
+
+class TicketAllocatorTest(unittest.TestCase):
+    """TicketAllocator never hands out a ticket number twice"""
+
+    def test_sparse_allocations_are_unique(self):
+        allocator = TicketAllocator([TICKET_MIN, TICKET_MAX])
+        numbers = []
+        for _ in range(200):
+            numbers.extend(allocator.allocate(50))
+        self.assertEqual(len(numbers), len(set(numbers)))
+        self.assertNotIn(TICKET_MIN, numbers)
+        self.assertNotIn(TICKET_MAX, numbers)
+        self.assertTrue(all(TICKET_MIN <= n <= TICKET_MAX for n in numbers))
+        self.assertEqual(allocator.used, len(numbers) + 2)
+
+    def test_dense_allocation_takes_exactly_the_free_numbers(self):
+        free = set(range(TICKET_MIN, TICKET_MIN + 1000, 10))
+        allocator = TicketAllocator(n for n in range(TICKET_MIN, TICKET_MAX + 1) if n not in free)
+        self.assertEqual(set(allocator.allocate(len(free))), free)
+        self.assertEqual(allocator.free, 0)
+        with self.assertRaises(TicketSpaceExhausted):
+            allocator.allocate(1)
+
+    def test_discarded_numbers_can_be_allocated_again(self):
+        allocator = TicketAllocator(n for n in range(TICKET_MIN, TICKET_MAX + 1) if n != TICKET_MIN)
+        allocator.discard(TICKET_MAX)
+        self.assertEqual(sorted(allocator.allocate(2)), [TICKET_MIN, TICKET_MAX])
+
+    def test_store_never_reissues_a_stored_ticket(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = Store(JsonBackend(os.path.join(directory, 'raffles.json'), os.path.join(directory, 'buyers.json')))
+        store.put_buyers('1', [dict(buyer) for buyer in BUYERS])
+        taken = {n for buyer in BUYERS for n in buyer['ticket_numbers']}
+        with store.transaction():
+            tickets = store.allocate_tickets('1', 1000)
+        self.assertEqual(len(set(tickets)), 1000)
+        self.assertFalse(taken & set(tickets))
+        # Another process only sees the stored buyers
+        with store.transaction():
+            store.put_buyer('1', {"buyerNumber": 6, "tickets": 1000, "ticket_numbers": tickets})
+        other = Store(JsonBackend(os.path.join(directory, 'raffles.json'), os.path.join(directory, 'buyers.json')))
+        with other.transaction():
+            more = other.allocate_tickets('1', 1000)
+        self.assertFalse((taken | set(tickets)) & set(more))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Tests for upload checks and image processing.
+
+Usage:
+    python -m unittest test_thumbnails
+"""
+
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from PIL import Image
+
+from thumbnails import UploadRejected, ingest_upload, inspect_upload
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def bomb_png(width=30000, height=30000):
+    """A few hundred bytes of PNG whose header claims width x height pixels"""
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    pixels = zlib.compress(b'\0' * (width * 3 + 1) * 4)
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + png_chunk(b'IDAT', pixels)
+            + png_chunk(b'IEND', b''))
+
+
+def image_bytes(size, fmt='JPEG', **save_options):
+    buffered = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffered, fmt, **save_options)
+    return buffered.getvalue()
+
+
+class InspectUploadTest(unittest.TestCase):
+
+    def test_decompression_bomb_is_rejected_from_its_header(self):
+        stream = io.BytesIO(bomb_png())
+        with self.assertRaises(UploadRejected):
+            inspect_upload(stream, max_pixels=40_000_000)
+        self.assertEqual(stream.tell(), 0)
+
+    def test_pixel_limit(self):
+        data = image_bytes((200, 100))
+        inspect_upload(io.BytesIO(data), max_pixels=20_000)
+        with self.assertRaises(UploadRejected):
+            inspect_upload(io.BytesIO(data), max_pixels=19_999)
+
+    def test_not_an_image(self):
+        with self.assertRaisesRegex(UploadRejected, 'Not a valid image file'):
+            inspect_upload(io.BytesIO(b'<html>not an image</html>'))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(UploadRejected):
+            inspect_upload(io.BytesIO(image_bytes((10, 10), 'BMP')))
+
+
+class IngestUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        return self.path(name)
+
+    def test_worker_rejects_a_bomb_too(self):
+        upload = self.write('upload', bomb_png())
+        with self.assertRaises(UploadRejected):
+            ingest_upload(upload, self.path('image'), self.path('thumb'))
+        self.assertFalse(os.path.exists(self.path('image')))
+
+    def test_image_is_scaled_down_and_thumbnailed(self):
+        upload = self.write('upload', image_bytes((4000, 1000)))
+        ext, _ = ingest_upload(upload, self.path('image'), self.path('thumb'), max_dimension=2000,
+                               max_size=(300, 300))
+        self.assertEqual(ext, 'jpg')
+        with Image.open(self.path('image')) as img:
+            self.assertEqual(img.size, (2000, 500))
+        with Image.open(self.path('thumb')) as thumb:
+            self.assertEqual((thumb.format, thumb.size), ('JPEG', (300, 75)))
+
+    def test_exif_orientation_is_applied_and_metadata_dropped(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated 90 degrees clockwise
+        upload = self.write('upload', image_bytes((400, 200), exif=exif.tobytes()))
+        ingest_upload(upload, self.path('image'), self.path('thumb'))
+        with Image.open(self.path('image')) as img:
+            self.assertEqual(img.size, (200, 400))
+            self.assertNotIn(0x0112, img.getexif())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+Uploaded images and their thumbnails, processed in a pool of worker processes.
+
+Decoding a large upload, resizing it (LANCZOS) and encoding the results is
+CPU bound and can take seconds for a phone photo, so the request that
+receives an upload only checks its header (inspect_upload: format and pixel
+dimensions, without decoding anything), spools it to a temporary file and
+submits a job to ThumbnailQueue. A pool of THUMBNAIL_WORKERS processes
+(spawned, not forked, so they don't inherit the app's threads and locks)
+decodes the upload once and writes both the normalized image (EXIF
+orientation applied, metadata stripped, at most IMAGE_MAX_DIMENSION pixels
+on the long side) and its thumbnail into temporary files; back in the app
+process the callback stores them (e.g. in the blob store) and records the
+result. Uploads over IMAGE_MAX_PIXELS are rejected before they are decoded,
+which bounds the memory a worker needs per image.
+
+Jobs are keyed by raffle: if an image is replaced while the previous
+thumbnail is still being made, the earlier job's result is discarded. Pass
+the store's transaction as guard and submit inside it, so a result is
+either applied before a replacing upload is saved or discarded after.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (300, 300)
+THUMBNAIL_QUALITY = 85
+MAX_PIXELS = 40_000_000
+MAX_DIMENSION = 2560
+# Upload format -> (stored extension, Pillow save options); GIFs are stored as (still) PNGs
+IMAGE_FORMATS = {
+    'JPEG': ('jpg', {'format': 'JPEG', 'quality': 90, 'optimize': True}),
+    'PNG': ('png', {'format': 'PNG'}),
+    'GIF': ('png', {'format': 'PNG'}),
+    'WEBP': ('webp', {'format': 'WEBP', 'quality': 90}),
+}
+
+
+class UploadRejected(ValueError):
+    """An upload that is not an acceptable image"""
+
+
+def thumbnail_settings():
+    """(max_size, quality) from THUMBNAIL_MAX_SIZE and THUMBNAIL_QUALITY"""
+    size = int(os.environ.get('THUMBNAIL_MAX_SIZE', THUMBNAIL_SIZE[0]))
+    return (size, size), int(os.environ.get('THUMBNAIL_QUALITY', THUMBNAIL_QUALITY))
+
+
+def image_limits():
+    """(max_pixels, max_dimension) from IMAGE_MAX_PIXELS and IMAGE_MAX_DIMENSION"""
+    return (int(os.environ.get('IMAGE_MAX_PIXELS', MAX_PIXELS)),
+            int(os.environ.get('IMAGE_MAX_DIMENSION', MAX_DIMENSION)))
+
+
+def check_image(img, max_pixels):
+    """Raise UploadRejected unless the opened (not yet decoded) image is of an accepted format and size"""
+    if img.format not in IMAGE_FORMATS:
+        raise UploadRejected(f"Unsupported image format: {img.format}")
+    width, height = img.size
+    if width * height > max_pixels:
+        raise UploadRejected(f"Image is too large ({width}x{height} pixels, at most {max_pixels:,} pixels allowed)")
+
+
+def inspect_upload(stream, max_pixels=MAX_PIXELS):
+    """Check an upload from its header alone; the stream is rewound afterwards"""
+    try:
+        with Image.open(stream) as img:
+            check_image(img, max_pixels)
+    except UnidentifiedImageError:
+        raise UploadRejected("Not a valid image file")
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(str(e))
+    finally:
+        stream.seek(0)
+
+
+def flatten(img):
+    """img without transparency (composited onto white), in a mode JPEG can store"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1])
+        return background
+    if img.mode not in ('RGB', 'L'):
+        return img.convert('RGB')
+    return img
+
+
+def make_thumbnail(image_path, thumbnail_path, max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """Write a JPEG thumbnail of image_path; returns the milliseconds it took"""
+    started = time.perf_counter()
+    with Image.open(image_path) as img:
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for a fraction of the
+        # cost; keep at least twice the thumbnail size for LANCZOS to work from
+        img.draft('RGB', (max_size[0] * 2, max_size[1] * 2))
+        img = flatten(img)
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        img.save(thumbnail_path, 'JPEG', quality=quality, optimize=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def ingest_upload(upload_path, image_path, thumbnail_path, max_pixels=MAX_PIXELS, max_dimension=MAX_DIMENSION,
+                  max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """Decode an upload once and write the normalized image and its JPEG thumbnail.
+
+    The image is turned upright according to its EXIF orientation, scaled
+    down to max_dimension on its long side and saved without metadata (the
+    ICC colour profile is kept). Returns (extension of the image, milliseconds).
+    """
+    started = time.perf_counter()
+    try:
+        upload = Image.open(upload_path)
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(str(e))
+    with upload:
+        # Checked again here: the worker must not rely on the caller for its memory bound
+        check_image(upload, max_pixels)
+        extension, save_options = IMAGE_FORMATS[upload.format]
+        icc_profile = upload.info.get('icc_profile')
+        # A JPEG far larger than max_dimension is decoded at a reduced scale directly
+        upload.draft(upload.mode, (max_dimension, max_dimension))
+        img = ImageOps.exif_transpose(upload)
+
+    if max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    if extension == 'jpg':
+        img = flatten(img)
+    elif extension == 'webp' and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('LA', 'P', 'PA') else 'RGB')
+    if icc_profile:
+        save_options = dict(save_options, icc_profile=icc_profile)
+    img.save(image_path, **save_options)
+
+    thumbnail = flatten(img)
+    thumbnail.thumbnail(max_size, Image.Resampling.LANCZOS)
+    thumbnail.save(thumbnail_path, 'JPEG', quality=quality, optimize=True)
+    return extension, (time.perf_counter() - started) * 1000
+
+
+def thumbnail_key(image_path, max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """Hash of the source image's content and the thumbnail settings"""
+    digest = hashlib.sha256(f"{max_size[0]}x{max_size[1]}q{quality}:".encode())
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def refresh_thumbnail(image_path, output_path, max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY, known_key=None):
+    """Render a thumbnail of image_path to output_path unless known_key shows the current one is up to date.
+
+    known_key is the key the existing thumbnail was made with (None if there
+    is none). Returns (created, key, milliseconds, source bytes).
+    """
+    started = time.perf_counter()
+    key = thumbnail_key(image_path, max_size, quality)
+    size = os.path.getsize(image_path)
+    if key == known_key:
+        return False, key, (time.perf_counter() - started) * 1000, size
+    make_thumbnail(image_path, output_path, max_size, quality)
+    return True, key, (time.perf_counter() - started) * 1000, size
+
+
+class ThumbnailQueue:
+    """Upload processing jobs run in a process pool.
+
+    on_done(raffle_id, rendered, error, timing) is called in the app
+    process, inside guard(), when a job has finished. rendered is a dict
+    with the temporary files of the normalized image ("image", with its
+    extension in "format") and of the thumbnail ("thumbnail"), None if the
+    job failed; on_done should move them to where they belong, anything
+    left behind (and the upload itself) is deleted.
+    """
+
+    def __init__(self, on_done, workers=2, guard=None, history=50):
+        self.on_done = on_done
+        self.workers = workers
+        self.guard = guard or nullcontext
+        self._executor = None
+        self._lock = threading.Lock()
+        self._current = {}   # raffle id -> token of its latest job
+        self.completed = 0
+        self.failed = 0
+        self.superseded = 0
+        self.recent = deque(maxlen=history)
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, raffle_id, upload_path, work_dir):
+        """Queue the upload at upload_path for raffle_id, replacing any job still running for it.
+
+        The queue takes over the upload file. The results are written to
+        temporary files in work_dir.
+        """
+        token = uuid.uuid4().hex[:12]
+        outputs = {"image": os.path.join(work_dir, f".image-{token}.tmp"),
+                   "thumbnail": os.path.join(work_dir, f".thumb-{token}.tmp")}
+        args = (ingest_upload, upload_path, outputs["image"], outputs["thumbnail"],
+                *image_limits(), *thumbnail_settings())
+        queued_at = time.monotonic()
+        with self._lock:
+            self._current[raffle_id] = token
+            try:
+                future = self._pool().submit(*args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool
+                logger.warning("Thumbnail process pool broken, restarting it")
+                self._executor = None
+                future = self._pool().submit(*args)
+        future.add_done_callback(
+            lambda f: self._finish(f, raffle_id, token, [upload_path, *outputs.values()], outputs, queued_at))
+
+    def _finish(self, future, raffle_id, token, temp_paths, outputs, queued_at):
+        error = future.exception()
+        timing = {
+            "raffleId": raffle_id,
+            "renderMs": None if error else round(future.result()[1], 1),
+            "totalMs": round((time.monotonic() - queued_at) * 1000, 1),
+        }
+        with self.guard():
+            try:
+                with self._lock:
+                    if self._current.get(raffle_id) != token:
+                        self.superseded += 1
+                        return
+                    del self._current[raffle_id]
+                    if error is None:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    timing["ok"] = error is None
+                    self.recent.append(timing)
+                try:
+                    self.on_done(raffle_id, None if error else dict(outputs, format=future.result()[0]), error, timing)
+                except Exception as e:
+                    logger.error(f"Error recording image of raffle {raffle_id}: {str(e)}")
+            finally:
+                for path in temp_paths:
+                    self._discard(path)
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def cancel(self, raffle_id):
+        """Forget the raffle's running job; its result will be discarded"""
+        with self._lock:
+            self._current.pop(raffle_id, None)
+
+    def stats(self):
+        with self._lock:
+            recent = list(self.recent)
+            rendered = [t["renderMs"] for t in recent if t["ok"]]
+            return {
+                "workers": self.workers,
+                "pending": len(self._current),
+                "completed": self.completed,
+                "failed": self.failed,
+                "superseded": self.superseded,
+                "avgRenderMs": round(sum(rendered) / len(rendered), 1) if rendered else None,
+                "recent": recent[-10:]
+            }
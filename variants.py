@@ -0,0 +1,246 @@
+"""
+Resized copies of uploaded images, rendered on demand and kept on disk.
+
+The raffle list, the detail view and the draw screen each want the prize
+image at a different size, and browsers that accept WebP get a much smaller
+file in that format. A variant is identified by the source blob, a width and
+a format; requested widths are rounded up to one of WIDTHS so a handful of
+files per image covers every layout, and an image is never scaled up.
+
+Rendered variants are kept in VariantCache, a directory bounded by total
+size (VARIANT_CACHE_BYTES): the least recently served files are evicted
+when a new one would exceed it. Concurrent requests for a variant that is
+not cached yet wait for a single render instead of each starting their own.
+"""
+
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)
+# Format name -> (file extension, mimetype, Pillow save options)
+FORMATS = {
+    'webp': ('webp', 'image/webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'image/jpeg', {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}),
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+RENDER_TIMEOUT = 60
+# Temporary files younger than this may be renders in progress in another process
+TEMP_GRACE = 3600
+
+
+def snap_width(width):
+    """The smallest of WIDTHS at least width wide (the largest if width exceeds them all)"""
+    for candidate in WIDTHS:
+        if candidate >= width:
+            return candidate
+    return WIDTHS[-1]
+
+
+def parse_format(fmt):
+    """Format name for a fmt query value; None for 'auto' or no value, ValueError if unsupported"""
+    fmt = (fmt or 'auto').strip().lower()
+    if fmt == 'auto':
+        return None
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format: {fmt} (use {', '.join(FORMATS)} or auto)")
+    return fmt
+
+
+def negotiate_format(accept):
+    """WebP if the Accept header allows it, otherwise JPEG"""
+    for part in (accept or '').split(','):
+        media_type, _, params = part.strip().partition(';')
+        if media_type.strip().lower() != 'image/webp':
+            continue
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        try:
+            return 'webp' if not match or float(match.group(1)) > 0 else 'jpeg'
+        except ValueError:
+            return 'jpeg'
+    return 'jpeg'
+
+
+def variant_name(blob_name, width, fmt):
+    """File name of a variant in the cache"""
+    return f"{blob_name.rsplit('.', 1)[0]}-w{width}.{FORMATS[fmt][0]}"
+
+
+def render_variant(image_path, output_path, width, fmt):
+    """Write image_path scaled down to width (never up) in fmt to output_path; returns the milliseconds it took"""
+    started = time.perf_counter()
+    with Image.open(image_path) as img:
+        source_width, source_height = img.size
+        width = min(width, source_width)
+        height = max(1, round(source_height * width / source_width))
+        # Decode JPEGs at a reduced scale where that still leaves LANCZOS twice the target size
+        img.draft('RGB', (width * 2, height * 2))
+
+        keep_alpha = fmt == 'webp' and (img.mode in ('RGBA', 'LA') or 'transparency' in img.info)
+        if keep_alpha:
+            img = img.convert('RGBA')
+        elif img.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white, as for thumbnails
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[-1])
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.Resampling.LANCZOS)
+        img.save(output_path, **FORMATS[fmt][2])
+    return (time.perf_counter() - started) * 1000
+
+
+class VariantCache:
+    """Directory of rendered files, bounded by total size, evicting the least recently used.
+
+    Recency is kept in memory and in the files' modification times, so the
+    order survives a restart. Other app processes share the directory: a file
+    one of them rendered is picked up on first use.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # name -> size, least recently used first
+        self._size = 0
+        self._rendering = {}            # name -> Future of its render in progress
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evicted = 0
+        self.render_ms = 0.0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        cutoff = time.time() - TEMP_GRACE
+        for file_name in os.listdir(self.root):
+            path = os.path.join(self.root, file_name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if file_name.startswith('.'):
+                if st.st_mtime < cutoff:
+                    # Left over from an interrupted render
+                    self._discard(path)
+                continue
+            files.append((st.st_mtime, file_name, st.st_size))
+        for _, file_name, size in sorted(files):
+            self._entries[file_name] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep=None):
+        """Remove least recently used files until the cache fits (call with the lock held)"""
+        for name in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            self._size -= self._entries.pop(name)
+            self._discard(self.path(name))
+            self.evicted += 1
+
+    def _add(self, name, size):
+        old = self._entries.pop(name, None)
+        if old is not None:
+            self._size -= old
+        self._entries[name] = size
+        self._size += size
+        self._evict(keep=name)
+
+    def _lookup(self, name):
+        """Path of a cached file, marking it recently used; None if it isn't there (call with the lock held)"""
+        path = self.path(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            # Evicted by another process
+            if name in self._entries:
+                self._size -= self._entries.pop(name)
+            return None
+        if name in self._entries:
+            self._entries.move_to_end(name)
+        else:
+            self._add(name, st.st_size)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return path
+
+    def get(self, name, render):
+        """Path of the cached file name, calling render(temp_path) to create it on a miss.
+
+        Only one render per name runs at a time; other callers wait for it and
+        share its result (or its exception).
+        """
+        with self._lock:
+            path = self._lookup(name)
+            if path is not None:
+                self.hits += 1
+                return path
+            future = self._rendering.get(name)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                future = self._rendering[name] = Future()
+                leader = True
+        if not leader:
+            return future.result(timeout=RENDER_TIMEOUT)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.render-', suffix='.tmp')
+        os.close(fd)
+        try:
+            ms = render(temp_path)
+            path = self.path(name)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+            with self._lock:
+                self.render_ms += ms or 0
+                self._add(name, size)
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            self._discard(temp_path)
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._rendering.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "evicted": self.evicted, "rendering": len(self._rendering),
+                    "avgRenderMs": round(self.render_ms / self.misses, 1) if self.misses else None}